@@ -1,6 +1,11 @@
+from a2wsgi import WSGIMiddleware
 from flask_cors import CORS
 from flask_marshmallow import Marshmallow
 from easyearth.config.log_config import setup_logger
+from easyearth.config.serving import wsgi_threads
+from easyearth.core.compression import init_compression
+from easyearth.core.metrics import init_metrics
+from easyearth.core.serialization import ORJSONProvider
 import connexion
 
 ma = Marshmallow()
@@ -12,6 +17,15 @@ def init_api():
                 arguments={'title': 'EasyEarth API'},
                 pythonic_params=True,
                 base_path='/easyearth')
+    app.app.json = ORJSONProvider(app.app)
+    # the flask app runs on a pool of WSGI_THREADS threads instead of the 10 of connexion, the admission control of
+    # /predict leaves some of them to the other endpoints. Connexion has no option for it, so this replaces the
+    # WSGIMiddleware of its private middleware app: connexion is pinned in the requirements, and test_serving checks
+    # the replacement after an upgrade
+    app._middleware_app.asgi_app = WSGIMiddleware(app._middleware_app.asgi_app.app, workers=wsgi_threads())
+    # registered first, so that its Server-Timing header includes the compression of the response
+    init_metrics(app.app)
+    init_compression(app.app)
     CORS(app.app)
     ma.init_app(app.app)
     return app
\ No newline at end of file
@@ -32,5 +32,8 @@ if __name__ == "__main__":
     logger.info("Starting EasyEarth API server")
     # Configuration pre-checks before starting the app
     pre_check()
+    # continue the background jobs interrupted by a crash or restart, gunicorn does it in every worker
+    from easyearth.controllers.jobs_controller import resume_jobs
+    resume_jobs()
     # Start the Flask app
     app.run(host="0.0.0.0", port=3781)
\ No newline at end of file
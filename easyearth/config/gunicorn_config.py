@@ -0,0 +1,81 @@
+"""Production server configuration for gunicorn
+
+Run the server with:
+    gunicorn -c easyearth/config/gunicorn_config.py easyearth.app:app
+
+The master process loads the models of PRELOAD_MODELS (comma separated model_type:model_path pairs) before it forks
+the workers, which share the memory pages of their weights copy-on-write. The number of workers and of torch threads
+per worker are derived from the available cores, see easyearth.config.serving, and can be set with EASYEARTH_WORKERS
+and TORCH_THREADS.
+
+Reload the code without dropping requests with:
+    kill -HUP <pid of the master>
+New workers start with the new code, and the old ones finish their requests (GRACEFUL_TIMEOUT seconds at most)
+before they exit. Every worker resumes the interrupted background jobs when it starts, and those of the old workers
+once they exited, see easyearth.core.jobs. Without PRELOAD_MODELS the master imports no code of easyearth, so a reload
+picks up all of it.
+The master loads the PRELOAD_MODELS with the easyearth package, its models and the easyearth.core modules they use,
+which the new workers inherit: changes of those need a restart.
+"""
+import gc
+import importlib.util
+import logging
+import os
+
+# check for a GPU without initializing CUDA, which cannot be used any more in forked workers once initialized
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+import torch  # noqa: E402
+
+logger = logging.getLogger("easyearth")
+
+# loaded from its file, as importing easyearth.config.serving would import the easyearth package in the master, and
+# the workers would inherit it instead of importing its new code on a reload
+_spec = importlib.util.spec_from_file_location('easyearth_serving', os.path.join(os.path.dirname(__file__), 'serving.py'))
+serving = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(serving)
+
+gpu = torch.cuda.is_available()
+workers, torch_threads = serving.worker_layout(
+    serving.available_cores(), gpu,
+    workers=int(os.environ['EASYEARTH_WORKERS']) if os.environ.get('EASYEARTH_WORKERS') else None,
+    threads=int(os.environ['TORCH_THREADS']) if os.environ.get('TORCH_THREADS') else None)
+
+bind = os.environ.get('EASYEARTH_BIND', '0.0.0.0:3781')
+# connexion 3 is an ASGI application
+worker_class = 'uvicorn.workers.UvicornWorker'
+# the application is imported by every worker, so that a reload with HUP picks up new code
+preload_app = False
+timeout = int(os.environ.get('WORKER_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 300))
+keepalive = 5
+
+
+def on_starting(server):
+    """Load the models of PRELOAD_MODELS once in the master, before the workers are forked"""
+    models = os.environ.get('PRELOAD_MODELS', '')
+    if not models:
+        return
+    if gpu:
+        # CUDA does not survive a fork, the GPU worker loads the models on first use
+        logger.info("Not preloading models on a GPU server")
+        return
+    from easyearth.models.registry import preload_models
+    logger.info(f"Preloaded models: {preload_models(models)}")
+    # keep the garbage collector from writing to, and so copying, the pages of the preloaded objects
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Set the torch threads of the worker and its number of workers"""
+    torch.set_num_threads(torch_threads)
+    # the admission control of every worker gets its share of the memory
+    os.environ.setdefault('EASYEARTH_WORKERS', str(workers))
+    server.log.info(f"Worker {worker.pid}: {torch_threads} torch threads of {workers} workers")
+
+
+def post_worker_init(worker):
+    """Continue the background jobs interrupted by a crash, restart or reload once the worker loaded the app"""
+    # imported here, in the worker, as the master imports no code of easyearth
+    from easyearth.controllers.jobs_controller import resume_jobs
+    resume_jobs()
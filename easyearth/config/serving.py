@@ -0,0 +1,71 @@
+"""Number of server worker processes and torch threads per worker, derived from the available cores, the threads
+running the requests of a worker, and the memory available to the server."""
+import os
+from typing import Optional, Tuple
+
+
+def available_cores() -> int:
+    """Cores this process may use: its CPU affinity, limited by the CPU quota of its cgroup (e.g. docker --cpus)"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS and Windows
+        cores = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            cores = min(cores, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cores)
+
+
+# threads of the WSGI pool of a worker that the /predict requests leave to the other endpoints, e.g. GET /metrics,
+# GET /requests and DELETE /requests/{id}, see easyearth.core.admission.admission_limits
+RESERVED_THREADS = 4
+
+
+def wsgi_threads() -> int:
+    """Threads of a worker running the requests of the flask app, WSGI_THREADS (32 by default). A request holds its
+    thread until its response is sent, also while it waits for its turn and while it streams its events."""
+    return max(1, int(os.environ.get('WSGI_THREADS', 32)))
+
+
+def available_memory() -> Optional[int]:
+    """Memory in bytes this process may use: the physical memory, limited by the memory limit of its cgroup (e.g.
+    docker --memory), None if unknown"""
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):  # Windows
+        memory = None
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            memory = min(memory, int(limit)) if memory else int(limit)
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+def worker_layout(cores: int, gpu: bool = False, workers: Optional[int] = None,
+                  threads: Optional[int] = None) -> Tuple[int, int]:
+    """Number of worker processes and torch threads per worker
+    On a GPU all requests share one worker, so the GPU memory holds the models once. On CPU the cores are split in
+    workers of 4 threads: more threads per worker hardly speed up one forward pass, more workers serve more requests.
+    Args:
+        cores: Available cores, see available_cores
+        gpu: Whether the models run on a GPU
+        workers: Number of workers to use instead, the threads are then derived from it
+        threads: Number of threads per worker to use instead, the workers are then derived from it
+    Returns:
+        Number of workers and threads per worker
+    """
+    if workers is None:
+        if gpu:
+            workers = 1
+        else:
+            workers = max(1, cores // (threads or min(4, cores)))
+    if threads is None:
+        threads = max(1, cores // workers)
+    return workers, threads
@@ -0,0 +1,152 @@
+"""Controller for background jobs, for work that takes too long for a synchronous /predict request."""
+from flask import request, jsonify
+import json
+import os
+import threading
+import logging
+
+from easyearth.controllers.predict_controller import framework_response, result_response, run_prediction, verify_image_path
+from easyearth.core.cancellation import CancelScope, RequestCancelled, cancellable
+from easyearth.core.encoding import negotiate
+from easyearth.core.jobs import COMPLETED, UNFINISHED, Job, JobCancelled, JobManager
+from easyearth.core.metrics import stage, timed
+from easyearth.core.raster_jobs import segment_raster
+from easyearth.core.tiling import TileFilter
+from easyearth.models.registry import get_model
+from easyearth.models.segmentation import Segmentation
+
+logger = logging.getLogger("easyearth")
+
+
+def run_segment_raster(job: Job):
+    """Segment a whole raster with a segmentation model, see easyearth.core.raster_jobs"""
+    data = job.request
+    segformer = get_model(Segmentation, data.get('model_path') or 'restor/tcd-segformer-mit-b5')
+    sliding_window = data.get('sliding_window') or {}
+    segment_raster(
+        job,
+        segformer.predict_tile_logits,
+        label_dtype=segformer.label_dtype,
+        tile_size=sliding_window.get('tile_size', 512),
+        overlap=sliding_window.get('overlap', 64),
+        batch_size=sliding_window.get('batch_size', 4),
+        workers=sliding_window.get('workers', 2),
+        tile_filter=TileFilter.from_options(sliding_window.get('tile_filter')),
+    )
+
+
+def run_predict(job: Job):
+    """Run a /predict request in the background, the result is saved as result.json in the job directory"""
+    job.progress = {'stage': 'predicting'}
+    job.save()
+    with timed('predict job') as timings:
+        try:
+            # a cancelled prediction stops before its next forward pass, chunk of prompts or batch of tiles
+            with cancellable(CancelScope(job.job_id, event=job.cancelled)):
+                result = run_prediction(job.request)
+        except RequestCancelled:
+            raise JobCancelled(job.job_id)
+        # the result of a job cancelled meanwhile, e.g. by another server process, is dropped
+        job.check_cancelled()
+
+        filename = os.path.join(job.path, 'result.json')
+        with stage('write_result'):
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(result, f)
+            os.replace(filename + '.tmp', filename)
+    job.outputs = {'result': filename}
+    job.progress = {'stage': 'done', 'objects': len(result.get('features', result.get('masks', []))),
+                    'timings': timings.to_dict()}
+
+
+RUNNERS = {
+    'segment_raster': run_segment_raster,
+    'predict': run_predict,
+}
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Get the process-wide job manager, saving jobs to BASE_DIR/jobs by default"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            directory = os.environ.get('JOBS_DIR', os.path.join(os.environ.get('BASE_DIR', '.'), 'jobs'))
+            # results of predict jobs are removed after JOB_RESULT_TTL seconds, segmented rasters are kept
+            _manager = JobManager(directory, RUNNERS, workers=int(os.environ.get('JOB_WORKERS', 1)),
+                                  ttl={'predict': float(os.environ.get('JOB_RESULT_TTL', 3600))})
+        return _manager
+
+
+def resume_jobs():
+    """Resume the jobs that were interrupted by a crash or restart of the server, and every RESUME_INTERVAL seconds
+    (30 by default) those of the server processes that stopped meanwhile, e.g. the old workers of a reload"""
+    if os.environ.get('RESUME_JOBS', 'true').lower() in ('1', 'true', 'yes'):
+        manager = get_job_manager()
+        manager.resume()
+        manager.watch(float(os.environ.get('RESUME_INTERVAL', 30)))
+
+
+def create_job():
+    """Queue a job and return its id immediately"""
+    data = request.get_json()
+    job_type = data.get('job_type', 'segment_raster')
+    image_path = data.get('image_path')
+
+    if job_type == 'segment_raster' and image_path and image_path.startswith(('http://', 'https://')):
+        return jsonify({'status': 'error', 'message': 'segment_raster jobs need a local raster'}), 400
+    if not image_path or not verify_image_path(image_path):
+        return jsonify({'status': 'error', 'message': 'Invalid or missing image_path'}), 400
+
+    manager = get_job_manager()
+    if data.get('latest_wins') and data.get('session_id'):
+        # a new job of the session cancels its unfinished jobs, e.g. of realtime predictions while drawing
+        for job in manager.list():
+            if job.status in UNFINISHED and job.request.get('session_id') == data['session_id']:
+                manager.cancel(job.job_id)
+
+    try:
+        job = manager.submit(job_type, data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify(job.to_dict()), 202
+
+
+def list_jobs():
+    """List all jobs"""
+    return jsonify({'jobs': [job.to_dict() for job in get_job_manager().list()]}), 200
+
+
+def get_job(job_id):
+    """Get the status, progress and outputs of a job"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Job {job_id} not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+
+def cancel_job(job_id):
+    """Cancel a job, the outputs written so far are kept"""
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Job {job_id} not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@framework_response
+def get_job_result(job_id):
+    """Get the result of a completed predict job, in the media type negotiated like /predict"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Job {job_id} not found, its result may have expired'}), 404
+    if job.status != COMPLETED:
+        message = f'Job {job_id} is {job.status}' + (f': {job.error}' if job.error else '')
+        return jsonify({'status': 'error', 'message': message}), 409
+    if 'result' not in job.outputs or not os.path.exists(job.outputs['result']):
+        return jsonify({'status': 'error', 'message': f'Job {job_id} has no result, see its outputs'}), 404
+
+    with open(job.outputs['result']) as f:
+        result = json.load(f)
+    return result_response(result, negotiate(request.accept_mimetypes))
@@ -0,0 +1,47 @@
+"""Controller of the metrics of the server process in the Prometheus text format, see easyearth.core.metrics."""
+from flask import make_response
+
+from easyearth.controllers.jobs_controller import get_job_manager
+from easyearth.controllers.sessions_controller import get_decoder_batcher, get_session_manager
+from easyearth.core.admission import get_admission
+from easyearth.core.cancellation import get_cancellation
+from easyearth.core.jobs import QUEUED, RUNNING
+from easyearth.core.metrics import render_gauge, render_metrics
+from easyearth.models.registry import loaded_models
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def server_gauges():
+    """Gauges of the state of the server: loaded models, queue depths, open sessions and rejected requests"""
+    admission = get_admission().stats()
+    manager = get_job_manager()
+    with manager.lock:
+        jobs = [manager.jobs[job_id].status for job_id in manager.owned if job_id in manager.jobs]
+    batcher = get_decoder_batcher()
+    with batcher.condition:
+        pending = sum(len(items) for items in batcher.pending.values())
+
+    return [
+        render_gauge('easyearth_loaded_models', 'Models loaded in this process',
+                     [({'model_class': model_class, 'model_path': model_path}, 1)
+                      for model_class, model_path in loaded_models()]),
+        render_gauge('easyearth_predictions', 'Running and queued /predict requests, see GET /requests',
+                     [({'state': 'running'}, admission['running']), ({'state': 'queued'}, admission['queued'])]),
+        render_gauge('easyearth_prediction_memory_bytes', 'Estimated memory of the running /predict requests',
+                     [({}, admission['memory_mb'] * 1024 * 1024)]),
+        render_gauge('easyearth_prediction_rejections_total', 'Rejected /predict requests by reason',
+                     [({'reason': reason}, count) for reason, count in sorted(admission['rejected'].items())],
+                     'counter'),
+        render_gauge('easyearth_jobs', 'Background jobs of this process by status',
+                     [({'status': status}, jobs.count(status)) for status in (QUEUED, RUNNING)]),
+        render_gauge('easyearth_sessions', 'Open sessions', [({}, len(get_session_manager().list()))]),
+        render_gauge('easyearth_decoder_pending', 'Objects of sessions waiting to be decoded in a batch', [({}, pending)]),
+        render_gauge('easyearth_cancellable_requests', 'Running requests with a request_id',
+                     [({}, get_cancellation().stats()['running'])]),
+    ]
+
+
+def metrics():
+    """Latency histograms of the requests and their stages, cache lookups and the state of the server"""
+    return make_response(render_metrics(server_gauges()), 200, {'Content-Type': CONTENT_TYPE})
@@ -1,16 +1,34 @@
-from flask import request, jsonify
+from flask import Response, current_app, request, jsonify, make_response
 import numpy as np
 import rasterio
+from rasterio.enums import MaskFlags
 import torch
 
 from easyearth.models.langsam import SamText
-from easyearth.models.sam import Sam
+from easyearth.models.sam import Sam, count_objects
 from easyearth.models.easy_sam2 import SAM2
-from easyearth.models.segmentation import Segmentation
+from easyearth.models.segmentation import POST_PROCESSING, Segmentation
+from easyearth.models.registry import get_model
+from easyearth.core.admission import Overloaded, estimate_memory, get_admission
+from easyearth.core.archive import archive_enabled, get_archive
+from easyearth.core.automatic import segment_everything
+from easyearth.core.cancellation import RequestCancelled, check_cancelled, get_cancellation
+from easyearth.core.encoding import ENCODERS, JSON, STREAM_TYPES, decode_prompt_arrays, encode_event, negotiate
+from easyearth.core.metrics import cache_lookup, stage, timed
+from easyearth.core.georeference import boxes_to_pixels, is_pixel_crs, prompts_to_pixels, reproject_features
+from easyearth.core.pipeline import overlap, vectorize_windows, with_fallback
+from easyearth.core.tiling import TileFilter, merge_windows, read_valid, read_window
 from PIL import Image
+from pyproj import CRS
+from pyproj.exceptions import CRSError
 import requests
+import functools
 import os
 import json
+import queue
+import tempfile
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
@@ -42,65 +60,6 @@ def verify_model_path(model_path):
     raise NotImplementedError("Model path verification is not implemented yet.")
 
 
-# TODO: add this to the predict function
-def reproject_prompts(prompts, transform, image_shape):
-    """
-    Transform all types of prompts from map coordinates to pixel coordinates
-
-    Args:
-        prompts (list): List of prompt dictionaries
-        transform (affine.Affine): Rasterio transform object
-        image_shape (tuple): Image dimensions (height, width)
-    """
-
-    height, width = image_shape[:2]
-
-    def clip_coordinates(x, y):
-        """Clip coordinates to image boundaries"""
-        x = max(0, min(int(x), width - 1))
-        y = max(0, min(int(y), height - 1))
-        return x, y
-
-    input_points = prompts.get('points', [])
-    input_labels = prompts.get('labels', [])
-    input_boxes = prompts.get('boxes', [])
-    input_text = prompts.get('text', [])
-
-    transformed = {
-        'points': [],
-        'labels': [],
-        'boxes': [],
-        'text': []
-    }
-
-    if input_points:
-        for point in input_points:
-            px, py = ~transform * (point[0], point[1])
-            px, py = clip_coordinates(px, py)
-            transformed['points'].append([px, py])
-
-        transformed['labels'].extend(input_labels)
-
-    if input_boxes:
-        for box in input_boxes:
-            x1, y1 = ~transform * (box[0], box[1])
-            x2, y2 = ~transform * (box[2], box[3])
-
-            x1, y1 = clip_coordinates(x1, y1)
-            x2, y2 = clip_coordinates(x2, y2)
-
-            transformed['boxes'].append([
-                min(x1, x2),
-                min(y1, y2),
-                max(x1, x2),
-                max(y1, y2)
-            ])
-
-    if input_text:
-        transformed['text'].extend(input_text)
-
-    return transformed
-
 def reorganize_prompts(prompts):
     """
     Reorganize prompts into a unified format for processing.
@@ -144,85 +103,348 @@ def reorganize_prompts(prompts):
             
     return transformed_prompts
 
-# --- Unified predict endpoint ---
-
-def predict():
-    logger.debug("Starting unified prediction")
-
-    try:
-        data = request.get_json()
-        model_type = data.get('model_type', 'sam')  # 'sam' or 'segment'
-        image_path = data.get('image_path')
-        model_path = data.get('model_path')
-        TEMP_DIR = os.path.join(os.environ['BASE_DIR'], 'tmp')
-        EMBEDDINGS_DIR = os.path.join(os.environ['BASE_DIR'], 'embeddings')
-
-        if not image_path or not verify_image_path(image_path):
-            return jsonify({'status': 'error', 'message': 'Invalid or missing image_path'}), 400
-
-        # Load image
+@stage('prompts')
+def get_prompts(data, img_transform=None, image_shape=None, image_crs=None):
+    """Get the prompts of a request in the format of reorganize_prompts, from the binary 'prompt_arrays' if given.
+    Prompts in map coordinates of 'prompt_crs' are converted to pixels of the image with img_transform."""
+    if data.get('prompt_arrays'):
+        prompts = decode_prompt_arrays(data['prompt_arrays'])
+    else:
+        prompts = reorganize_prompts(data.get('prompts', []))
+    if is_pixel_crs(data.get('prompt_crs')):
+        return prompts
+    return prompts_to_pixels(prompts, img_transform, image_shape, data['prompt_crs'], image_crs)
+
+def check_georeference(data, source_crs):
+    """Error message if the 'prompt_crs' or 'output_crs' of a request cannot be used with its image, else None"""
+    crs_options = {key: data[key] for key in ('prompt_crs', 'output_crs') if not is_pixel_crs(data.get(key))}
+    if crs_options and source_crs is None:
+        return f"{' and '.join(crs_options)} need a georeferenced image"
+    for key, crs in crs_options.items():
         try:
-            if image_path.startswith(('http://', 'https://')):
-                response = requests.get(image_path, stream=True)
-                response.raise_for_status()
-                image = Image.open(response.raw).convert('RGB')
-                image_array = np.array(image)
-                transform = None
-                source_crs = None
-            else:
-                try:
-                    with rasterio.open(image_path) as src:
-                        transform = src.transform
-                        source_crs = src.crs.to_string() if src.crs else None
-                        image_array = src.read()
-                        image_array = np.transpose(image_array, (1, 2, 0))
-                except rasterio.errors.RasterioIOError:
-                    image = Image.open(image_path).convert('RGB')
-                    image_array = np.array(image)
-                    transform = None
-                    source_crs = None
-            if len(image_array.shape) == 2:
-                image_array = np.stack([image_array] * 3, axis=-1)
-            elif image_array.shape[2] > 3:
-                image_array = image_array[:, :, :3]
-        except Exception as e:
-            logger.error("Error loading image", exc_info=True)
-            return jsonify({'status': 'error', 'message': f'Failed to load image: {str(e)}'}), 500
-
-        original_height, original_width = image_array.shape[:2]
-
-        # --- LangSam branch ---
-        if model_type == 'langsam':
-            prompts = data.get('prompts', [])
-            transformed_prompts = reorganize_prompts(prompts)
-            input_text = transformed_prompts.get('text')
-            # get one dimensional list of text prompts
-            if len(input_text) > 0 and isinstance(input_text[0], list):
-                input_text = [text for sublist in input_text for text in sublist]
+            CRS.from_user_input(crs)
+        except CRSError as e:
+            return f'Invalid {key}: {str(e)}'
+    return None
+
+@stage('reproject')
+def georeference_features(data, geojson, source_crs):
+    """Reproject the features of a prediction to the 'output_crs' of the request
+    Returns:
+        geojson, crs of the features
+    """
+    if is_pixel_crs(data.get('output_crs')):
+        return geojson, source_crs
+    return reproject_features(geojson, source_crs, data['output_crs']), data['output_crs']
+
+@stage('serialize')
+def prediction_response(geojson, source_crs, media_type=JSON, tiling=None):
+    """Build the response of a prediction in the negotiated media type, JSON responses with the report of the tiled
+    inference if given"""
+    if media_type == JSON:
+        return jsonify({'status': 'success', 'features': geojson, 'crs': source_crs,
+                        **({'tiling': tiling} if tiling else {})}), 200
+    try:
+        body = ENCODERS[media_type](geojson, source_crs)
+    except ImportError as e:
+        return jsonify({'status': 'error', 'message': f'{media_type} is not available on this server: {str(e)}'}), 406
+    return make_response(body, 200, {'Content-Type': media_type})
 
-            # Initialize LangSam
-            logger.info("Initializing LangSam model")
-            langsam = SamText(model_path or 'ultralytics/sam2.1_s')
+def stream_features(data, stream, parts, source_crs, total, unit):
+    """Send the features of every part of a prediction as soon as it is computed, each followed by the progress
+    Args:
+        data: Request body
+        stream: Callback receiving the events, see run_prediction
+        parts: Iterator of (number of finished units, GeoJSON features in the CRS of the image)
+        source_crs: CRS of the image
+        total: Total number of units
+        unit: Unit of the progress, e.g. 'objects' or 'rows'
+    Returns:
+        All features in the output CRS
+    """
+    geojson = []
+    for done, features in parts:
+        features, _ = georeference_features(data, features, source_crs)
+        if features:
+            stream({'type': 'features', 'features': features})
+        stream({'type': 'progress', 'done': done, 'total': total, 'unit': unit})
+        geojson.extend(features)
+    return geojson
+
+@stage('serialize')
+def mask_response(encoded, source_crs):
+    """Build the response of a prediction returned as encoded masks instead of polygons"""
+    return jsonify({'status': 'success', 'crs': source_crs, **encoded}), 200
+
+def read_valid_mask(src):
+    """Valid data mask of a raster, or None if it has no nodata value or mask"""
+    if src.nodata is None and all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+        return None
+    valid_mask = src.dataset_mask() > 0
+    return None if valid_mask.all() else valid_mask
+
+@stage('load_image')
+def load_image(image_path):
+    """Read the image of a request from a URL, a raster or another image file as an RGB array (height, width, 3)
+    Returns:
+        image_array, transform, source_crs, valid_mask, where transform, source_crs and valid_mask are None for images
+        that are not rasters
+    """
+    if image_path.startswith(('http://', 'https://')):
+        response = requests.get(image_path, stream=True)
+        response.raise_for_status()
+        return np.array(Image.open(response.raw).convert('RGB')), None, None, None
+    try:
+        with rasterio.open(image_path) as src:
+            transform = src.transform
+            source_crs = src.crs.to_string() if src.crs else None
+            valid_mask = read_valid_mask(src)
+            image_array = np.transpose(src.read(), (1, 2, 0))
+    except rasterio.errors.RasterioIOError:
+        return np.array(Image.open(image_path).convert('RGB')), None, None, None
+    if image_array.shape[2] == 1:
+        image_array = np.concatenate([image_array] * 3, axis=-1)
+    elif image_array.shape[2] > 3:
+        image_array = image_array[:, :, :3]
+    return image_array, transform, source_crs, valid_mask
+
+@stage('load_embeddings')
+def load_image_embeddings(embedding_path, image_shape, device):
+    """Load image embeddings saved by save_image_embeddings, or None if they are missing or of another image size"""
+    try:
+        logger.debug(f"Loading image embeddings from: {embedding_path}")
+        embedding_data = torch.load(embedding_path)
+    except Exception as e:
+        logger.warning(f"Failed to load image embeddings: {str(e)}")
+        return None
+    # handle different formats of embedding data
+    if not isinstance(embedding_data, dict):
+        return embedding_data.to(device)
+    if tuple(embedding_data.get('image_shape', ())) == tuple(image_shape[:2]):
+        return embedding_data['embeddings'].to(device)
+    logger.warning("Unexpected format in embedding data, using SAM to generate embeddings")
+    return None
+
+@stage('save_embeddings')
+def save_image_embeddings(embedding_path, image_embeddings, image_shape):
+    """Save image embeddings with the size of the image they belong to"""
+    os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
+    embedding_data = {
+        'embeddings': image_embeddings.cpu(),
+        'image_shape': tuple(image_shape[:2]),
+        'timestamp': datetime.now().isoformat()
+    }
+    logger.debug(f"Saving image embeddings to: {embedding_path}")
+    torch.save(embedding_data, embedding_path)
+
+def mask_nodata(masks, valid_mask):
+    """Give the background label to nodata pixels of a label map, so they are never vectorized"""
+    if valid_mask is None:
+        return masks
+    labels = masks[0]
+    if isinstance(labels, torch.Tensor):
+        labels[..., ~torch.from_numpy(valid_mask)] = 0
+    else:
+        labels[..., ~valid_mask] = 0
+    return [labels]
+
+def get_aois(data):
+    """Pixel boxes (x_min, y_min, x_max, y_max) of the areas of interest of a request, from 'aois' and 'aoi'"""
+    aois = list(data.get('aois') or [])
+    if data.get('aoi'):
+        aois.append(data['aoi'])
+    return [aoi['coordinates'] if isinstance(aoi, dict) else aoi for aoi in aois]
+
+def read_windows(image_path, image_array, windows):
+    """Read windows of the image of a request, from the raster on disk if it was not loaded, with their valid data
+    masks (None where every pixel is valid)"""
+    if image_array is not None:
+        return [read_window(image_array, window) for window in windows], [None] * len(windows)
+    with rasterio.open(image_path) as src:
+        return [read_window(src, window) for window in windows], [read_valid(src, window) for window in windows]
+
+@contextmanager
+def image_source(image_path, image_array):
+    """The loaded image of a request, or else its raster on disk opened to be read window by window"""
+    if image_array is not None:
+        yield image_array
+        return
+    with rasterio.open(image_path) as src:
+        yield src
+
+def clip_to_areas(labels, window, members, valid=None):
+    """Give the background label to the pixels of a merged window outside its areas of interest, or nodata"""
+    inside = np.zeros(labels.shape, dtype=bool)
+    for member in members:
+        inside[member.row_off - window.row_off:member.row_off - window.row_off + member.height,
+               member.col_off - window.col_off:member.col_off - window.col_off + member.width] = True
+    if valid is not None:
+        inside &= valid
+    labels[~inside] = 0
+    return labels
+
+def encode_windows(model, windows, label_maps, image_shape, img_transform, encoding):
+    """Encode the label maps of windows of an image like raster_to_rle, with bounding boxes in pixels of the image"""
+    encoded = model.encoded_masks(encoding, image_shape, img_transform, [])
+    for window, labels in zip(windows, label_maps):
+        for mask in model.raster_to_rle([labels], None, encoding)['masks']:
+            x_min, y_min, x_max, y_max = mask['bbox']
+            mask['bbox'] = [x_min + window.col_off, y_min + window.row_off, x_max + window.col_off, y_max + window.row_off]
+            encoded['masks'].append(mask)
+    return encoded
+
+# options of get_automatic_options for the tiling, the others are passed to the mask generation of the model
+AUTOMATIC_TILING = ('tile_size', 'overlap', 'iou_threshold', 'min_area')
+
+def get_automatic_options(data, prompts):
+    """Options of automatic mask generation, for requests asking for it or without point and box prompts, else None"""
+    options = data.get('automatic')
+    if options is False or (options is None and (len(prompts['points']) > 0 or len(prompts['boxes']) > 0)):
+        return None
+    options = dict(options) if isinstance(options, dict) else {}
+    options.setdefault('tile_size', 1024)
+    return options
+
+def framework_response(func):
+    """Turn (response, status) tuples into flask responses, so connexion does not have to infer the content type of
+    endpoints that produce several media types"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return make_response(func(*args, **kwargs))
+    return wrapper
 
-            # Get masks from LangSam
-            masks_path, _ = langsam.get_masks(image_path, input_text=input_text)
+# --- Unified predict endpoint ---
 
-            if masks_path is None or len(masks_path) == 0:
-                return jsonify({'status': 'error', 'message': 'No valid masks generated'}), 400
+class PredictionError(Exception):
+    """Error of a prediction request, with the HTTP status of the response"""
 
-            # Convert masks to GeoJSON
-            geojson_path = f"{TEMP_DIR}/predict-langsam_{os.path.basename(image_path)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
-            geojson = langsam.raster_to_vector(masks_path[0], input_text[0], filename=geojson_path, img_transform=transform)
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
 
-        # --- SAM2 branch ---
-        elif model_type == 'sam2' and model_path.startswith('ultralytics/sam2'):
-            prompts = data.get('prompts', [])
-            transformed_prompts = reorganize_prompts(prompts)
+def mask_result(encoded, source_crs, tiling=None):
+    """Result of a prediction returned as encoded masks instead of polygons, with the report of the tiled inference
+    if given"""
+    return {'crs': source_crs, **encoded, **({'tiling': tiling} if tiling else {})}
 
-            # Initialize SAM2
-            logger.debug("Initializing SAM2 model")
-            sam2 = SAM2(model_path or 'ultralytics/sam2.1_b')
+def result_response(result, media_type=JSON):
+    """Build the response of a result of run_prediction in the negotiated media type, masks are always JSON"""
+    if 'features' in result:
+        return prediction_response(result['features'], result['crs'], media_type, result.get('tiling'))
+    with stage('serialize'):
+        return jsonify({'status': 'success', **result}), 200
 
+def run_prediction(data, stream=None):
+    """Run a prediction request, outside of a flask request so it can also run as a background job
+    Args:
+        data: Request body
+        stream: Optional callback receiving the events of a streamed response: 'start' with the output CRS, then
+            'features' as they are computed, with 'progress' events where the prediction runs in parts (chunks of
+            prompts or strips of tiles). The streamed features have no empty fallback feature.
+    Returns:
+        {'features': [...], 'crs': ...} for polygons, or {'crs': ..., **encoded} for masks, see mask_result, both with
+        'tiling', the report of the skipped tiles and the utilization of sliding_window inference, or of the compute
+        saved by coarse_to_fine
+    Raises:
+        PredictionError for invalid requests or failures, with the HTTP status of the response
+    """
+    model_type = data.get('model_type', 'sam')  # 'sam' or 'segment'
+    image_path = data.get('image_path')
+    model_path = data.get('model_path')
+    output_format = data.get('output_format', 'geojson')  # 'geojson', 'rle' or 'bitmask'
+    aois = get_aois(data) if model_type == 'segment' else []
+    # report of the tiled inference, e.g. the skipped tiles, returned with the result
+    tiling_report = {}
+    EMBEDDINGS_DIR = os.path.join(os.environ['BASE_DIR'], 'embeddings')
+
+    # null passes the schema, and the requests of background jobs are not validated against it
+    post_processing = data.get('post_processing') or 'tiled'
+    if model_type == 'segment' and post_processing not in POST_PROCESSING:
+        raise PredictionError(f"Unknown post_processing: {post_processing}. Available: {', '.join(POST_PROCESSING)}", 400)
+
+    if not image_path or not verify_image_path(image_path):
+        raise PredictionError('Invalid or missing image_path', 400)
+
+    # Load image
+    try:
+        image_array, image_shape = None, None
+        windowed = bool(aois) or (model_type == 'segment' and bool(data.get('sliding_window'))) or \
+            (model_type in ('sam', 'sam2') and data.get('automatic') is not False)
+        if windowed and not image_path.startswith(('http://', 'https://')):
+            try:
+                with rasterio.open(image_path) as src:
+                    # only the windows of the areas of interest, of the sliding window or of the tiles of automatic
+                    # mask generation are read, the segmentation branch also gives nodata pixels the background
+                    # label, and the SAM branches load the whole image if they need it after all
+                    transform = src.transform
+                    source_crs = src.crs.to_string() if src.crs else None
+                    valid_mask, image_shape = None, (src.height, src.width)
+            except rasterio.errors.RasterioIOError:
+                pass
+        if image_shape is None:
+            image_array, transform, source_crs, valid_mask = load_image(image_path)
+            image_shape = image_array.shape[:2]
+    except Exception as e:
+        logger.error("Error loading image", exc_info=True)
+        raise PredictionError(f'Failed to load image: {str(e)}', 500)
+
+    original_height, original_width = image_shape
+
+    # Prompts and areas of interest may be in map coordinates, the features may be returned in another CRS
+    georeference_error = check_georeference(data, source_crs)
+    if georeference_error:
+        raise PredictionError(georeference_error, 400)
+    if aois and not is_pixel_crs(data.get('prompt_crs')):
+        aois = boxes_to_pixels(aois, transform, image_shape, data['prompt_crs'], source_crs).tolist()
+    streamed = False
+    if stream is not None:
+        stream({'type': 'start', 'crs': source_crs if is_pixel_crs(data.get('output_crs')) else data['output_crs']})
+
+    # --- LangSam branch ---
+    if model_type == 'langsam':
+        prompts = data.get('prompts', [])
+        transformed_prompts = reorganize_prompts(prompts)
+        input_text = transformed_prompts.get('text')
+        # get one dimensional list of text prompts
+        if len(input_text) > 0 and isinstance(input_text[0], list):
+            input_text = [text for sublist in input_text for text in sublist]
+
+        # Initialize LangSam
+        logger.info("Initializing LangSam model")
+        langsam = get_model(SamText, model_path or 'ultralytics/sam2.1_s')
+
+        # Get masks from LangSam
+        masks_path, _ = langsam.get_masks(image_path, input_text=input_text)
+
+        if masks_path is None or len(masks_path) == 0:
+            raise PredictionError('No valid masks generated', 400)
+
+        if output_format != 'geojson':
+            return mask_result(langsam.raster_to_rle(masks_path[0], transform, output_format), source_crs)
+
+        # Convert masks to GeoJSON
+        with stage('vectorize'):
+            geojson = langsam.raster_to_vector(masks_path[0], input_text[0], filename=None, img_transform=transform)
+
+    # --- SAM2 branch ---
+    elif model_type == 'sam2' and model_path.startswith('ultralytics/sam2'):
+        transformed_prompts = get_prompts(data, transform, image_shape, source_crs)
+
+        # Initialize SAM2
+        logger.debug("Initializing SAM2 model")
+        sam2 = get_model(SAM2, model_path or 'ultralytics/sam2.1_b')
+
+        automatic = get_automatic_options(data, transformed_prompts)
+        if automatic is not None:
+            if output_format != 'geojson':
+                raise PredictionError('Automatic mask generation only returns polygons', 400)
+            # Segment everything without prompts, tile by tile
+            with image_source(image_path, image_array) as source:
+                geojson = segment_everything(source, sam2.generate_masks, img_transform=transform,
+                                             **{key: automatic[key] for key in AUTOMATIC_TILING if key in automatic})
+        else:
+            if image_array is None:
+                image_array = load_image(image_path)[0]
             # Get masks from SAM2
             masks = sam2.get_masks(
                 image_array,
@@ -232,78 +454,107 @@ def predict():
             )
 
             if masks is None:
-                return jsonify({'status': 'error', 'message': 'No valid masks generated'}), 400
+                raise PredictionError('No valid masks generated', 400)
+
+            if output_format != 'geojson':
+                return mask_result(sam2.raster_to_rle(masks, transform, output_format), source_crs)
 
             # Convert masks to GeoJSON
-            geojson_path = f"{TEMP_DIR}/predict-sam2_{os.path.basename(image_path)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
-            geojson = sam2.raster_to_vector(masks, transform, filename=geojson_path)
+            with stage('vectorize'):
+                geojson = sam2.raster_to_vector(masks, transform)
 
-        # --- SAM branch ---
-        elif model_type == 'sam' and model_path.startswith('facebook/sam-'):
-            prompts = data.get('prompts', [])
-            transformed_prompts = reorganize_prompts(prompts)
+    # --- SAM branch ---
+    elif model_type == 'sam' and model_path.startswith('facebook/sam-'):
+        transformed_prompts = get_prompts(data, transform, image_shape, source_crs)
 
-            # Handle embeddings
-            embedding_path = data.get('embedding_path', None)
-            save_embeddings = data.get('save_embeddings', False)
+        # Handle embeddings
+        embedding_path = data.get('embedding_path', None)
+        save_embeddings = data.get('save_embeddings', False)
 
-            # Initialize SAM
-            logger.debug("Initializing SAM model")
-            sam = Sam(model_path or 'facebook/sam-vit-base')
+        # Initialize SAM
+        logger.debug("Initializing SAM model")
+        sam = get_model(Sam, model_path or 'facebook/sam-vit-base')
 
-            image_embeddings = None
+        image_embeddings = None
+        automatic = get_automatic_options(data, transformed_prompts)
+        single_tile = automatic is None or max(image_shape) <= automatic['tile_size']
+        if image_array is None and single_tile:
+            image_array = load_image(image_path)[0]
 
-            if embedding_path and os.path.exists(embedding_path) and not save_embeddings:
-                try:
-                    logger.debug(f"Loading image embeddings from: {embedding_path}")
-                    embedding_data = torch.load(embedding_path)
-
-                    # handle different formats of embedding data
-                    if isinstance(embedding_data, dict):
-                        if embedding_data.get('image_shape') == image_array.shape[:2]:
-                            image_embeddings = embedding_data['embeddings'].to(sam.device)
-                            used_cache = True
-                        else:
-                            logger.warning("Unexpected format in embedding data, using SAM to generate embeddings")
-                    else:
-                        image_embeddings = embedding_data.to(sam.device)
-                        used_cache = True
+        if embedding_path and os.path.exists(embedding_path) and not save_embeddings:
+            image_embeddings = load_image_embeddings(embedding_path, image_shape, sam.device)
+            cache_lookup('embeddings', image_embeddings is not None)
 
-                except Exception as e:
-                    image_embeddings = None
+        elif not single_tile:
+            # the tiles of an image larger than one tile are embedded one by one
+            image_embeddings = None
 
-            # Generate embeddings if not loaded from cache
-            else:
-                logger.debug("Generating image embeddings without caching.")
+        # Generate embeddings if not loaded from cache
+        else:
+            logger.debug("Generating image embeddings without caching.")
+            if embedding_path and not save_embeddings:
+                cache_lookup('embeddings', False)
+            with stage('embed'):
                 image_embeddings = sam.get_image_embeddings(image_array)
 
-                # generate an index file to relate image to the embeddings
-                index_path = os.path.join(EMBEDDINGS_DIR, 'index.json')
+            # generate an index file to relate image to the embeddings
+            index_path = os.path.join(EMBEDDINGS_DIR, 'index.json')
 
-                if os.path.exists(index_path):
-                    with open(index_path, 'r') as f:
-                        index = json.load(f)
-                else:
-                    index = {}
-                # add the embedding path to the index
-                index[image_path] = embedding_path
-                with open(index_path, 'w') as f:
-                    json.dump(index, f)
-
-                if save_embeddings and embedding_path:
-                    try:
-                        os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
-                        embedding_data = {
-                            'embeddings': image_embeddings.cpu(),
-                            'image_shape': image_array.shape[:2],
-                            'timestamp': datetime.now().isoformat()
-                        }
-                        logger.debug(f"Saving image embeddings to: {embedding_path}")
-                        torch.save(embedding_data, embedding_path)
-                    except Exception as e:
-                        logger.error(f"Failed to save image embeddings: {str(e)}")
-                        return jsonify({'status': 'error', 'message': f'Failed to save image embeddings: {str(e)}'}), 500
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            else:
+                index = {}
+            # add the embedding path to the index
+            index[image_path] = embedding_path
+            with stage('save_embeddings'), open(index_path, 'w') as f:
+                json.dump(index, f)
 
+            if save_embeddings and embedding_path:
+                try:
+                    save_image_embeddings(embedding_path, image_embeddings, image_array.shape)
+                except Exception as e:
+                    logger.error(f"Failed to save image embeddings: {str(e)}")
+                    raise PredictionError(f'Failed to save image embeddings: {str(e)}', 500)
+
+        chunking = {key: data[key] for key in ('points_per_batch', 'boxes_per_batch') if data.get(key)}
+        if automatic is not None:
+            if output_format != 'geojson':
+                raise PredictionError('Automatic mask generation only returns polygons', 400)
+            # Segment everything from a grid of points, decoded in batches against the embedding of every tile
+            generate = functools.partial(
+                sam.generate_masks,
+                image_embeddings=image_embeddings if single_tile else None,
+                **{key: value for key, value in automatic.items() if key not in AUTOMATIC_TILING},
+            )
+            with image_source(image_path, image_array) as source:
+                geojson = segment_everything(source, generate, img_transform=transform,
+                                             **{key: automatic[key] for key in AUTOMATIC_TILING if key in automatic})
+        elif chunking:
+            # Many prompts are decoded chunk by chunk against the shared embedding
+            chunks = sam.get_masks_chunked(
+                image_array,
+                image_embeddings=image_embeddings,
+                input_points=transformed_prompts['points'] if len(transformed_prompts['points']) > 0 else None,
+                input_labels=transformed_prompts['labels'] if len(transformed_prompts['labels']) > 0 else None,
+                input_boxes=transformed_prompts['boxes'] if len(transformed_prompts['boxes']) > 0 else None,
+                **chunking,
+            )
+            # every chunk is encoded or polygonized on the post-processing pool while the next one is decoded
+            if output_format != 'geojson':
+                encoded = overlap(chunks, lambda chunk: sam.best_masks_to_rle(chunk[1], chunk[0], output_format))
+                return mask_result(sam.encoded_masks(output_format, image_array.shape[:2], transform,
+                                                     [mask for masks in encoded for mask in masks]), source_crs)
+            polygonized = overlap(chunks, lambda chunk: (chunk[0] + len(chunk[1]),
+                                                         sam.best_masks_to_vector(chunk[1], chunk[0], transform)))
+            if stream is not None:
+                total = count_objects(transformed_prompts['points'] if len(transformed_prompts['points']) > 0 else None,
+                                      transformed_prompts['boxes'] if len(transformed_prompts['boxes']) > 0 else None)
+                geojson = stream_features(data, stream, polygonized, source_crs, total, 'objects')
+                streamed = True
+            else:
+                geojson = with_fallback([feature for _, features in polygonized for feature in features])
+        else:
             # Get masks from SAM
             masks, scores = sam.get_masks(
                 image_array,
@@ -311,59 +562,296 @@ def predict():
                 input_points=transformed_prompts['points'] if len(transformed_prompts['points']) > 0 else None,
                 input_labels=transformed_prompts['labels'] if len(transformed_prompts['labels']) > 0 else None,
                 input_boxes=transformed_prompts['boxes'] if len(transformed_prompts['boxes']) > 0 else None,
+                best_mask_only=True,
             )
 
             if masks is None:
-                return jsonify({'status': 'error', 'message': 'No valid masks generated'}), 400
+                raise PredictionError('No valid masks generated', 400)
+
+            if output_format != 'geojson':
+                return mask_result(sam.raster_to_rle(masks, scores, transform, output_format), source_crs)
 
             # Convert masks to GeoJSON
-            geojson_path = f"{TEMP_DIR}/predict-sam_{os.path.basename(image_path)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
-            geojson = sam.raster_to_vector(masks, scores, transform, filename=geojson_path)
-
-        # --- Segmentation branch ---
-        elif model_type == 'segment':
-            # Initialize Segmentation model
-            logger.debug("Initializing Segmentation model")
-            segformer = Segmentation(model_path or 'restor/tcd-segformer-mit-b5')
-
-            aoi = data.get('aoi', None)
-            if aoi:
-                image_array = segformer.focus_on_region(image_array, aoi["coordinates"])
-
-            # Get masks from Segmentation model
-            masks = segformer.get_masks(image_array)
-
-            # If the image is cropped, we need to reproject the masks back to the original image size
-            if aoi and len(aoi) > 0 and isinstance(aoi["coordinates"], list) and len(aoi["coordinates"]) == 4:
-                if isinstance(masks, list):
-                    masks = masks[0]  # Get the first mask if multiple masks are returned
-                # Create an empty canvas the size of the original image
-                if isinstance(masks, torch.Tensor):
-                    pseudo_image = torch.zeros((original_height, original_width), dtype=masks.dtype)
-                else:
-                    pseudo_image = np.zeros((original_height, original_width), dtype=masks.dtype)
+            with stage('vectorize'):
+                geojson = sam.raster_to_vector(masks, scores, transform)
+
+    # --- Segmentation branch ---
+    elif model_type == 'segment':
+        # Initialize Segmentation model
+        logger.debug("Initializing Segmentation model")
+        segformer = get_model(Segmentation, model_path or 'restor/tcd-segformer-mit-b5')
+
+        sliding_window = data.get('sliding_window')
+        if sliding_window:
+            tiling = {
+                'tile_size': sliding_window.get('tile_size', 512),
+                'overlap': sliding_window.get('overlap', 64),
+                'batch_size': sliding_window.get('batch_size', 4),
+                'tile_filter': TileFilter.from_options(sliding_window.get('tile_filter')),
+            }
+            coarse_to_fine = sliding_window.get('coarse_to_fine')
+
+        if aois:
+            # Overlapping areas of interest are merged, every merged window is read once and predicted as one crop
+            regions = merge_windows(aois, original_height, original_width)
+            if not regions:
+                raise PredictionError('No area of interest overlaps the image', 400)
+            windows = [window for window, _ in regions]
+            crops, valid_masks = read_windows(image_path, image_array, windows)
+
+            if sliding_window and coarse_to_fine:
+                reports = [{} for _ in crops]
+                label_maps = [segformer.get_masks_adaptive(crop, tile_size=tiling['tile_size'], overlap=tiling['overlap'],
+                                                           batch_size=tiling['batch_size'], report=report,
+                                                           **coarse_to_fine)[0]
+                              for crop, report in zip(crops, reports)]
+                tiling_report = {'areas': reports}
+            elif sliding_window:
+                reports = [{} for _ in crops]
+                label_maps = [segformer.get_masks_tiled(crop, report=report, **tiling)[0]
+                              for crop, report in zip(crops, reports)]
+                tiling_report = {'areas': reports}
+            else:
+                label_maps = segformer.get_masks_batch(crops, post_processing=post_processing)
+            label_maps = [clip_to_areas(segformer.to_label_map([labels]), window, members, valid)
+                          for labels, (window, members), valid in zip(label_maps, regions, valid_masks)]
+
+            if output_format != 'geojson':
+                return mask_result(encode_windows(segformer, windows, label_maps, (original_height, original_width),
+                                                  transform, output_format), source_crs, tiling_report)
+
+            # Every crop is polygonized in its own extent
+            with stage('vectorize'):
+                geojson = vectorize_windows(windows, label_maps, transform)
+
+        elif sliding_window and output_format == 'geojson' and not coarse_to_fine:
+            # Reading, inference and polygonization run as a pipeline, local rasters are streamed window by window
+            source = image_path if image_array is None else image_array
+            if stream is not None:
+                # the features of every strip are sent as soon as it is polygonized
+                strips = segformer.stream_tiled(source, img_transform=transform, workers=sliding_window.get('workers', 2),
+                                                report=tiling_report, **tiling)
+                geojson = stream_features(data, stream, strips, source_crs, original_height, 'rows')
+                streamed = True
+            else:
+                # reading and polygonization overlap with the compute stage, so the pipeline is timed as a whole
+                with stage('tile_pipeline'):
+                    geojson = segformer.vectorize_tiled(source, img_transform=transform,
+                                                        workers=sliding_window.get('workers', 2),
+                                                        report=tiling_report, **tiling)
+        else:
+            if sliding_window:
+                # Full resolution inference tile by tile, local rasters are streamed window by window
+                source = image_path if image_array is None else np.array(image_array)
+            if sliding_window and output_format != 'geojson':
+                # the label map is written strip by strip to a temporary GeoTIFF, and encoded label by label
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    output_path = os.path.join(tmp_dir, 'labels.tif')
+                    if coarse_to_fine:
+                        segformer.get_masks_adaptive(source, tile_size=tiling['tile_size'], overlap=tiling['overlap'],
+                                                     batch_size=tiling['batch_size'], output_path=output_path,
+                                                     report=tiling_report, **coarse_to_fine)
+                    else:
+                        segformer.get_masks_tiled(source, output_path=output_path, report=tiling_report, **tiling)
+                    return mask_result(segformer.raster_file_to_rle(output_path, transform, output_format), source_crs,
+                                       tiling_report)
+            if sliding_window and coarse_to_fine:
+                # Full resolution inference only on the tiles where a coarse pass is unsure
+                masks = segformer.get_masks_adaptive(source, tile_size=tiling['tile_size'], overlap=tiling['overlap'],
+                                                     batch_size=tiling['batch_size'], report=tiling_report,
+                                                     **coarse_to_fine)
+            elif sliding_window:
+                masks = segformer.get_masks_tiled(source, report=tiling_report, **tiling)
+            elif valid_mask is not None and not valid_mask.any():
+                # nothing but nodata, no need to run the model
+                masks = [np.zeros((original_height, original_width), dtype=segformer.label_dtype)]
+            else:
+                # Get masks from Segmentation model, by default without upsampling the whole logit volume
+                masks = segformer.get_masks(image_array, post_processing=post_processing)
 
-                x_min, y_min, x_max, y_max = aoi["coordinates"]
-                pseudo_image[y_min:y_max, x_min:x_max] = masks
+            if masks is None:
+                raise PredictionError('No valid masks generated', 400)
 
-                # Wrap in a list to match expected format
-                masks = [pseudo_image]
+            # nodata pixels of the raster are never vectorized
+            masks = mask_nodata(masks, valid_mask)
 
-            if masks is None:
-                return jsonify({'status': 'error', 'message': 'No valid masks generated'}), 400
+            if output_format != 'geojson':
+                return mask_result(segformer.raster_to_rle(masks, transform, output_format), source_crs, tiling_report)
 
             # Convert masks to GeoJSON
-            geojson_path = f"{TEMP_DIR}/predict-segment_{os.path.basename(image_path)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
-            geojson = segformer.raster_to_vector(masks, transform, filename=geojson_path)
+            with stage('vectorize'):
+                geojson = segformer.raster_to_vector(masks, transform)
 
-        else:
-            return jsonify({'status': 'error', 'message': f'Unknown model_type: {model_type}'}), 400
+    else:
+        raise PredictionError(f'Unknown model_type: {model_type}', 400)
+
+    if streamed:
+        output_crs = source_crs if is_pixel_crs(data.get('output_crs')) else data['output_crs']
+    else:
+        geojson, output_crs = georeference_features(data, geojson, source_crs)
+        if stream is not None:
+            stream({'type': 'features', 'features': geojson})
+
+    # Archive the predictions off the request path, only if asked for
+    if archive_enabled(data):
+        get_archive().submit(geojson, f"predict-{model_type}_{os.path.basename(image_path)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}", crs=output_crs)
 
-        return jsonify({'status': 'success', 'features': geojson, 'crs': source_crs}), 200
+    result = {'features': geojson, 'crs': output_crs}
+    if tiling_report:
+        result['tiling'] = tiling_report
+    return result
 
+
+def request_scope(data, group=None, event=None):
+    """Register a request for cancellation by its request_id, and as the latest request of its group with latest_wins
+    Args:
+        data: Request body
+        group: Group of the request, the session_id of the body by default
+        event: Optional event cancelling the request, e.g. when the client of a streamed response disconnects
+    """
+    if group is None:
+        group = data.get('session_id')
+    return get_cancellation().scope(data.get('request_id'), group if data.get('latest_wins') else None, event)
+
+def request_memory(data):
+    """Estimated memory of a prediction request, from the header of its raster and its model type"""
+    image_path = data.get('image_path') or ''
+    if image_path.startswith(('http://', 'https://')):
+        return estimate_memory(data.get('model_type', 'sam'))
+    try:
+        with rasterio.open(image_path) as src:
+            return estimate_memory(data.get('model_type', 'sam'), src.height, src.width, src.count,
+                                   np.dtype(src.dtypes[0]).itemsize)
+    except rasterio.errors.RasterioIOError:
+        pass
+    try:
+        with Image.open(image_path) as image:
+            return estimate_memory(data.get('model_type', 'sam'), image.height, image.width, len(image.getbands()))
+    except Exception:
+        # invalid images are rejected by run_prediction
+        return estimate_memory(data.get('model_type', 'sam'))
+
+def overloaded_response(e):
+    """429 response of a request that is not admitted"""
+    logger.warning(str(e))
+    return make_response(jsonify({'status': 'error', 'message': str(e)}), 429, {'Retry-After': str(e.retry_after)})
+
+def stream_prediction(data, media_type, ticket):
+    """Stream the events of a prediction as newline delimited JSON or server-sent events, see run_prediction
+    The prediction runs in a thread and its events wait in a bounded queue until they are sent, a client that
+    disconnects cancels the prediction.
+    Events: 'start', 'features' and 'progress' as in run_prediction, 'masks' with the encoded masks of a prediction
+    returned as masks, then 'end' with the number of features, the report of sliding_window inference and the
+    timings of the stages in milliseconds, or 'cancelled' or 'error' with the message.
+    Args:
+        data: Request body
+        media_type: NDJSON or EVENT_STREAM
+        ticket: Admission of the request, reserved in the admission control
+    """
+    dumps = current_app.json.dumps
+    endpoint = f"{request.url_rule.rule} (stream)"
+    events = queue.Queue(maxsize=int(os.environ.get('STREAM_QUEUE_SIZE', 16)))
+    cancelled, disconnected = threading.Event(), threading.Event()
+
+    def put(event):
+        # wait for the client to take the previous events, but not once it is gone
+        while not disconnected.is_set():
+            try:
+                events.put(event, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def send(event):
+        check_cancelled()
+        if not put(event):
+            check_cancelled()
+
+    def produce():
+        try:
+            with timed(endpoint) as timings:
+                with request_scope(data, event=cancelled), get_admission().admit(ticket):
+                    result = run_prediction(data, stream=send)
+                tiling = {'tiling': result.pop('tiling')} if 'tiling' in result else {}
+                if 'features' in result:
+                    put({'type': 'end', 'count': len(result['features']), **tiling, 'timings': timings.to_dict()})
+                else:
+                    with stage('serialize'):
+                        put({'type': 'masks', **result})
+                    put({'type': 'end', **tiling, 'timings': timings.to_dict()})
+        except RequestCancelled as e:
+            logger.info(str(e))
+            put({'type': 'cancelled', 'message': str(e)})
+        except Overloaded as e:
+            logger.warning(str(e))
+            put({'type': 'error', 'status': 429, 'message': str(e), 'retry_after': e.retry_after})
+        except PredictionError as e:
+            put({'type': 'error', 'status': e.status, 'message': str(e)})
+        except Exception as e:
+            logger.error("Error running prediction", exc_info=True)
+            put({'type': 'error', 'status': 500, 'message': f'Server error: {str(e)}'})
+        finally:
+            put(None)
+
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            yield encode_event(event, media_type, dumps)
+
+    def close():
+        # also when the client disconnects early, the scope is cancelled before the queue stops waiting
+        cancelled.set()
+        disconnected.set()
+
+    # the prediction starts right away, so that its place in the admission queue is given up even if the response
+    # is never sent
+    threading.Thread(target=produce, name="predict-stream", daemon=True).start()
+    response = Response(generate(), 200, mimetype=media_type, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
+
+@framework_response
+def predict():
+    logger.debug("Starting unified prediction")
+
+    data = request.get_json()
+    media_type = negotiate(request.accept_mimetypes, streaming=True)
+    # requests beyond the running and queued limits are rejected before anything is loaded
+    try:
+        ticket = get_admission().reserve(request_memory(data))
+    except Overloaded as e:
+        return overloaded_response(e)
+    if media_type in STREAM_TYPES:
+        return stream_prediction(data, media_type, ticket)
+    try:
+        with request_scope(data), get_admission().admit(ticket):
+            result = run_prediction(data)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except RequestCancelled as e:
+        logger.info(str(e))
+        return jsonify({'status': 'cancelled', 'message': str(e)}), 409
+    except PredictionError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), e.status
     except Exception as e:
+        logger.error("Error running prediction", exc_info=True)
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
+    return result_response(result, media_type)
+
+def cancel_request(request_id):
+    """Cancel a running request by the request_id given by the client"""
+    if not get_cancellation().cancel(request_id):
+        return jsonify({'status': 'error', 'message': f'No running request {request_id}'}), 404
+    return jsonify({'status': 'cancelled', 'request_id': request_id}), 200
+
+def list_requests():
+    """Running and queued requests, rejected requests and cancellations"""
+    return jsonify({'admission': get_admission().stats(), 'cancellation': get_cancellation().stats()}), 200
+
 def ping():
     """Endpoint to check if the server is alive", and to check GPU availability"""
     gpu_info = {
@@ -0,0 +1,235 @@
+"""Controller for interactive sessions, which pin an image and its embedding so that every click only decodes prompts."""
+from flask import request, jsonify
+import numpy as np
+import os
+import threading
+import logging
+
+from easyearth.controllers.predict_controller import (
+    check_georeference, framework_response, georeference_features, get_prompts, load_image, load_image_embeddings,
+    mask_response, prediction_response, request_scope, save_image_embeddings, verify_image_path
+)
+from easyearth.core.batching import MicroBatcher
+from easyearth.core.cancellation import RequestCancelled, acquire, cancellable, check_cancelled
+from easyearth.core.encoding import negotiate
+from easyearth.core.pipeline import with_fallback
+from easyearth.core.sessions import Session, SessionManager
+from easyearth.models.registry import get_model
+from easyearth.models.sam import Sam, chunk_prompts
+
+logger = logging.getLogger("easyearth")
+
+_manager = None
+_batcher = None
+_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    """Get the process-wide session manager, sharing its session markers with the other workers in SESSIONS_DIR,
+    BASE_DIR/sessions by default"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionManager(idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 900)),
+                                      max_sessions=int(os.environ.get('MAX_SESSIONS', 8)),
+                                      directory=os.environ.get('SESSIONS_DIR', os.path.join(os.environ.get('BASE_DIR', '.'), 'sessions')))
+        return _manager
+
+
+def session_not_found(session_id, message=None):
+    """Response for a session this worker does not hold: 421 if another worker holds it, which only happens with
+    several EASYEARTH_WORKERS, else 404"""
+    holder = get_session_manager().holder(session_id)
+    if holder is not None:
+        return jsonify({'status': 'error', 'message': f'Session {session_id} is held by another server worker ({holder}), '
+                                                      f'sessions need a single worker: set EASYEARTH_WORKERS=1'}), 421
+    return jsonify({'status': 'error', 'message': message or f'Session {session_id} not found'}), 404
+
+
+def decode_batch(items):
+    """Decode the objects of concurrent requests on the same model and embedding, one forward pass per group of
+    objects with the same kind of prompts. The batch is not cancelled with the request that happens to run it."""
+    first = items[0]
+    groups = {}
+    for index, item in enumerate(items):
+        points, boxes, _, mask_input = item['prompt']
+        signature = (None if points is None else tuple(np.shape(points)), boxes is not None, mask_input is not None)
+        groups.setdefault(signature, []).append(index)
+
+    results = [None] * len(items)
+    with cancellable(None):
+        for indices in groups.values():
+            decoded = first['sam'].decode_objects(None, first['image_embeddings'], [items[index]['prompt'] for index in indices],
+                                                  image_sizes=first['image_sizes'])
+            for index, result in zip(indices, decoded):
+                results[index] = result
+    return results
+
+
+def get_decoder_batcher() -> MicroBatcher:
+    """Get the process-wide batcher of the objects decoded by sessions"""
+    global _batcher
+    with _manager_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(decode_batch, max_batch_size=int(os.environ.get('DECODER_MAX_BATCH', 8)),
+                                    max_wait=float(os.environ.get('DECODER_MAX_WAIT_MS', 5)) / 1000)
+        return _batcher
+
+
+def create_session():
+    """Open a session: decode the image, load the model and embed the image once"""
+    data = request.get_json()
+    image_path = data.get('image_path')
+    model_type = data.get('model_type', 'sam')
+    model_path = data.get('model_path') or 'facebook/sam-vit-base'
+    embedding_path = data.get('embedding_path')
+
+    if model_type != 'sam' or not model_path.startswith('facebook/sam-'):
+        return jsonify({'status': 'error', 'message': 'Sessions are only available for SAM models'}), 400
+    if not image_path or not verify_image_path(image_path):
+        return jsonify({'status': 'error', 'message': 'Invalid or missing image_path'}), 400
+
+    try:
+        image_array, transform, source_crs, _ = load_image(image_path)
+    except Exception as e:
+        logger.error("Error loading image", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'Failed to load image: {str(e)}'}), 500
+
+    manager = get_session_manager()
+    model_key = (model_type, model_path)
+    sam = manager.get_model(model_key, lambda: get_model(Sam, model_path))
+
+    # sessions of several users on the same image share its embedding, so their prompts are decoded in batches
+    shared = manager.find(model_key, image_path) if not data.get('save_embeddings') else None
+    if shared is not None:
+        session = manager.add(Session(model_key, sam, shared.image, image_embeddings=shared.image_embeddings,
+                                      image_sizes=shared.image_sizes, transform=shared.transform, crs=shared.crs,
+                                      request={'image_path': image_path, 'model_type': model_type, 'model_path': model_path},
+                                      cache_size=int(os.environ.get('SESSION_CACHE_SIZE', 128))))
+        logger.info(f"Opened session {session.session_id} for {image_path}, sharing the embedding of {shared.session_id}")
+        return jsonify(session.to_dict()), 201
+
+    image_embeddings = None
+    if embedding_path and os.path.exists(embedding_path) and not data.get('save_embeddings'):
+        image_embeddings = load_image_embeddings(embedding_path, image_array.shape, sam.device)
+    if image_embeddings is None:
+        image_embeddings = sam.get_image_embeddings(image_array)
+        if data.get('save_embeddings') and embedding_path:
+            try:
+                save_image_embeddings(embedding_path, image_embeddings, image_array.shape)
+            except Exception as e:
+                logger.error(f"Failed to save image embeddings: {str(e)}")
+                return jsonify({'status': 'error', 'message': f'Failed to save image embeddings: {str(e)}'}), 500
+
+    session = manager.add(Session(model_key, sam, image_array, image_embeddings=image_embeddings,
+                                  image_sizes=sam.get_image_sizes(image_array.shape), transform=transform, crs=source_crs,
+                                  request={'image_path': image_path, 'model_type': model_type, 'model_path': model_path},
+                                  cache_size=int(os.environ.get('SESSION_CACHE_SIZE', 128))))
+    logger.info(f"Opened session {session.session_id} for {image_path}")
+    return jsonify(session.to_dict()), 201
+
+
+def list_sessions():
+    """List the open sessions, with the batch sizes of their decoded objects"""
+    return jsonify({'sessions': [session.to_dict() for session in get_session_manager().list()],
+                    'batching': get_decoder_batcher().stats()}), 200
+
+
+def get_session(session_id):
+    """Get the state of a session"""
+    session = get_session_manager().get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    return jsonify(session.to_dict()), 200
+
+
+def close_session(session_id):
+    """Close a session and free its image and embedding"""
+    session = get_session_manager().close(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    return jsonify(session.to_dict()), 200
+
+
+def decode_objects(session, prompts):
+    """Decode the objects of a request, reusing the objects of the session cache whose prompts did not change and
+    refining the mask of the closest cached prompt set otherwise. The objects to decode are batched with those of
+    concurrent requests on the same embedding.
+    Returns:
+        Cache entries of the objects in the order of the prompts, with score, roi, mask and logits
+    """
+    entries, missing = [], []
+    for _, points, boxes, labels in chunk_prompts(prompts['points'] if len(prompts['points']) > 0 else None,
+                                                  prompts['boxes'] if len(prompts['boxes']) > 0 else None,
+                                                  prompts['labels'] if len(prompts['labels']) > 0 else None,
+                                                  points_per_batch=1, boxes_per_batch=1):
+        key = session.cache.key(points, labels, boxes)
+        entry = session.cache.get(key)
+        if entry is None:
+            previous = session.cache.closest(key)
+            mask_input = previous['logits'].float() if previous is not None else None
+            missing.append((len(entries), key, (points, boxes, labels, mask_input)))
+        entries.append(entry)
+
+    if missing:
+        futures = get_decoder_batcher().submit_many(
+            (id(session.model), id(session.image_embeddings)),
+            [{'sam': session.model, 'image_embeddings': session.image_embeddings, 'image_sizes': session.image_sizes,
+              'prompt': prompt} for _, _, prompt in missing])
+        for (index, key, _), future in zip(missing, futures):
+            score, roi, mask, logits = future.result()
+            entries[index] = session.cache.put(key, {'score': score, 'roi': roi, 'mask': mask, 'logits': logits.half()})
+    return entries
+
+
+@framework_response
+def add_prompts(session_id):
+    """Decode prompts against the pinned embedding of a session, the response is the same as /predict
+    Objects are decoded one by one through the cache of the session, so only the objects with new or changed prompts
+    are decoded and vectorized. Overlapping objects keep their whole masks, as with points_per_batch in /predict."""
+    session = get_session_manager().get(session_id)
+    if session is None:
+        return session_not_found(session_id, f'Session {session_id} not found, it may have been closed after being idle')
+
+    data = request.get_json()
+    output_format = data.get('output_format', 'geojson')
+    georeference_error = check_georeference(data, session.crs)
+    if georeference_error:
+        return jsonify({'status': 'error', 'message': georeference_error}), 400
+    prompts = get_prompts(data, session.transform, session.image.shape, session.crs)
+    if len(prompts['points']) == 0 and len(prompts['boxes']) == 0:
+        return jsonify({'status': 'error', 'message': 'No point or box prompts'}), 400
+
+    try:
+        sam = session.model
+        # with latest_wins, a new request of the session cancels the one it waits for
+        with request_scope(data, ('session', session_id)):
+            acquire(session.lock)
+            try:
+                entries = decode_objects(session, prompts)
+                session.prompts += 1
+                if output_format != 'geojson':
+                    encoded = [mask for obj, entry in enumerate(entries)
+                               for mask in sam.best_masks_to_rle([(entry['score'], entry['roi'], entry['mask'])], obj, output_format)]
+                    return mask_response(sam.encoded_masks(output_format, session.image.shape[:2], session.transform, encoded), session.crs)
+
+                geojson = []
+                for obj, entry in enumerate(entries):
+                    # the polygons of an object are cached with it, only the uid depends on the request
+                    if 'feature' not in entry:
+                        check_cancelled()
+                        features = sam.best_masks_to_vector([(entry['score'], entry['roi'], entry['mask'])], 0, session.transform)
+                        entry['feature'] = features[0] if features else None
+                    if entry['feature'] is not None:
+                        geojson.append({'properties': {'uid': float(obj + 1)}, 'geometry': entry['feature']['geometry']})
+            finally:
+                session.lock.release()
+    except RequestCancelled as e:
+        logger.info(str(e))
+        return jsonify({'status': 'cancelled', 'message': str(e)}), 409
+    except Exception as e:
+        logger.error("Error decoding prompts", exc_info=True)
+        return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
+
+    geojson, output_crs = georeference_features(data, with_fallback(geojson), session.crs)
+    return prediction_response(geojson, output_crs, negotiate(request.accept_mimetypes))
@@ -0,0 +1 @@
+"""Init file for easyearth.core module: serving infrastructure shared by the controllers."""
@@ -0,0 +1,214 @@
+"""Admission control of prediction requests: a bounded number of requests run at the same time within a memory
+budget, the next ones wait in a bounded queue, and the others are rejected with the time after which to retry.
+
+The memory of a request is estimated before it runs, from the size of its raster and its model type, see
+estimate_memory. A request larger than the whole budget still runs, but only when no other request is running.
+
+Running and queued requests hold a thread of the WSGI pool of the worker, so their number stays below its size and
+requests beyond it are rejected instead of waiting for a thread, see admission_limits.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from easyearth.config.serving import RESERVED_THREADS, available_memory, wsgi_threads
+from easyearth.core.cancellation import check_cancelled
+from easyearth.core.metrics import stage
+
+logger = logging.getLogger("easyearth")
+
+MB = 1024 * 1024
+
+# working memory per pixel of the image besides the image itself, e.g. masks, label maps and upsampled logits
+MODEL_PIXEL_BYTES = {'sam': 4, 'sam2': 8, 'langsam': 8, 'segment': 8}
+# working memory independent of the image size, e.g. the resized model input and the activations
+MODEL_BASE_BYTES = 256 * MB
+
+
+def estimate_memory(model_type: str, height: int = 0, width: int = 0, bands: int = 3, itemsize: int = 1) -> int:
+    """Estimated peak memory of a prediction in bytes, an upper bound for predictions reading only windows
+    Args:
+        model_type: Model type of the request
+        height: Height of the image in pixels, 0 if unknown
+        width: Width of the image in pixels, 0 if unknown
+        bands: Number of bands of the raster
+        itemsize: Bytes per value of the raster
+    """
+    pixels = height * width
+    # the raster as read, and its RGB copy as fed to the model
+    image = pixels * (bands * itemsize + 3)
+    return MODEL_BASE_BYTES + image + pixels * MODEL_PIXEL_BYTES.get(model_type, 8)
+
+
+class Overloaded(Exception):
+    """Raised for a request that is not admitted, with the seconds after which the client should retry"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Place of a request in the admission queue"""
+
+    def __init__(self, memory: int):
+        self.memory = memory
+        self.started = None
+
+
+class AdmissionControl:
+    """Running and queued requests, limited in number and memory"""
+
+    def __init__(self, max_running: int = 4, max_queued: int = 16, memory_limit: Optional[int] = None,
+                 queue_timeout: float = 60.0):
+        """Initialize the limits
+        Args:
+            max_running: Maximum number of requests running at the same time
+            max_queued: Maximum number of requests waiting to run, more are rejected
+            memory_limit: Maximum estimated memory in bytes of the running requests, None for no limit
+            queue_timeout: Seconds a request waits in the queue before it is rejected
+        """
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.memory_limit = memory_limit
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.memory = 0
+        self.queue = deque()
+        self.admitted = 0
+        self.rejected = Counter()
+        # moving average of the duration of a request, for Retry-After
+        self.duration = 1.0
+        self.condition = threading.Condition()
+
+    def _fits(self, ticket: Ticket) -> bool:
+        if self.running >= self.max_running:
+            return False
+        return self.memory_limit is None or self.running == 0 or self.memory + ticket.memory <= self.memory_limit
+
+    def _start(self, ticket: Ticket):
+        self.running += 1
+        self.memory += ticket.memory
+        self.admitted += 1
+        ticket.started = time.perf_counter()
+
+    def _reject(self, reason: str, message: str) -> Overloaded:
+        self.rejected[reason] += 1
+        return Overloaded(message, self.retry_after())
+
+    def retry_after(self) -> int:
+        """Seconds until the queued requests have probably run"""
+        return max(1, math.ceil(self.duration * (len(self.queue) + 1) / self.max_running))
+
+    def reserve(self, memory: int) -> Ticket:
+        """Start a request, or queue it
+        Args:
+            memory: Estimated memory of the request in bytes
+        Raises:
+            Overloaded if the queue is full
+        """
+        ticket = Ticket(memory)
+        with self.condition:
+            if not self.queue and self._fits(ticket):
+                self._start(ticket)
+            elif len(self.queue) >= self.max_queued:
+                raise self._reject('queue_full', f"Too many requests: {self.running} running, {len(self.queue)} queued")
+            else:
+                self.queue.append(ticket)
+        return ticket
+
+    def wait(self, ticket: Ticket, interval: float = 0.05):
+        """Wait until a queued request may run, in the order of the queue
+        Raises:
+            Overloaded if it waited longer than the queue timeout, RequestCancelled if it was cancelled meanwhile
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        with self.condition:
+            try:
+                while ticket.started is None:
+                    if self.queue[0] is ticket and self._fits(ticket):
+                        self.queue.popleft()
+                        self._start(ticket)
+                        break
+                    if time.monotonic() >= deadline:
+                        raise self._reject('timeout', f"Request waited {self.queue_timeout:g}s for its turn")
+                    check_cancelled()
+                    self.condition.wait(interval)
+            except BaseException:
+                if ticket.started is None:
+                    self.queue.remove(ticket)
+                    self.condition.notify_all()
+                raise
+
+    def release(self, ticket: Ticket):
+        """Finish a running request"""
+        with self.condition:
+            self.running -= 1
+            self.memory -= ticket.memory
+            self.duration = 0.8 * self.duration + 0.2 * (time.perf_counter() - ticket.started)
+            self.condition.notify_all()
+
+    @contextmanager
+    def admit(self, ticket: Ticket) -> Iterator[Ticket]:
+        """Wait for the turn of a reserved request, and finish it at the end of the context"""
+        with stage('queue'):
+            self.wait(ticket)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of running and queued requests, their estimated memory and the rejected requests by reason"""
+        with self.condition:
+            return {'running': self.running, 'queued': len(self.queue), 'max_running': self.max_running,
+                    'max_queued': self.max_queued, 'memory_mb': round(self.memory / MB),
+                    'memory_limit_mb': round(self.memory_limit / MB) if self.memory_limit is not None else None,
+                    'admitted': self.admitted, 'rejected': dict(self.rejected)}
+
+
+def admission_limits() -> Tuple[int, int]:
+    """Maximum numbers of running and of queued /predict requests of a worker, MAX_RUNNING_PREDICTIONS (4) and
+    MAX_QUEUED_PREDICTIONS (the rest of the WSGI pool by default)
+    Every running or queued request holds a thread of the WSGI pool, so together they get at most its size minus the
+    RESERVED_THREADS of the other endpoints, larger values are lowered.
+    """
+    capacity = max(1, wsgi_threads() - RESERVED_THREADS)
+    running = int(os.environ.get('MAX_RUNNING_PREDICTIONS', 4))
+    queued = int(os.environ['MAX_QUEUED_PREDICTIONS']) if os.environ.get('MAX_QUEUED_PREDICTIONS') else None
+    max_running = min(running, capacity)
+    max_queued = capacity - max_running if queued is None else min(queued, capacity - max_running)
+    if max_running < running or (queued is not None and max_queued < queued):
+        logger.warning(f"At most {max_running} running and {max_queued} queued /predict requests, "
+                       f"{RESERVED_THREADS} of the {wsgi_threads()} WSGI_THREADS are left to the other endpoints")
+    return max_running, max_queued
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission() -> AdmissionControl:
+    """Get the admission control of the /predict requests of this process
+    The limits are set with MAX_RUNNING_PREDICTIONS and MAX_QUEUED_PREDICTIONS, see admission_limits,
+    ADMISSION_TIMEOUT (60 s) and PREDICTION_MEMORY_MB, by default half of the available memory shared by the
+    EASYEARTH_WORKERS workers.
+    """
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            memory_limit = os.environ.get('PREDICTION_MEMORY_MB')
+            if memory_limit:
+                memory_limit = int(memory_limit) * MB
+            else:
+                total = available_memory()
+                memory_limit = total // 2 // int(os.environ.get('EASYEARTH_WORKERS') or 1) if total else None
+            max_running, max_queued = admission_limits()
+            _admission = AdmissionControl(max_running=max_running, max_queued=max_queued, memory_limit=memory_limit,
+                                          queue_timeout=float(os.environ.get('ADMISSION_TIMEOUT', 60)))
+        return _admission
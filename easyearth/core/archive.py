@@ -0,0 +1,105 @@
+"""Opt-in archiving of predictions to disk on a background writer thread."""
+import atexit
+import logging
+import os
+import queue
+import threading
+from typing import Dict, List, Optional
+
+import geopandas as gpd
+
+logger = logging.getLogger("easyearth")
+
+FILE_EXTENSIONS = {
+    'FlatGeobuf': '.fgb',
+    'GPKG': '.gpkg',
+    'GeoJSON': '.geojson',
+}
+
+# the spatial index of FlatGeobuf does not support empty geometries, e.g. the fallback feature of a prediction without
+# objects, see easyearth.core.encoding.encode_flatgeobuf
+LAYER_OPTIONS = {
+    'FlatGeobuf': {'SPATIAL_INDEX': 'NO'},
+}
+
+
+def archive_enabled(data: Optional[Dict] = None) -> bool:
+    """Check if the predictions of a request should be archived
+    Args:
+        data: The request body, where 'save_predictions' overrides the ARCHIVE_PREDICTIONS environment variable
+    """
+    if data is not None and data.get('save_predictions') is not None:
+        return bool(data['save_predictions'])
+    return os.environ.get('ARCHIVE_PREDICTIONS', 'false').lower() in ('1', 'true', 'yes')
+
+
+class PredictionArchive:
+    """Writes predicted features to disk on a background thread, so the request never waits for the file"""
+
+    def __init__(self, directory: str, driver: str = 'FlatGeobuf', max_queue: int = 64):
+        """Initialize the archive
+        Args:
+            directory: Directory to write the prediction files to
+            driver: OGR driver used for the files, FlatGeobuf is much faster to write than GeoJSON
+            max_queue: Maximum number of pending writes, further predictions are not archived until the queue drains
+        """
+        if driver not in FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported driver {driver}. Available: {list(FILE_EXTENSIONS.keys())}")
+        self.directory = directory
+        self.driver = driver
+        self.queue = queue.Queue(maxsize=max_queue)
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="prediction-archive", daemon=True)
+        self.thread.start()
+
+    def submit(self, features: List[Dict], name: str, crs: Optional[str] = None) -> Optional[str]:
+        """Queue features to be written
+        Args:
+            features: GeoJSON features as returned by raster_to_vector
+            name: File name without extension
+            crs: Coordinate reference system of the features
+        Returns:
+            The path the features will be written to, or None if the queue is full
+        """
+        filename = os.path.join(self.directory, f"{name}{FILE_EXTENSIONS[self.driver]}")
+        try:
+            self.queue.put_nowait((features, filename, crs))
+        except queue.Full:
+            logger.warning(f"Prediction archive queue is full, not archiving {filename}")
+            return None
+        return filename
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                features, filename, crs = item
+                gdf = gpd.GeoDataFrame.from_features(features, crs=crs)
+                gdf.to_file(filename=filename, driver=self.driver, layer_options=LAYER_OPTIONS.get(self.driver))
+                logger.debug(f"Archived {len(gdf)} features to {filename}")
+            except Exception as e:
+                logger.error(f"Failed to archive predictions: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def close(self, timeout: Optional[float] = None):
+        """Write the pending predictions and stop the writer thread"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive() -> PredictionArchive:
+    """Get the process-wide prediction archive, writing to BASE_DIR/predictions by default"""
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            directory = os.environ.get('PREDICTIONS_DIR', os.path.join(os.environ.get('BASE_DIR', '.'), 'predictions'))
+            _archive = PredictionArchive(directory, driver=os.environ.get('ARCHIVE_DRIVER', 'FlatGeobuf'))
+            atexit.register(_archive.close, 30)
+        return _archive
@@ -0,0 +1,184 @@
+"""Automatic mask generation ("segment everything") for promptable models, tile by tile on large rasters.
+
+A model prompted with a grid of points proposes masks for every object of a tile. The proposals with a low predicted
+IoU or stability score are dropped and duplicates are suppressed with a mask NMS, batch by batch of prompts. Masks cut
+by an inner tile edge are left to the neighbouring tile, and the polygons of the overlaps between tiles are
+de-duplicated with a spatial index before they are polygonized, so the result holds every object once.
+"""
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+import shapely.geometry
+import torch
+from rasterio import features
+from rasterio.transform import Affine
+
+from easyearth.core.pipeline import transform_geometries, with_fallback
+from easyearth.core.tiling import ImageSource, image_size, read_window, tile_windows
+
+logger = logging.getLogger("easyearth")
+
+# (score, roi (x_min, y_min, x_max, y_max) or None, boolean mask cropped to the roi or None), as Sam.select_best_masks
+BestMask = Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]
+GenerateMasks = Callable[[np.ndarray], List[BestMask]]
+
+
+def point_grid(points_per_side: int, height: int, width: int) -> np.ndarray:
+    """Grid of points_per_side x points_per_side points at the centers of the cells of an image
+    Returns:
+        Points (x, y) in pixels of shape (points_per_side ** 2, 2)
+    """
+    offsets = (np.arange(points_per_side) + 0.5) / points_per_side
+    xs, ys = np.meshgrid(offsets * width, offsets * height)
+    return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+
+def stability_score(logits: torch.Tensor, mask_threshold: float = 0.0, offset: float = 1.0) -> torch.Tensor:
+    """IoU of the masks thresholded at mask_threshold + offset and mask_threshold - offset, for logits (N, H, W)"""
+    intersections = (logits > mask_threshold + offset).sum(dim=(-1, -2), dtype=torch.int32)
+    unions = (logits > mask_threshold - offset).sum(dim=(-1, -2), dtype=torch.int32)
+    return intersections / unions.clamp(min=1)
+
+
+def mask_nms(masks: torch.Tensor, scores: torch.Tensor, iou_threshold: float = 0.7) -> torch.Tensor:
+    """Suppress masks that overlap a mask with a higher score, for all pairs of masks at once
+    Like Fast NMS, a mask is also suppressed by higher scoring masks that are suppressed themselves.
+    Args:
+        masks: Boolean masks (N, H, W)
+        scores: Scores (N,)
+        iou_threshold: Masks with a higher IoU with a better mask are suppressed
+    Returns:
+        Indices of the kept masks, best first
+    """
+    if len(masks) == 0:
+        return torch.zeros(0, dtype=torch.long)
+    order = torch.argsort(scores, descending=True)
+    ious = mask_ious(masks[order], masks[order])
+    # only the masks with a higher score can suppress a mask
+    suppressed = torch.triu(ious, diagonal=1).amax(dim=0) > iou_threshold
+    return order[~suppressed]
+
+
+def mask_ious(masks: torch.Tensor, others: torch.Tensor) -> torch.Tensor:
+    """IoU of every pair of boolean masks (N, H, W) and (M, H, W), of shape (N, M)"""
+    flat, other_flat = masks.flatten(1).float(), others.flatten(1).float()
+    intersections = flat @ other_flat.T
+    areas, other_areas = flat.sum(dim=1), other_flat.sum(dim=1)
+    return intersections / (areas[:, None] + other_areas[None, :] - intersections).clamp(min=1)
+
+
+def merge_nms(kept: torch.Tensor, kept_scores: torch.Tensor, masks: torch.Tensor, scores: torch.Tensor,
+              iou_threshold: float = 0.7) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Suppress the duplicates between the masks kept so far and the kept masks of a new batch
+    Only the IoU of the pairs across the two sets is computed, so the masks are de-duplicated batch by batch without
+    an IoU matrix of all the masks.
+    Args:
+        kept: Boolean masks kept so far (N, H, W)
+        kept_scores: Their scores (N,)
+        masks: Boolean masks of the new batch, de-duplicated among themselves with mask_nms (M, H, W)
+        scores: Their scores (M,)
+        iou_threshold: Masks with a higher IoU with a better mask are suppressed
+    Returns:
+        Boolean tensors of which of the masks kept so far and of the new masks are kept
+    """
+    if len(kept) == 0 or len(masks) == 0:
+        return torch.ones(len(kept), dtype=torch.bool), torch.ones(len(masks), dtype=torch.bool)
+    duplicates = mask_ious(kept, masks) > iou_threshold
+    better = kept_scores[:, None] >= scores[None, :]
+    return ~(duplicates & ~better).any(dim=1), ~(duplicates & better).any(dim=0)
+
+
+def dedupe_masks(rois: np.ndarray, masks: List[np.ndarray], scores: np.ndarray, iou_threshold: float = 0.7) -> np.ndarray:
+    """Indices of the masks that do not overlap a mask with a higher score, best first
+    Pairs with intersecting bounding boxes are found with a spatial index, and their IoU is computed on the pixels of
+    the overlap of the boxes, so the masks are only polygonized once they are kept.
+    Args:
+        rois: Bounding boxes (x_min, y_min, x_max, y_max) of the masks in pixels of the image, of shape (N, 4)
+        masks: Boolean masks cropped to their bounding box
+        scores: Scores (N,)
+        iou_threshold: Masks with a higher IoU with a better mask are suppressed
+    """
+    order = np.argsort(-scores, kind="stable")
+    rois = rois[order]
+    masks = [masks[index] for index in order]
+    boxes = shapely.box(rois[:, 0], rois[:, 1], rois[:, 2], rois[:, 3])
+    left, right = shapely.STRtree(boxes).query(boxes, predicate="intersects")
+    pairs = left < right
+    areas = np.array([mask.sum() for mask in masks])
+    suppressed = np.zeros(len(masks), dtype=bool)
+    for i, j in zip(left[pairs], right[pairs]):
+        if suppressed[j]:
+            continue
+        x_min, y_min = np.maximum(rois[i, :2], rois[j, :2])
+        x_max, y_max = np.minimum(rois[i, 2:], rois[j, 2:])
+        if x_min >= x_max or y_min >= y_max:
+            continue
+        intersection = np.count_nonzero(
+            masks[i][y_min - rois[i, 1]:y_max - rois[i, 1], x_min - rois[i, 0]:x_max - rois[i, 0]]
+            & masks[j][y_min - rois[j, 1]:y_max - rois[j, 1], x_min - rois[j, 0]:x_max - rois[j, 0]])
+        suppressed[j] = intersection / max(areas[i] + areas[j] - intersection, 1) > iou_threshold
+    return order[~suppressed]
+
+
+def _touches_inner_edge(roi: Tuple[int, int, int, int], mask: np.ndarray, tile_shape: Tuple[int, int],
+                        inner_edges: Tuple[bool, bool, bool, bool]) -> bool:
+    """Whether a mask reaches an edge of its tile that is not an edge of the image (left, top, right, bottom)"""
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    x_min, y_min = roi[0] + cols[0], roi[1] + rows[0]
+    x_max, y_max = roi[0] + cols[-1] + 1, roi[1] + rows[-1] + 1
+    reaches = (x_min <= 0, y_min <= 0, x_max >= tile_shape[1], y_max >= tile_shape[0])
+    return any(reach and inner for reach, inner in zip(reaches, inner_edges))
+
+
+def segment_everything(image: ImageSource,
+                       generate: GenerateMasks,
+                       tile_size: int = 1024,
+                       overlap: int = 256,
+                       iou_threshold: float = 0.7,
+                       min_area: float = 0,
+                       img_transform: Optional[Affine] = None) -> List[Dict]:
+    """Generate the masks of every object of an image, tile by tile, and return de-duplicated polygons
+    Args:
+        image: Array of shape (height, width, bands) or an open rasterio dataset
+        generate: Function generating the masks of a tile, as (score, roi, mask) in pixels of the tile
+        tile_size: Size of the tiles in pixels, images up to this size are a single tile
+        overlap: Overlap between neighbouring tiles in pixels, objects up to this size are never cut
+        iou_threshold: Polygons of neighbouring tiles with a higher IoU are duplicates
+        min_area: Masks smaller than this area in pixels are dropped
+        img_transform: Optional transform for georeferencing
+    Returns:
+        List of GeoJSON features with uid and score, best first
+    """
+    height, width = image_size(image)
+    rows = tile_windows(height, width, tile_size, overlap)
+    rois, masks, scores = [], [], []
+    for window in (window for row in rows for window in row):
+        tile = read_window(image, window)
+        inner_edges = (window.col_off > 0, window.row_off > 0,
+                       window.col_off + window.width < width, window.row_off + window.height < height)
+        for score, roi, mask in generate(tile):
+            if roi is None or mask.sum() <= max(min_area, 0) or _touches_inner_edge(roi, mask, tile.shape[:2], inner_edges):
+                continue
+            rois.append((window.col_off + roi[0], window.row_off + roi[1],
+                         window.col_off + roi[0] + mask.shape[1], window.row_off + roi[1] + mask.shape[0]))
+            masks.append(mask)
+            scores.append(score)
+
+    rois, scores = np.array(rois, dtype=np.int64).reshape(-1, 4), np.array(scores, dtype=np.float64)
+    keep = dedupe_masks(rois, masks, scores, iou_threshold) if len(masks) else np.zeros(0, dtype=int)
+    logger.info(f"Segment everything: {len(keep)} objects from {len(masks)} masks in {sum(len(row) for row in rows)} tiles")
+
+    geometries = []
+    for index in keep:
+        offset = Affine.translation(rois[index, 0], rois[index, 1])
+        parts = [shapely.geometry.shape(polygon) for polygon, _ in
+                 features.shapes(masks[index].astype(np.uint8), mask=masks[index], transform=offset)]
+        geometries.append(parts[0] if len(parts) == 1 else shapely.geometry.MultiPolygon(parts))
+    geometries = np.array(geometries, dtype=object)
+    if img_transform is not None and len(geometries):
+        geometries = transform_geometries(geometries, img_transform)
+    return with_fallback([{"properties": {"uid": float(uid), "score": round(float(scores[index]), 4)},
+                           "geometry": shapely.geometry.mapping(geometry)}
+                          for uid, (index, geometry) in enumerate(zip(keep, geometries), start=1)])
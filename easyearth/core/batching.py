@@ -0,0 +1,84 @@
+"""Micro-batching of work items that arrive at about the same time, e.g. the prompts of several users decoded
+against the same image embedding.
+
+The first item submitted for a key waits up to max_wait seconds for more items of the same key, then runs all of
+them in batches of at most max_batch_size on its own thread. Items submitted meanwhile only wait for their result, so
+no scheduler thread is needed and a lone request is only delayed by max_wait.
+"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+
+class MicroBatcher:
+    """Runs the items submitted for the same key within a short time as one batch"""
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.005):
+        """Initialize the batcher
+        Args:
+            run_batch: Function computing the results of a batch of items of the same key, in the order of the items
+            max_batch_size: Maximum number of items run as one batch
+            max_wait: Seconds the first item of a key waits for more items, 0 to only batch items submitted together
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.pending: Dict[Hashable, List[Tuple[Any, Future]]] = {}
+        self.condition = threading.Condition()
+        self.histogram: Counter = Counter()
+
+    def submit(self, key: Hashable, item: Any) -> Future:
+        """Submit one item, see submit_many"""
+        return self.submit_many(key, [item])[0]
+
+    def submit_many(self, key: Hashable, items: List[Any]) -> List[Future]:
+        """Submit items of a key, which may be batched with the items of other threads
+        Returns:
+            Futures of the results of the items, already done if this call ran the batches
+        """
+        futures = [Future() for _ in items]
+        with self.condition:
+            queue = self.pending.setdefault(key, [])
+            leader = not queue
+            queue.extend(zip(items, futures))
+            if not leader:
+                if len(queue) >= self.max_batch_size:
+                    self.condition.notify_all()
+                return futures
+            # the first caller of a key collects the items of the others until the batch is full or max_wait passed
+            deadline = time.monotonic() + self.max_wait
+            while len(queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            del self.pending[key]
+
+        for start in range(0, len(queue), self.max_batch_size):
+            self._run(queue[start:start + self.max_batch_size])
+        return futures
+
+    def _run(self, batch: List[Tuple[Any, Future]]):
+        with self.condition:
+            self.histogram[len(batch)] += 1
+        try:
+            results = list(self.run_batch([item for item, _ in batch]))
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch of {len(batch)} items returned {len(results)} results")
+        except Exception as e:
+            # every caller gets the error, none waits for a result that never comes
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of batches and items, and the histogram of the batch sizes"""
+        with self.condition:
+            histogram = dict(sorted(self.histogram.items()))
+        return {'batches': sum(histogram.values()), 'items': sum(size * count for size, count in histogram.items()),
+                'max_batch_size': self.max_batch_size, 'max_wait': self.max_wait,
+                'histogram': {str(size): count for size, count in histogram.items()}}
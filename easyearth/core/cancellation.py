@@ -0,0 +1,231 @@
+"""Cancellation of running requests, by a client-supplied request id or because a newer request of the same client
+session superseded them ("latest wins"), e.g. the predictions of a realtime drawing tool.
+
+A cancelled request is not interrupted at once: the work checks check_cancelled between units of work, e.g. before
+every forward pass of a model, between chunks of prompts and batches of tiles, and while it waits for a model or a
+session. Requests waiting for their turn are then aborted before they start computing.
+
+The server workers share a directory of marker files, like the cancel markers of the background jobs, so a request
+is cancelled or superseded also from another worker than the one running it:
+    running/<request>   request with this id is running
+    cancelled/<request> request with this id was cancelled
+    groups/<group>      token of the latest request of the group, followed by ':done' once it finished
+"""
+import contextvars
+import hashlib
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterator, Optional
+
+_current: contextvars.ContextVar[Optional['CancelScope']] = contextvars.ContextVar('cancel_scope', default=None)
+
+
+class RequestCancelled(Exception):
+    """Raised by check_cancelled in a request that was cancelled"""
+
+
+def _marker(directory: str, kind: str, key: Hashable) -> str:
+    """Path of the marker file of a request id or group, named by its hash as the ids are chosen by the clients"""
+    return os.path.join(directory, kind, hashlib.sha1(str(key).encode('utf-8')).hexdigest())
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write(path: str, content: str = ''):
+    """Write a marker file atomically"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class CancelScope:
+    """Cancellation state of a request"""
+
+    def __init__(self, request_id: Optional[str] = None, group: Optional[Hashable] = None,
+                 event: Optional[threading.Event] = None, directory: Optional[str] = None):
+        """Initialize the scope
+        Args:
+            request_id: Id of the request given by the client, to cancel it
+            group: Requests of the same group supersede each other, e.g. the session id of a client
+            event: Event to set when the request is cancelled, e.g. the one of a background job
+            directory: Optional directory of the marker files shared by the server workers
+        """
+        self.request_id = request_id
+        self.group = group
+        self.event = event or threading.Event()
+        self.directory = directory
+        self.token = uuid.uuid4().hex
+
+    def _shared_cancelled(self) -> bool:
+        """Whether another worker cancelled the request, or a newer request of its group superseded it"""
+        if self.request_id is not None and os.path.exists(_marker(self.directory, 'cancelled', self.request_id)):
+            return True
+        if self.group is not None:
+            latest = _read(_marker(self.directory, 'groups', self.group))
+            return latest is not None and latest.split(':')[0] != self.token
+        return False
+
+    @property
+    def cancelled(self) -> bool:
+        if not self.event.is_set() and self.directory is not None and self._shared_cancelled():
+            self.event.set()
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+
+    def check(self):
+        """Raise RequestCancelled if the request was cancelled"""
+        if self.cancelled:
+            raise RequestCancelled(f"Request {self.request_id} was cancelled" if self.request_id else "Request was cancelled")
+
+
+class CancellationRegistry:
+    """Running requests by request id and group"""
+
+    def __init__(self, directory: Optional[str] = None):
+        """Initialize the registry
+        Args:
+            directory: Directory of the marker files shared with the other server workers, None for the requests
+                of this process only
+        """
+        self.directory = directory
+        self.requests: Dict[str, CancelScope] = {}
+        # latest request of every group
+        self.groups: Dict[Hashable, CancelScope] = {}
+        self.cancelled = 0
+        self.superseded = 0
+        self.lock = threading.Lock()
+
+    def open(self, request_id: Optional[str] = None, group: Optional[Hashable] = None,
+             event: Optional[threading.Event] = None) -> CancelScope:
+        """Register a request, cancelling the unfinished requests of its group"""
+        scope = CancelScope(request_id, group, event, self.directory)
+        with self.lock:
+            if group is not None:
+                previous = self.groups.get(group)
+                if previous is not None and not previous.cancelled:
+                    previous.cancel()
+                    self.superseded += 1
+                elif previous is None and self.directory is not None:
+                    latest = _read(_marker(self.directory, 'groups', group))
+                    if latest is not None and not latest.endswith(':done'):
+                        # the request of another worker stops at its next check
+                        self.superseded += 1
+                self.groups[group] = scope
+            if request_id is not None:
+                self.requests[request_id] = scope
+        if self.directory is not None:
+            if request_id is not None:
+                # a cancellation of an earlier request with the same id does not apply to this one
+                _remove(_marker(self.directory, 'cancelled', request_id))
+                _write(_marker(self.directory, 'running', request_id), str(os.getpid()))
+            if group is not None:
+                _write(_marker(self.directory, 'groups', group), scope.token)
+        return scope
+
+    def close(self, scope: CancelScope):
+        """Unregister a finished request"""
+        with self.lock:
+            if scope.request_id is not None and self.requests.get(scope.request_id) is scope:
+                del self.requests[scope.request_id]
+            if scope.group is not None and self.groups.get(scope.group) is scope:
+                del self.groups[scope.group]
+        if self.directory is not None:
+            if scope.request_id is not None:
+                _remove(_marker(self.directory, 'running', scope.request_id))
+                _remove(_marker(self.directory, 'cancelled', scope.request_id))
+            if scope.group is not None:
+                group_path = _marker(self.directory, 'groups', scope.group)
+                if _read(group_path) == scope.token:
+                    _write(group_path, scope.token + ':done')
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel a running request, also of another worker, False if there is no such request"""
+        with self.lock:
+            scope = self.requests.get(request_id)
+            if scope is not None and not scope.cancelled:
+                scope.cancel()
+                self.cancelled += 1
+        if self.directory is not None and os.path.exists(_marker(self.directory, 'running', request_id)):
+            _write(_marker(self.directory, 'cancelled', request_id))
+            if scope is None:
+                with self.lock:
+                    self.cancelled += 1
+            return True
+        return scope is not None
+
+    @contextmanager
+    def scope(self, request_id: Optional[str] = None, group: Optional[Hashable] = None,
+              event: Optional[threading.Event] = None) -> Iterator[CancelScope]:
+        """Register a request for the duration of the context, check_cancelled then checks it"""
+        scope = self.open(request_id, group, event)
+        try:
+            with cancellable(scope):
+                yield scope
+        finally:
+            self.close(scope)
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of running requests with an id, of cancelled and of superseded requests"""
+        with self.lock:
+            return {'running': len(self.requests), 'cancelled': self.cancelled, 'superseded': self.superseded}
+
+
+@contextmanager
+def cancellable(scope: Optional[CancelScope]) -> Iterator[Optional[CancelScope]]:
+    """Make check_cancelled check a scope within the context, None for work that must not be cancelled, e.g. a batch
+    of several requests"""
+    token = _current.set(scope)
+    try:
+        yield scope
+    finally:
+        _current.reset(token)
+
+
+def check_cancelled():
+    """Raise RequestCancelled if the request of the current context was cancelled"""
+    scope = _current.get()
+    if scope is not None:
+        scope.check()
+
+
+def acquire(lock, interval: float = 0.05):
+    """Acquire a lock or semaphore, giving up with RequestCancelled if the request is cancelled while it waits"""
+    check_cancelled()
+    if _current.get() is None:
+        lock.acquire()
+        return
+    while not lock.acquire(timeout=interval):
+        check_cancelled()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_cancellation() -> CancellationRegistry:
+    """Get the process-wide registry of the running requests, sharing its markers with the other workers in
+    REQUESTS_DIR, BASE_DIR/requests by default"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = CancellationRegistry(
+                os.environ.get('REQUESTS_DIR', os.path.join(os.environ.get('BASE_DIR', '.'), 'requests')))
+        return _registry
@@ -0,0 +1,178 @@
+"""Coarse-to-fine sliding-window segmentation.
+
+The model first runs on a decimated copy of the image (read from the overviews of a raster if it has any). Tiles of
+the full resolution image that the coarse pass finds uniform and confident keep the coarse class, only the tiles with
+class boundaries or low confidence are run again at full resolution. A sample of the confident tiles is checked at full
+resolution, and if the coarse classes disagree with it by more than the tolerance, every tile is refined.
+"""
+import logging
+import math
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from rasterio.enums import Resampling
+
+from easyearth.core.tiling import (
+    ImageSource, PredictLogits, StripBlender, _batches, blended_label_strips, finished_row, image_size, read_valid,
+    read_window, tile_windows
+)
+
+logger = logging.getLogger("easyearth")
+
+# logit given to the coarse class of a confident tile, it dominates the blending with refined neighbours only where
+# the refined tile is unsure
+CONFIDENT_LOGIT = 10.0
+
+
+def read_decimated(image: ImageSource, factor: int) -> np.ndarray:
+    """RGB copy of an image decimated by ``factor`` with average resampling, of shape (height, width, 3)"""
+    height, width = image_size(image)
+    out_shape = (max(1, height // factor), max(1, width // factor))
+    if isinstance(image, np.ndarray):
+        pixels = torch.from_numpy(np.ascontiguousarray(image[:, :, :3])).permute(2, 0, 1).float()[None]
+        decimated = F.adaptive_avg_pool2d(pixels, out_shape)[0].permute(1, 2, 0).round().numpy().astype(image.dtype)
+    else:
+        indexes = list(range(1, min(image.count, 3) + 1))
+        decimated = np.transpose(image.read(indexes, out_shape=(len(indexes),) + out_shape, resampling=Resampling.average), (1, 2, 0))
+    if decimated.shape[2] == 1:
+        decimated = np.repeat(decimated, 3, axis=2)
+    return decimated
+
+
+class CoarseToFine:
+    """Sliding-window segmentation that only runs the model at full resolution where the coarse pass is unsure"""
+
+    def __init__(self,
+                 predict: PredictLogits,
+                 tile_size: int = 512,
+                 overlap: int = 64,
+                 batch_size: int = 4,
+                 factor: int = 4,
+                 min_confidence: float = 0.9,
+                 tolerance: float = 0.01,
+                 verify_fraction: float = 0.05,
+                 label_dtype=np.uint8,
+                 seed: int = 0):
+        """Initialize the coarse-to-fine segmentation
+        Args:
+            predict: Function computing the logits of a batch of tiles at tile resolution
+            tile_size: Size of the tiles in pixels, for both passes
+            overlap: Overlap between neighbouring tiles in pixels
+            batch_size: Number of tiles per forward pass
+            factor: Decimation of the image for the coarse pass
+            min_confidence: Tiles where the coarse confidence is lower somewhere are refined
+            tolerance: Maximum fraction of pixels of the verified tiles where the coarse class may differ from the
+                full resolution inference, otherwise every tile is refined
+            verify_fraction: Fraction of the confident tiles checked at full resolution, at least one
+            label_dtype: Data type of the label map
+            seed: Seed of the sample of verified tiles
+        """
+        self.predict = predict
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.factor = factor
+        self.min_confidence = min_confidence
+        self.tolerance = tolerance
+        self.verify_fraction = verify_fraction
+        self.label_dtype = label_dtype
+        self.seed = seed
+        self.num_classes = None
+        self.report = {}
+
+    def coarse_pass(self, image: ImageSource) -> Tuple[np.ndarray, np.ndarray]:
+        """Labels and confidence of the decimated image, also records the number of classes of the model"""
+        def predict(tiles):
+            logits = self.predict(tiles)
+            self.num_classes = logits.shape[1]
+            return logits
+
+        coarse = read_decimated(image, self.factor)
+        labels = np.empty(coarse.shape[:2], dtype=self.label_dtype)
+        confidence = np.empty(coarse.shape[:2], dtype=np.float16)
+        for row, strip_labels, strip_confidence in blended_label_strips(
+                coarse, predict, tile_size=self.tile_size, overlap=self.overlap, batch_size=self.batch_size,
+                label_dtype=self.label_dtype, with_confidence=True):
+            labels[row:row + strip_labels.shape[0]] = strip_labels
+            confidence[row:row + strip_labels.shape[0]] = strip_confidence
+        self.report['coarse_tiles'] = sum(len(row) for row in tile_windows(*coarse.shape[:2], self.tile_size, self.overlap))
+        return labels, confidence
+
+    def tile_classes(self, rows, labels: np.ndarray, confidence: np.ndarray, size: Tuple[int, int]) -> Dict[Tuple[int, int], int]:
+        """Class of the tiles that the coarse pass finds uniform and confident, with one coarse pixel of margin
+        Returns:
+            Dictionary of (row_off, col_off) -> class
+        """
+        scale_y, scale_x = labels.shape[0] / size[0], labels.shape[1] / size[1]
+        classes = {}
+        for window in (window for row in rows for window in row):
+            row_start = max(0, int(window.row_off * scale_y) - 1)
+            row_stop = math.ceil((window.row_off + window.height) * scale_y) + 1
+            col_start = max(0, int(window.col_off * scale_x) - 1)
+            col_stop = math.ceil((window.col_off + window.width) * scale_x) + 1
+            region = labels[row_start:row_stop, col_start:col_stop]
+            if (region == region.flat[0]).all() and confidence[row_start:row_stop, col_start:col_stop].min() >= self.min_confidence:
+                classes[(window.row_off, window.col_off)] = int(region.flat[0])
+        return classes
+
+    def verify(self, image: ImageSource, rows, classes: Dict[Tuple[int, int], int]) -> float:
+        """Fraction of the valid pixels of a sample of confident tiles where the full resolution label differs"""
+        windows = [window for row in rows for window in row if (window.row_off, window.col_off) in classes]
+        if not windows:
+            return 0.0
+        count = min(len(windows), max(1, math.ceil(self.verify_fraction * len(windows))))
+        sample = [windows[i] for i in sorted(np.random.default_rng(self.seed).choice(len(windows), count, replace=False))]
+
+        different, total = 0, 0
+        for batch in _batches(sample, self.batch_size):
+            tile_labels = self.predict([read_window(image, window) for window in batch]).argmax(dim=1).numpy()
+            for window, labels in zip(batch, tile_labels):
+                valid = read_valid(image, window)
+                valid = np.ones(labels.shape, dtype=bool) if valid is None else valid
+                different += int(((labels != classes[(window.row_off, window.col_off)]) & valid).sum())
+                total += int(valid.sum())
+        self.report['verified'] = count
+        return different / total if total else 0.0
+
+    def run(self, image: ImageSource) -> Iterator[Tuple[int, np.ndarray]]:
+        """Segment an image, yielding the label map in horizontal strips like blended_label_strips
+        The report of the compute saved is in ``self.report`` once the iterator is exhausted.
+        """
+        height, width = image_size(image)
+        rows = tile_windows(height, width, self.tile_size, self.overlap)
+        total = sum(len(row) for row in rows)
+        self.report = {'factor': self.factor, 'tiles': total, 'verified': 0}
+
+        coarse_labels, confidence = self.coarse_pass(image)
+        classes = self.tile_classes(rows, coarse_labels, confidence, (height, width))
+        disagreement = self.verify(image, rows, classes)
+        fallback = disagreement > self.tolerance
+        if fallback:
+            logger.info(f"Coarse classes disagree on {disagreement:.2%} of the verified pixels, refining every tile")
+            classes = {}
+
+        blender = StripBlender(height, width, self.overlap, (rows[0][0].height, rows[0][0].width), self.label_dtype)
+        refined = 0
+        for index, row in enumerate(rows):
+            refine = [window for window in row if (window.row_off, window.col_off) not in classes]
+            for batch in _batches(refine, self.batch_size):
+                blender.add(batch, self.predict([read_window(image, window) for window in batch]),
+                            [read_valid(image, window) for window in batch])
+            refined += len(refine)
+
+            confident = [window for window in row if (window.row_off, window.col_off) in classes]
+            if confident:
+                one_hot = F.one_hot(torch.tensor([classes[(w.row_off, w.col_off)] for w in confident]), self.num_classes).float()
+                logits = (one_hot * CONFIDENT_LOGIT)[:, :, None, None].expand(-1, -1, confident[0].height, confident[0].width)
+                blender.add(confident, logits, [read_valid(image, window) for window in confident])
+
+            strip = blender.finish(finished_row(rows, index, height))
+            if strip is not None:
+                yield strip
+
+        computed = self.report['coarse_tiles'] + self.report['verified'] + refined
+        self.report.update(refined=refined, coarse=total - refined, disagreement=round(disagreement, 5),
+                           fallback=fallback, compute_saved=round(1 - computed / total, 4))
+        logger.info(f"Coarse-to-fine segmentation: {self.report}")
@@ -0,0 +1,59 @@
+"""Response compression negotiated with the Accept-Encoding header, zstd if installed, otherwise gzip."""
+import gzip
+import os
+
+from flask import request
+
+from easyearth.core.metrics import stage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary formats that are already compressed
+COMPRESSED_MIMETYPES = {'application/vnd.apache.parquet', 'application/zip', 'application/gzip', 'image/png', 'image/jpeg'}
+
+
+def compress(data: bytes, encoding: str, level: int = None) -> bytes:
+    """Compress data with the given content encoding ('zstd' or 'gzip')"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level or 5)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def available_encodings():
+    """Content encodings supported by the server, in order of preference"""
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def compress_response(response, min_size: int = 1024):
+    """Compress a response if the client accepts it, for use as an after_request handler"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype in COMPRESSED_MIMETYPES):
+        return response
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    with stage('compress'):
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_compression(app):
+    """Compress the responses of a Flask app larger than RESPONSE_COMPRESSION_MIN_SIZE bytes"""
+    min_size = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+    app.after_request(lambda response: compress_response(response, min_size=min_size))
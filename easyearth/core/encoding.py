@@ -0,0 +1,158 @@
+"""Binary wire formats for prompts and predictions.
+
+Predictions are returned as JSON by default. Clients that send an ``Accept`` header with one of the binary media types
+below get the same features in a compact binary encoding that can be opened directly with OGR, e.g. from ``/vsimem``.
+Streaming clients get the features as events while they are computed, as newline delimited JSON or server-sent events.
+"""
+import base64
+import io
+import json
+import struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+import shapely.geometry
+
+JSON = 'application/json'
+FLATGEOBUF = 'application/flatgeobuf'
+GEOPARQUET = 'application/vnd.apache.parquet'
+WKB_STREAM = 'application/vnd.easyearth.wkb-stream'
+
+MEDIA_TYPES = [JSON, FLATGEOBUF, GEOPARQUET, WKB_STREAM]
+
+NDJSON = 'application/x-ndjson'
+EVENT_STREAM = 'text/event-stream'
+STREAM_TYPES = [NDJSON, EVENT_STREAM]
+
+WKB_STREAM_MAGIC = b'EEWKB\x01'
+
+
+def features_to_geodataframe(features: List[Dict], crs: Optional[str] = None) -> gpd.GeoDataFrame:
+    """Convert GeoJSON features as returned by raster_to_vector to a GeoDataFrame"""
+    return gpd.GeoDataFrame.from_features(features, crs=crs)
+
+
+def encode_flatgeobuf(features: List[Dict], crs: Optional[str] = None) -> bytes:
+    """Encode features as FlatGeobuf, without spatial index so the features keep their order"""
+    buffer = io.BytesIO()
+    features_to_geodataframe(features, crs).to_file(buffer, driver='FlatGeobuf', layer_options={'SPATIAL_INDEX': 'NO'})
+    return buffer.getvalue()
+
+
+def encode_geoparquet(features: List[Dict], crs: Optional[str] = None) -> bytes:
+    """Encode features as GeoParquet, requires pyarrow"""
+    buffer = io.BytesIO()
+    features_to_geodataframe(features, crs).to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def encode_wkb_stream(features: List[Dict], crs: Optional[str] = None) -> bytes:
+    """Encode features as a length-prefixed stream of WKB geometries
+    Layout (little endian): magic, uint32 length + crs (utf-8), then for every feature
+    uint32 length + properties (JSON, utf-8) and uint32 length + geometry (WKB).
+    """
+    geometries = [shapely.geometry.shape(feature['geometry']) for feature in features]
+    wkbs = shapely.to_wkb(geometries) if geometries else []
+    crs_bytes = (crs or '').encode('utf-8')
+
+    chunks = [WKB_STREAM_MAGIC, struct.pack('<I', len(crs_bytes)), crs_bytes]
+    for feature, wkb in zip(features, wkbs):
+        properties = json.dumps(feature.get('properties', {})).encode('utf-8')
+        chunks.extend([struct.pack('<I', len(properties)), properties, struct.pack('<I', len(wkb)), wkb])
+    return b''.join(chunks)
+
+
+def decode_wkb_stream(data: bytes) -> Tuple[List[Dict], Optional[str]]:
+    """Decode a stream written by encode_wkb_stream
+    Returns:
+        Tuple of (list of features with 'properties' and a shapely 'geometry', crs)
+    """
+    if not data.startswith(WKB_STREAM_MAGIC):
+        raise ValueError("Not an EasyEarth WKB stream")
+    offset = len(WKB_STREAM_MAGIC)
+
+    def read_chunk():
+        nonlocal offset
+        (length,) = struct.unpack_from('<I', data, offset)
+        chunk = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        return chunk
+
+    crs = read_chunk().decode('utf-8') or None
+    features = []
+    while offset < len(data):
+        properties = json.loads(read_chunk())
+        features.append({'properties': properties, 'geometry': shapely.from_wkb(read_chunk())})
+    return features, crs
+
+
+ENCODERS = {
+    FLATGEOBUF: encode_flatgeobuf,
+    GEOPARQUET: encode_geoparquet,
+    WKB_STREAM: encode_wkb_stream,
+}
+
+
+def negotiate(accept_mimetypes, streaming: bool = False) -> str:
+    """Choose the response media type from the Accept header, JSON unless a binary type is preferred
+    Args:
+        accept_mimetypes: werkzeug MIMEAccept of the request
+        streaming: Whether the endpoint can also stream its response, see STREAM_TYPES
+    """
+    return accept_mimetypes.best_match(MEDIA_TYPES + (STREAM_TYPES if streaming else []), default=JSON) or JSON
+
+
+def encode_event(event: Dict[str, Any], media_type: str, dumps: Callable[[Any], str] = json.dumps) -> bytes:
+    """Encode an event of a streamed response, e.g. {'type': 'features', 'features': [...]}
+    Args:
+        event: The event, its type is the event name of server-sent events
+        media_type: NDJSON, one JSON object per line, or EVENT_STREAM for server-sent events
+        dumps: JSON serializer, e.g. the one of the flask app
+    """
+    data = dumps(event)
+    if media_type == EVENT_STREAM:
+        return f"event: {event['type']}\ndata: {data}\n\n".encode('utf-8')
+    return f"{data}\n".encode('utf-8')
+
+
+def decode_array(encoded: str) -> np.ndarray:
+    """Decode a base64 encoded .npy array"""
+    return np.load(io.BytesIO(base64.b64decode(encoded)), allow_pickle=False)
+
+
+def encode_array(array: np.ndarray) -> str:
+    """Encode an array as base64 .npy, the inverse of decode_array"""
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def decode_prompt_arrays(prompt_arrays: Dict[str, str]) -> Dict[str, list]:
+    """Decode the binary form of prompts into the format of reorganize_prompts
+    Args:
+        prompt_arrays: Dictionary of base64 encoded .npy arrays
+            - points: (Object, 2) or (Object, Point, 2) pixel coordinates
+            - labels: (Object,) or (Object, Point) point labels
+            - boxes: (Object, 4) pixel coordinates [x1, y1, x2, y2]
+    Returns:
+        dict: A dictionary with keys 'points', 'labels', 'boxes', and 'text'
+    """
+    transformed_prompts = {'points': [], 'labels': [], 'boxes': [], 'text': []}
+
+    if prompt_arrays.get('points'):
+        points = decode_array(prompt_arrays['points']).astype(np.float64)
+        if points.ndim == 2:
+            points = points[:, np.newaxis, :]
+        transformed_prompts['points'] = [points.tolist()]
+
+        if prompt_arrays.get('labels'):
+            labels = decode_array(prompt_arrays['labels']).astype(np.int64).reshape(points.shape[:2])
+            transformed_prompts['labels'] = [labels.tolist()]
+
+    if prompt_arrays.get('boxes'):
+        boxes = decode_array(prompt_arrays['boxes']).astype(np.float64).reshape(-1, 4)
+        transformed_prompts['boxes'] = [boxes.tolist()]
+
+    return transformed_prompts
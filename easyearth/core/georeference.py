@@ -0,0 +1,89 @@
+"""Conversion of prompts from map coordinates to pixels, and of predicted geometries to other coordinate reference
+systems, on whole coordinate arrays at once instead of point by point."""
+import functools
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+import shapely.geometry
+from pyproj import CRS, Transformer
+from rasterio.transform import Affine
+
+PIXEL = 'pixel'
+
+
+def is_pixel_crs(crs: Optional[str]) -> bool:
+    """Whether coordinates in crs are pixels of the image, the default of prompts"""
+    return crs is None or str(crs).lower() == PIXEL
+
+
+@functools.lru_cache(maxsize=32)
+def get_transformer(src_crs: str, dst_crs: str) -> Optional[Transformer]:
+    """Transformer from src_crs to dst_crs in (x, y) order, or None if both are the same CRS"""
+    src, dst = CRS.from_user_input(src_crs), CRS.from_user_input(dst_crs)
+    if src == dst:
+        return None
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def reproject_coordinates(coords: np.ndarray, src_crs: str, dst_crs: str) -> np.ndarray:
+    """Reproject (N, 2) coordinates from src_crs to dst_crs"""
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None or len(coords) == 0:
+        return coords
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def to_pixels(coordinates, img_transform: Affine, image_shape: Tuple[int, ...], crs: Optional[str] = None,
+              image_crs: Optional[str] = None) -> np.ndarray:
+    """Convert coordinates (..., 2) in crs to pixel coordinates of the image, clipped to its bounds
+    Args:
+        coordinates: Nested list or array of (x, y) coordinates
+        img_transform: Affine transform from pixels to the CRS of the image
+        image_shape: Image shape (height, width, ...)
+        crs: CRS of the coordinates, the CRS of the image if None
+        image_crs: CRS of the image
+    Returns:
+        Array of the same shape with (column, row) coordinates
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    coords = coordinates.reshape(-1, 2)
+    if crs is not None and image_crs is not None:
+        coords = reproject_coordinates(coords, crs, image_crs)
+    inverse = ~img_transform
+    pixels = coords @ np.array([[inverse.a, inverse.d], [inverse.b, inverse.e]]) + np.array([inverse.c, inverse.f])
+    height, width = image_shape[:2]
+    pixels = np.clip(pixels, 0, [width - 1, height - 1])
+    return pixels.reshape(coordinates.shape)
+
+
+def boxes_to_pixels(boxes, img_transform: Affine, image_shape: Tuple[int, ...], crs: Optional[str] = None,
+                    image_crs: Optional[str] = None) -> np.ndarray:
+    """Convert boxes (..., 4) [x1, y1, x2, y2] in crs to pixel boxes [x_min, y_min, x_max, y_max], see to_pixels"""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    corners = to_pixels(boxes.reshape(-1, 2, 2), img_transform, image_shape, crs, image_crs)
+    # the y axis of map coordinates points up, the corners are reordered
+    pixels = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    return pixels.reshape(boxes.shape)
+
+
+def prompts_to_pixels(prompts: Dict[str, List], img_transform: Affine, image_shape: Tuple[int, ...],
+                      crs: Optional[str] = None, image_crs: Optional[str] = None) -> Dict[str, List]:
+    """Convert the point and box prompts of a request, as returned by get_prompts, from crs to pixel coordinates"""
+    prompts = dict(prompts)
+    if len(prompts['points']) > 0:
+        prompts['points'] = to_pixels(prompts['points'], img_transform, image_shape, crs, image_crs).tolist()
+    if len(prompts['boxes']) > 0:
+        prompts['boxes'] = boxes_to_pixels(prompts['boxes'], img_transform, image_shape, crs, image_crs).tolist()
+    return prompts
+
+
+def reproject_features(features: List[Dict], src_crs: str, dst_crs: str) -> List[Dict]:
+    """Reproject the geometries of GeoJSON features from src_crs to dst_crs, all coordinates at once"""
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None or not features:
+        return features
+    geometries = np.array([shapely.geometry.shape(feature['geometry']) for feature in features], dtype=object)
+    geometries = shapely.transform(geometries, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+    return [{**feature, 'geometry': shapely.geometry.mapping(geometry)} for feature, geometry in zip(features, geometries)]
@@ -0,0 +1,301 @@
+"""Background jobs with their state on disk, so unfinished jobs are resumed after a crash or restart of the server.
+
+The process running a job holds a lock on the owner.lock file of the job until the job finishes. The lock is released
+when the process exits, also when it crashes or is stopped by a reload, so any other process of the server can tell
+that the job was interrupted and resume it.
+"""
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the server runs as a single process
+    fcntl = None
+
+logger = logging.getLogger("easyearth")
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+UNFINISHED = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    """Raised by a job runner when the job was cancelled"""
+
+
+class Job:
+    """A background job, saved as job.json in its own directory"""
+
+    def __init__(self,
+                 directory: str,
+                 job_type: str,
+                 request: Dict[str, Any],
+                 job_id: Optional[str] = None,
+                 status: str = QUEUED,
+                 progress: Optional[Dict[str, Any]] = None,
+                 outputs: Optional[Dict[str, Any]] = None,
+                 error: Optional[str] = None,
+                 created: Optional[str] = None,
+                 updated: Optional[str] = None,
+                 expires: Optional[str] = None,
+                 owner: Optional[int] = None):
+        """Initialize a job
+        Args:
+            directory: Directory of all jobs, the job is saved in a sub directory named after its id
+            job_type: Type of the job, selects the runner
+            request: Parameters of the job
+            expires: Time after which a finished job is removed with its outputs, None to keep it
+            owner: Process id of the server process that queued or resumed the job last
+        """
+        self.job_id = job_id or uuid.uuid4().hex
+        self.path = os.path.join(directory, self.job_id)
+        self.job_type = job_type
+        self.request = request
+        self.status = status
+        self.progress = progress or {}
+        self.outputs = outputs or {}
+        self.error = error
+        self.created = created or datetime.now().isoformat()
+        self.updated = updated or self.created
+        self.expires = expires
+        self.owner = owner
+        self.cancelled = threading.Event()
+        self.owner_lock = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """State of the job as returned by the API"""
+        return {'job_id': self.job_id, 'job_type': self.job_type, 'status': self.status, 'progress': self.progress,
+                'outputs': self.outputs, 'error': self.error, 'created': self.created, 'updated': self.updated,
+                'expires': self.expires, 'owner': self.owner, 'request': self.request}
+
+    def save(self):
+        """Write job.json atomically, a crash never leaves a partial state file"""
+        self.updated = datetime.now().isoformat()
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, 'job.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(filename + '.tmp', filename)
+
+    def cancel(self):
+        """Flag the job as cancelled, also for the server process running it if that is another one"""
+        self.cancelled.set()
+        os.makedirs(self.path, exist_ok=True)
+        open(os.path.join(self.path, 'cancel'), 'w').close()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if the job was cancelled, runners call this between units of work"""
+        if self.cancelled.is_set() or os.path.exists(os.path.join(self.path, 'cancel')):
+            self.cancelled.set()
+            raise JobCancelled(self.job_id)
+
+    def claim(self) -> bool:
+        """Take the lock of the job for this process, False if another process holds it, i.e. is running the job"""
+        os.makedirs(self.path, exist_ok=True)
+        lock = open(os.path.join(self.path, 'owner.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return False
+        self.owner_lock = lock
+        self.owner = os.getpid()
+        return True
+
+    def release(self):
+        """Release the lock of the job once this process is done with it"""
+        if self.owner_lock is not None:
+            self.owner_lock.close()
+            self.owner_lock = None
+
+    @classmethod
+    def load(cls, directory: str, job_id: str) -> 'Job':
+        """Load a job saved in directory/job_id/job.json"""
+        with open(os.path.join(directory, job_id, 'job.json')) as f:
+            state = json.load(f)
+        state.pop('job_id')
+        return cls(directory, job_id=job_id, **state)
+
+
+class JobManager:
+    """Runs jobs on background worker threads, one runner per job type
+
+    Several server processes can share the directory: every process runs the jobs it queued, and reads the state of
+    the jobs of the other processes from disk. The unfinished jobs of a process that stopped are resumed by the first
+    process that finds them, see resume and watch.
+    """
+
+    def __init__(self, directory: str, runners: Dict[str, Callable[[Job], None]], workers: int = 1,
+                 ttl: Optional[Dict[str, float]] = None):
+        """Initialize the manager and load the jobs saved in directory
+        Args:
+            directory: Directory the jobs are saved to
+            runners: Function running a job for every job type. Runners report progress with job.save(), call
+                job.check_cancelled() between units of work and skip the work already done when a job is resumed.
+            workers: Number of jobs running at the same time
+            ttl: Seconds the finished jobs of a type are kept with their outputs, jobs of other types are kept
+        """
+        self.directory = directory
+        self.runners = runners
+        self.workers = workers
+        self.ttl = ttl or {}
+        self.jobs: Dict[str, Job] = {}
+        # jobs queued by this process, the state of the other jobs is read from disk
+        self.owned: Set[str] = set()
+        self.queue = queue.Queue()
+        self.threads: List[threading.Thread] = []
+        self.watcher: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for job_id in sorted(os.listdir(directory)):
+            try:
+                self.jobs[job_id] = Job.load(directory, job_id)
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f"Skipping job {job_id}: {str(e)}")
+
+    def _start(self):
+        """Start the worker threads on first use"""
+        with self.lock:
+            if not self.threads:
+                for index in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+
+    def submit(self, job_type: str, request: Dict[str, Any]) -> Job:
+        """Queue a new job"""
+        if job_type not in self.runners:
+            raise ValueError(f"Unknown job type: {job_type}. Available: {list(self.runners.keys())}")
+        self.expire()
+        job = Job(self.directory, job_type, request)
+        job.claim()
+        job.save()
+        self.jobs[job.job_id] = job
+        self.owned.add(job.job_id)
+        self._start()
+        self.queue.put(job)
+        return job
+
+    def resume(self) -> List[Job]:
+        """Queue the jobs that were queued or running in a server process that stopped, e.g. by a crash, a restart
+        or a reload, and that no other process resumed yet"""
+        resumed = []
+        for job_id in sorted(os.listdir(self.directory)):
+            if job_id in self.owned:
+                continue
+            claimed = self._load(job_id)
+            if claimed is None or claimed.status not in UNFINISHED or claimed.job_type not in self.runners \
+                    or not claimed.claim():
+                continue
+            # the state as saved by its last owner, which may have finished it meanwhile
+            job = self._load(job_id)
+            if job is None or job.status not in UNFINISHED:
+                claimed.release()
+                continue
+            previous, job.owner, job.owner_lock = job.owner, claimed.owner, claimed.owner_lock
+            logger.info(f"Resuming job {job.job_id} of process {previous}")
+            job.status = QUEUED
+            job.save()
+            self.owned.add(job.job_id)
+            self._start()
+            self.queue.put(job)
+            resumed.append(job)
+        return resumed
+
+    def watch(self, interval: float):
+        """Resume the jobs of server processes that stop later on every interval seconds, e.g. of the old workers of
+        a reload that exit once their requests are done"""
+        def resume_interrupted():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.resume()
+                except Exception:
+                    logger.error("Failed to resume jobs", exc_info=True)
+
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=resume_interrupted, name="job-watcher", daemon=True)
+                self.watcher.start()
+
+    def _load(self, job_id: str) -> Optional[Job]:
+        """Reload a job of another process from disk, None if it does not exist (anymore)"""
+        try:
+            self.jobs[job_id] = Job.load(self.directory, job_id)
+        except (OSError, ValueError, TypeError):
+            self.jobs.pop(job_id, None)
+        return self.jobs.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get a job by id"""
+        self.expire()
+        if job_id in self.owned:
+            return self.jobs.get(job_id)
+        return self._load(job_id) if job_id.isalnum() else None
+
+    def list(self) -> List[Job]:
+        """All jobs, oldest first"""
+        self.expire()
+        for job_id in (set(self.jobs) | set(os.listdir(self.directory))) - self.owned:
+            self._load(job_id)
+        return sorted(self.jobs.values(), key=lambda job: job.created)
+
+    def expire(self) -> List[str]:
+        """Remove the finished jobs whose time to live has passed, with their outputs"""
+        now = datetime.now().isoformat()
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.expires is not None and job.expires < now]
+            for job in expired:
+                self.jobs.pop(job.job_id, None)
+        for job in expired:
+            logger.info(f"Removing expired job {job.job_id}")
+            shutil.rmtree(job.path, ignore_errors=True)
+        return [job.job_id for job in expired]
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel a job, a running job stops at the next unit of work and keeps its partial outputs"""
+        job = self.get(job_id)
+        if job is not None and job.status in UNFINISHED:
+            job.cancel()
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.save()
+        return job
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job.status != QUEUED:
+                    continue
+                job.check_cancelled()
+                job.status = RUNNING
+                job.save()
+                self.runners[job.job_type](job)
+                job.status = COMPLETED
+            except JobCancelled:
+                job.status = CANCELLED
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed", exc_info=True)
+                job.status = FAILED
+                job.error = str(e)
+            finally:
+                if job.status != QUEUED:
+                    if job.job_type in self.ttl:
+                        job.expires = (datetime.now() + timedelta(seconds=self.ttl[job.job_type])).isoformat()
+                    job.save()
+                job.release()
+                self.queue.task_done()
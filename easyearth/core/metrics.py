@@ -0,0 +1,215 @@
+"""Latency of the stages of every request, and metrics of the server in the Prometheus text format.
+
+Code runs its stages, e.g. loading the image, computing the embedding or polygonizing the masks, within stage(name).
+The durations are added up per request and returned in its Server-Timing header, and the totals of every request are
+aggregated in histograms per endpoint and stage, which GET /metrics exposes together with the cache lookups and the
+gauges of the server (loaded models, queue depths).
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from flask import g, request
+
+# upper bounds of the latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    """Distribution of observed values by labels"""
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self.series: Dict[Labels, List] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (buckets, total, count) in sorted(self.series.items()):
+                for bound, bucket in zip(self.buckets + (math.inf,), buckets + [count]):
+                    le = 'le="%s"' % _value(bound)
+                    lines.append(f'{self.name}_bucket{_labels(labels, le)} {bucket}')
+                lines.append(f'{self.name}_sum{_labels(labels)} {_value(total)}')
+                lines.append(f'{self.name}_count{_labels(labels)} {count}')
+        return lines
+
+
+class Counter:
+    """Monotonic counts by labels"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.series: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self.lock:
+            return self.series.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            lines.extend(f'{self.name}{_labels(labels)} {_value(value)}' for labels, value in sorted(self.series.items()))
+        return lines
+
+
+def render_gauge(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, str], float]],
+                 metric_type: str = 'gauge') -> List[str]:
+    """Lines of a gauge computed when the metrics are collected, from (labels, value) samples, or of a counter kept
+    elsewhere with metric_type 'counter'"""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+    lines.extend(f'{name}{_labels(tuple(sorted(labels.items())))} {_value(value)}' for labels, value in samples)
+    return lines
+
+
+REQUEST_SECONDS = Histogram('easyearth_request_duration_seconds', 'Duration of the requests by endpoint')
+STAGE_SECONDS = Histogram('easyearth_stage_duration_seconds', 'Time spent per request in every stage, by endpoint')
+CACHE_LOOKUPS = Counter('easyearth_cache_lookups_total', 'Lookups of the caches by cache and result (hit or miss)')
+
+
+def cache_lookup(cache: str, hit: bool):
+    """Count a lookup of a cache, e.g. of the loaded models"""
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+class Timings:
+    """Time spent in every stage of a request, in the order the stages started"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: 'OrderedDict[str, float]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, float]:
+        """Milliseconds per stage and in total"""
+        with self.lock:
+            stages = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+        stages['total'] = round((time.perf_counter() - self.started) * 1000, 1)
+        return stages
+
+    def header(self) -> str:
+        """Value of the Server-Timing header"""
+        return ', '.join(f'{name};dur={duration}' for name, duration in self.to_dict().items())
+
+    def observe(self, endpoint: str):
+        """Add the request to the histograms"""
+        with self.lock:
+            stages = list(self.stages.items())
+        for name, seconds in stages:
+            STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=name)
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, endpoint=endpoint)
+
+
+_current: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar('timings', default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a stage of the current request, nested stages are also part of the outer stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _current.get()
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def timed(endpoint: str) -> Iterator[Timings]:
+    """Record the stages of a request within the context, and add it to the histograms of the endpoint at its end"""
+    timings = Timings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+        timings.observe(endpoint)
+
+
+def render_metrics(gauges: Iterable[List[str]] = ()) -> str:
+    """All metrics in the Prometheus text format
+    Args:
+        gauges: Lines of the gauges of the server, see render_gauge
+    """
+    lines = REQUEST_SECONDS.render() + STAGE_SECONDS.render() + CACHE_LOOKUPS.render()
+    with CACHE_LOOKUPS.lock:
+        caches = sorted({dict(labels)['cache'] for labels in CACHE_LOOKUPS.series})
+    ratios = []
+    for cache in caches:
+        hits, misses = CACHE_LOOKUPS.get(cache=cache, result='hit'), CACHE_LOOKUPS.get(cache=cache, result='miss')
+        ratios.append(({'cache': cache}, hits / (hits + misses) if hits + misses else 0.0))
+    lines += render_gauge('easyearth_cache_hit_ratio', 'Fraction of the cache lookups that were hits', ratios)
+    for gauge in gauges:
+        lines += gauge
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app):
+    """Time every request of a Flask app, and return the timings of its stages in the Server-Timing header"""
+
+    @app.before_request
+    def start_timing():
+        rule = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        g.timed = timed(rule)
+        g.timings = g.timed.__enter__()
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = g.get('timings')
+        if timings is not None:
+            response.headers['Server-Timing'] = timings.header()
+        return response
+
+    @app.teardown_request
+    def finish_timing(error=None):
+        if g.get('timed') is not None:
+            g.timed.__exit__(None, None, None)
+            g.timed = None
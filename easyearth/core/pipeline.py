@@ -0,0 +1,376 @@
+"""Pipelined tile processing: prefetch windows, run mini-batched inference and polygonize finished strips concurrently.
+
+A reader thread prefetches tiles into a bounded queue, the calling thread runs the model on mini-batches and blends
+the logits, and a pool of workers polygonizes every finished strip of the label map. Each stage records how long it
+was busy, so the stage that limits the throughput shows up in the utilization report.
+"""
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import shapely
+import shapely.geometry
+from rasterio import features
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from easyearth.config.serving import available_cores
+from easyearth.core.tiling import (
+    ImageSource, PredictLogits, StripBlender, TileFilter, finished_row, image_size, screen_tiles, skipped_report, tile_windows
+)
+
+logger = logging.getLogger("easyearth")
+
+# (first row, label strip, polygons of the strip in pixel coordinates as (label value, polygon))
+StripResult = Tuple[int, np.ndarray, List[Tuple[float, Any]]]
+
+_DONE = object()
+
+_postprocess_executor = None
+_postprocess_lock = threading.Lock()
+
+
+def get_postprocess_executor() -> Executor:
+    """Thread pool shared by all requests for post-processing, POSTPROCESS_WORKERS threads (2 by default)"""
+    global _postprocess_executor
+    with _postprocess_lock:
+        if _postprocess_executor is None:
+            _postprocess_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('POSTPROCESS_WORKERS', 2)),
+                                                       thread_name_prefix="postprocess")
+        return _postprocess_executor
+
+
+def max_vectorize_workers() -> int:
+    """Maximum number of polygonization threads of a sliding-window prediction, MAX_VECTORIZE_WORKERS or by default
+    the available cores"""
+    return max(1, int(os.environ.get('MAX_VECTORIZE_WORKERS') or available_cores()))
+
+
+def overlap(items: Iterable, process: Callable[[Any], Any], executor: Optional[Executor] = None,
+            ahead: int = 2) -> Iterator:
+    """Process the items of an iterator on an executor while the iterator computes the next ones
+    E.g. a chunk of masks is polygonized while the model decodes the next chunk.
+    Args:
+        items: Items, computed lazily
+        process: Function processing an item
+        executor: Executor running process, the shared post-processing pool by default
+        ahead: Maximum number of processed items waiting to be returned, bounds the memory of the results
+    Returns:
+        Iterator of the processed items, in the order of the items. process runs in the context of the caller, e.g.
+        it is timed as part of the request, see easyearth.core.metrics.
+    """
+    executor = executor or get_postprocess_executor()
+    pending = deque()
+    try:
+        for item in items:
+            while len(pending) >= ahead:
+                yield pending.popleft().result()
+            pending.append(executor.submit(contextvars.copy_context().run, process, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class StageStats:
+    """Busy time of a pipeline stage"""
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, items: int = 1):
+        """Add the duration of a unit of work"""
+        with self._lock:
+            self.busy += seconds
+            self.items += items
+
+    def report(self, wall: float) -> Dict[str, float]:
+        """Busy time, number of items and utilization over the wall time of the pipeline"""
+        utilization = self.busy / (wall * self.workers) if wall > 0 else 0.0
+        return {'busy_s': round(self.busy, 3), 'items': self.items, 'workers': self.workers,
+                'utilization': round(utilization, 3)}
+
+
+def vectorize_strip(row: int, labels: np.ndarray, col: int = 0) -> List[Tuple[float, Any]]:
+    """Polygonize a strip of the label map in pixel coordinates of the whole image
+    Args:
+        row: First row of the strip in the image
+        labels: Label strip of shape (rows, width)
+        col: First column of the strip in the image, for label maps of a window of the image
+    Returns:
+        List of (label value, shapely polygon), background (0) excluded
+    """
+    shapes = features.shapes(labels, mask=labels > 0, transform=Affine.translation(col, row))
+    return [(value, shapely.geometry.shape(polygon)) for polygon, value in shapes]
+
+
+def transform_geometries(geometries, img_transform: Affine):
+    """Apply an affine transform to shapely geometries, on all coordinates at once"""
+    matrix = np.array([[img_transform.a, img_transform.d], [img_transform.b, img_transform.e]])
+    offset = np.array([img_transform.c, img_transform.f])
+    return shapely.transform(geometries, lambda coords: coords @ matrix + offset)
+
+
+def merge_strip_polygons(polygons: List[Tuple[float, Any]], seams: List[int], img_transform: Optional[Affine] = None) -> List[Dict]:
+    """Merge the polygons of all strips into one feature per label, like BaseModel.raster_to_vector
+    Only polygons touching a seam between strips are unioned, the others are kept as they are.
+    Args:
+        polygons: List of (label value, polygon) in pixel coordinates
+        seams: Rows where one strip ends and the next one starts
+        img_transform: Optional transform for georeferencing, applied after merging
+    Returns:
+        List of GeoJSON features
+    """
+    seams = np.asarray(seams, dtype=np.float64)
+    by_label = defaultdict(list)
+    for value, polygon in polygons:
+        by_label[value].append(polygon)
+
+    geojson = []
+    for value, parts in by_label.items():
+        bounds = shapely.bounds(parts)
+        touches = np.isin(bounds[:, 1], seams) | np.isin(bounds[:, 3], seams)
+        kept = [part for part, touch in zip(parts, touches) if not touch]
+        if touches.any():
+            merged = shapely.union_all([part for part, touch in zip(parts, touches) if touch])
+            kept.extend(shapely.get_parts(merged).tolist())
+        parts = kept
+
+        geometry = parts[0] if len(parts) == 1 else shapely.geometry.MultiPolygon(parts)
+        if img_transform is not None:
+            geometry = transform_geometries(geometry, img_transform)
+        geojson.append({"properties": {"uid": value}, "geometry": shapely.geometry.mapping(geometry)})
+    return geojson
+
+
+def with_fallback(geojson: List[Dict]) -> List[Dict]:
+    """Add an empty feature if no geometries were found, as in raster_to_vector"""
+    if len(geojson) == 0:
+        logger.warning("No polygons found; creating empty fallback GeoJSON.")
+        geojson.append({"properties": {"uid": -1}, "geometry": shapely.geometry.mapping(shapely.geometry.MultiPolygon([]))})
+    return geojson
+
+
+def vectorize_windows(windows: List[Window], label_maps: List[np.ndarray], img_transform: Optional[Affine] = None) -> List[Dict]:
+    """Polygonize the label maps of disjoint windows of an image into one GeoJSON feature per label value, like
+    BaseModel.raster_to_vector of the label map of the whole image, without a label map of the whole image
+    Args:
+        windows: Windows of the image, they do not overlap or touch
+        label_maps: Label map of every window
+        img_transform: Optional transform for georeferencing
+    Returns:
+        List of GeoJSON features
+    """
+    polygons = []
+    for window, labels in zip(windows, label_maps):
+        polygons.extend(vectorize_strip(window.row_off, labels, window.col_off))
+    return with_fallback(merge_strip_polygons(polygons, [], img_transform))
+
+
+class TilePipeline:
+    """Staged sliding-window segmentation with bounded queues between the stages"""
+
+    def __init__(self,
+                 predict: PredictLogits,
+                 tile_size: int = 512,
+                 overlap: int = 64,
+                 batch_size: int = 4,
+                 prefetch: int = 8,
+                 workers: int = 2,
+                 label_dtype=np.uint8,
+                 executor: Optional[Executor] = None,
+                 tile_filter: Optional[TileFilter] = None):
+        """Initialize the pipeline
+        Args:
+            predict: Function computing the logits of a batch of tiles at tile resolution
+            tile_size: Size of the tiles in pixels
+            overlap: Overlap between neighbouring tiles in pixels
+            batch_size: Number of tiles per forward pass
+            prefetch: Maximum number of tiles read ahead of the model
+            workers: Number of polygonization workers, also bounds the strips waiting to be polygonized. Lowered to
+                max_vectorize_workers, as every request starts its own threads
+            label_dtype: Data type of the label map
+            executor: Optional executor for polygonization, a thread pool of ``workers`` threads by default
+            tile_filter: Optional filter of the tiles to skip before inference, see easyearth.core.tiling.TileFilter.
+                Nodata pixels always get the background label, so they are never polygonized.
+        """
+        self.predict = predict
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.workers = max(1, min(workers, max_vectorize_workers()))
+        self.label_dtype = label_dtype
+        self.executor = executor
+        self.tile_filter = tile_filter
+        self.stats = {}
+
+    def _read(self, image: ImageSource, rows, first: int, tiles: queue.Queue, stop: threading.Event, stats: StageStats):
+        """Reader stage: put the screened tiles into the queue, then _DONE, or the exception that stopped it"""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    tiles.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            screened = screen_tiles(image, rows, self.tile_filter, first)
+            while True:
+                start = time.perf_counter()
+                item = next(screened, None)
+                if item is None:
+                    break
+                stats.record(time.perf_counter() - start)
+                if not put(item):
+                    return
+            put(_DONE)
+        except Exception as e:
+            put(e)
+
+    def _vectorize(self, row: int, labels: np.ndarray, stats: StageStats) -> StripResult:
+        """Vectorize stage, run by the workers"""
+        start = time.perf_counter()
+        polygons = vectorize_strip(row, labels)
+        stats.record(time.perf_counter() - start)
+        return row, labels, polygons
+
+    def run(self, image: ImageSource, start_row: int = 0) -> Iterator[StripResult]:
+        """Segment and polygonize an image
+        Args:
+            image: Array of shape (height, width, bands) or an open rasterio dataset
+            start_row: Index of the first row of tiles to return, to resume an interrupted run. The rows of tiles
+                before it that overlap it are computed again for the blending, but not returned. Usually this is the
+                row before it, but the last row, aligned with the bottom of the image, can overlap several rows.
+        Returns:
+            Iterator of (first row, label strip, polygons in pixel coordinates) from top to bottom. The stage
+            utilization is in ``self.stats`` once the iterator is exhausted.
+        """
+        height, width = image_size(image)
+        rows = tile_windows(height, width, self.tile_size, self.overlap)
+        # when resuming, the rows of tiles reaching into start_row only contribute to the blending of the overlap
+        first = start_row
+        while 0 < first < len(rows) and rows[first - 1][0].row_off + rows[first - 1][0].height > rows[start_row][0].row_off:
+            first -= 1
+        next_row = first
+        blender = StripBlender(height, width, self.overlap, (rows[0][0].height, rows[0][0].width), self.label_dtype,
+                               base=rows[first][0].row_off)
+        stats = {'read': StageStats('read'), 'infer': StageStats('infer'), 'vectorize': StageStats('vectorize', self.workers)}
+
+        tiles = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read, args=(image, rows, first, tiles, stop, stats['read']), name="tile-reader", daemon=True)
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tile-vectorize")
+        pending = deque()
+        remaining = [len(row) for row in rows]
+        reasons = Counter()
+
+        started = time.perf_counter()
+        reader.start()
+        try:
+            done = False
+            while not done:
+                # gather a mini-batch, possibly across rows of tiles
+                batch, skipped = [], []
+                while len(batch) < self.batch_size:
+                    item = tiles.get()
+                    if item is _DONE:
+                        done = True
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    (batch if item[4] is None else skipped).append(item)
+
+                start = time.perf_counter()
+                if batch:
+                    blender.add([window for _, window, _, _, _ in batch], self.predict([tile for _, _, tile, _, _ in batch]),
+                                [valid for _, _, _, valid, _ in batch])
+                for index, _, _, _, _ in batch + skipped:
+                    remaining[index] -= 1
+                reasons.update(reason for _, _, _, _, reason in skipped)
+                strips = []
+                while next_row < len(rows) and remaining[next_row] == 0:
+                    strip = blender.finish(finished_row(rows, next_row, height))
+                    if strip is not None and next_row >= start_row:
+                        strips.append(strip)
+                    next_row += 1
+                if batch:
+                    stats['infer'].record(time.perf_counter() - start, len(batch))
+
+                for row, labels in strips:
+                    # keep at most two strips per worker in flight, so finished strips do not pile up in memory
+                    while len(pending) >= 2 * self.workers:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(self._vectorize, row, labels, stats['vectorize']))
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            if self.executor is None:
+                executor.shutdown(wait=True)
+            reader.join()
+            wall = time.perf_counter() - started
+            self.stats = {name: stage.report(wall) for name, stage in stats.items()}
+            self.stats['skipped'] = skipped_report(reasons, sum(len(row) for row in rows[first:]))
+            self.stats['wall_s'] = round(wall, 3)
+            logger.info(f"Tile pipeline: {self.stats}")
+
+    def vectorize(self, image: ImageSource, img_transform: Optional[Affine] = None) -> List[Dict]:
+        """Segment an image and return one GeoJSON feature per label value, like BaseModel.raster_to_vector of the
+        label map of the whole image, e.g. one feature per class with Segmentation.to_label_map
+        Args:
+            image: Array of shape (height, width, bands) or an open rasterio dataset
+            img_transform: Optional transform for georeferencing
+        Returns:
+            List of GeoJSON features
+        """
+        polygons, seams = [], []
+        for row, labels, strip_polygons in self.run(image):
+            if row > 0:
+                seams.append(row)
+            polygons.extend(strip_polygons)
+
+        return with_fallback(merge_strip_polygons(polygons, seams, img_transform))
+
+    def stream(self, image: ImageSource, img_transform: Optional[Affine] = None) -> Iterator[Tuple[int, List[Dict]]]:
+        """Segment an image and return the features of every strip as soon as it is polygonized
+        The polygons touching a seam between strips may continue in the next strip, they are held back and returned
+        merged after the last strip. Unlike vectorize, a label may have one feature per strip.
+        Args:
+            image: Array of shape (height, width, bands) or an open rasterio dataset
+            img_transform: Optional transform for georeferencing
+        Returns:
+            Iterator of (number of finished rows, GeoJSON features)
+        """
+        height, _ = image_size(image)
+        held, seams = [], []
+        for row, labels, strip_polygons in self.run(image):
+            end = row + labels.shape[0]
+            if row > 0:
+                seams.append(row)
+            finished = []
+            for value, polygon in strip_polygons:
+                _, miny, _, maxy = polygon.bounds
+                (held if (row > 0 and miny == row) or (end < height and maxy == end) else finished).append((value, polygon))
+            yield end, merge_strip_polygons(finished, [], img_transform)
+
+        yield height, merge_strip_polygons(held, seams, img_transform)
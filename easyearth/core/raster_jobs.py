@@ -0,0 +1,110 @@
+"""Whole-raster segmentation as a resumable background job.
+
+The class mask is written strip by strip to an uncompressed tiled GeoTIFF, so blocks are updated in place, and the
+polygons of every strip are appended to a GeoPackage as soon as they are ready. The job records the rows of tiles that
+are done after both outputs are written, so a job interrupted by a crash or restart continues after the last finished
+row of tiles. Once all tiles are done, the mask is converted to a Cloud Optimized GeoTIFF.
+"""
+import logging
+import os
+import sqlite3
+from typing import Optional
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+
+from easyearth.core.jobs import Job
+from easyearth.core.pipeline import TilePipeline, transform_geometries
+from easyearth.core.tiling import PredictLogits, TileFilter, tile_windows
+
+logger = logging.getLogger("easyearth")
+
+PARTIAL_MASK = 'mask.partial.tif'
+MASK = 'mask.tif'
+VECTORS = 'predictions.gpkg'
+LAYER = 'predictions'
+
+
+def _remove_unfinished_features(filename: str, rows_done: int):
+    """Delete the features of rows of tiles that were written, but not recorded as done before an interruption"""
+    if not os.path.exists(filename):
+        return
+    connection = sqlite3.connect(filename)
+    try:
+        connection.execute(f'DELETE FROM "{LAYER}" WHERE tile_row >= ?', (rows_done,))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def segment_raster(job: Job,
+                   predict: PredictLogits,
+                   label_dtype=np.uint8,
+                   tile_size: int = 512,
+                   overlap: int = 64,
+                   batch_size: int = 4,
+                   workers: int = 2,
+                   tile_filter: Optional[TileFilter] = None):
+    """Segment a whole raster tile by tile, writing the outputs into the job directory as the tiles complete
+    Args:
+        job: The job, with the path of the raster in job.request['image_path']
+        predict: Function computing the logits of a batch of tiles at tile resolution
+        label_dtype: Data type of the class mask
+        tile_size: Size of the tiles in pixels
+        overlap: Overlap between neighbouring tiles in pixels
+        batch_size: Number of tiles per forward pass
+        workers: Number of polygonization workers
+        tile_filter: Optional filter of the tiles to skip before inference, e.g. nodata collars
+    """
+    partial_mask = os.path.join(job.path, PARTIAL_MASK)
+    mask = os.path.join(job.path, MASK)
+    vectors = os.path.join(job.path, VECTORS)
+
+    with rasterio.open(job.request['image_path']) as src:
+        rows = tile_windows(src.height, src.width, tile_size, overlap)
+        row_offsets = [row[0].row_off for row in rows]
+        rows_done = job.progress.get('rows_done', 0) if os.path.exists(partial_mask) else 0
+        job.progress = {'rows_done': rows_done, 'rows_total': len(rows),
+                        'tiles_done': sum(len(row) for row in rows[:rows_done]),
+                        'tiles_total': sum(len(row) for row in rows)}
+        job.save()
+
+        if rows_done == 0:
+            for filename in (partial_mask, vectors):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            profile = {'driver': 'GTiff', 'height': src.height, 'width': src.width, 'count': 1,
+                       'dtype': np.dtype(label_dtype).name, 'transform': src.transform, 'crs': src.crs,
+                       'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+            rasterio.open(partial_mask, 'w', **profile).close()
+        else:
+            logger.info(f"Resuming job {job.job_id} at row of tiles {rows_done}/{len(rows)}")
+            _remove_unfinished_features(vectors, rows_done)
+
+        pipeline = TilePipeline(predict, tile_size=tile_size, overlap=overlap, batch_size=batch_size,
+                                workers=workers, label_dtype=label_dtype, tile_filter=tile_filter)
+        strips = pipeline.run(src, start_row=rows_done) if rows_done < len(rows) else []
+        for row, labels, polygons in strips:
+            job.check_cancelled()
+            index = row_offsets.index(row)
+            # closing the dataset flushes the strip to disk before it is recorded as done
+            with rasterio.open(partial_mask, 'r+') as dst:
+                dst.write(labels, 1, window=Window(0, row, src.width, labels.shape[0]))
+            if polygons:
+                gdf = gpd.GeoDataFrame(
+                    {'uid': [int(value) for value, _ in polygons], 'tile_row': index},
+                    geometry=transform_geometries(np.array([polygon for _, polygon in polygons], dtype=object), src.transform),
+                    crs=src.crs,
+                )
+                gdf.to_file(vectors, layer=LAYER, driver='GPKG', mode='a' if os.path.exists(vectors) else 'w')
+
+            job.progress.update(rows_done=index + 1, tiles_done=job.progress['tiles_done'] + len(rows[index]))
+            job.save()
+
+    rasterio.shutil.copy(partial_mask, mask, driver='COG', compress='deflate', overview_resampling='nearest')
+    os.remove(partial_mask)
+    job.outputs = {'mask': mask, 'vectors': vectors if os.path.exists(vectors) else None,
+                   'skipped': pipeline.stats.get('skipped')}
@@ -0,0 +1,38 @@
+"""Fast JSON serialization for the Flask app, using orjson when it is installed."""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, falls back to the standard library encoder if orjson is not installed or if
+    encoder options are passed. Keys are not sorted, as the order of the features does not matter to the clients."""
+
+    sort_keys = False
+    options = 0 if orjson is None else orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(self, obj) -> bytes:
+        """Serialize obj to UTF-8 encoded JSON"""
+        if orjson is None:
+            return super().dumps(obj).encode('utf-8')
+        return orjson.dumps(obj, default=self.default, option=self.options)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Same as DefaultJSONProvider.response, but without decoding and re-encoding the serialized bytes"""
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,278 @@
+"""Interactive sessions that keep an image and its embedding in memory between prompts.
+
+A session is opened once per image: the image is decoded, the model is loaded and the image is embedded. The prompts
+sent to the session afterwards only run the prompt encoder and mask decoder. Sessions that are idle for longer than the
+timeout are closed by a background thread, and the least recently used session is closed when the maximum number of
+sessions is reached. Models are shared by the sessions using them and released with the last of them.
+
+Every session caches its decoded objects by their prompts. An object whose prompts did not change since the last
+request is neither decoded nor vectorized again, and an object with an added or removed point is decoded from the
+low resolution logits of its closest cached prompt set, like the interactive loop of SAM.
+
+Sessions live in the memory of the server worker that opened them. The workers share a directory with a marker file
+per open session holding the process and manager that opened it, so a worker receiving a request for a session of
+another worker reports it instead of answering as if the session had been closed.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, FrozenSet, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from easyearth.core.metrics import cache_lookup
+
+logger = logging.getLogger("easyearth")
+
+
+# prompts of one object: the set of its points (x, y, label) and its box (x_min, y_min, x_max, y_max) or None
+PromptKey = Tuple[FrozenSet[Tuple[float, float, int]], Optional[Tuple[float, ...]]]
+
+
+class PromptCache:
+    """Decoded objects of a session by their prompts, least recently used entries are dropped first"""
+
+    def __init__(self, max_entries: int = 128):
+        """Initialize the cache
+        Args:
+            max_entries: Maximum number of cached objects
+        """
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[PromptKey, Dict[str, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(points: Optional[Any] = None, labels: Optional[Any] = None, box: Optional[Any] = None) -> PromptKey:
+        """Key of the prompts of one object, independent of the order of its points"""
+        points = np.asarray(points if points is not None else [], dtype=np.float64).reshape(-1, 2)
+        labels = np.asarray(labels if labels is not None else [1] * len(points)).reshape(-1)
+        box = tuple(np.asarray(box, dtype=np.float64).reshape(-1).tolist()) if box is not None else None
+        return frozenset(zip(points[:, 0].tolist(), points[:, 1].tolist(), labels.astype(int).tolist())), box
+
+    def get(self, key: PromptKey) -> Optional[Dict[str, Any]]:
+        """Cached object of exactly these prompts"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        cache_lookup('session_objects', entry is not None)
+        return entry
+
+    def closest(self, key: PromptKey) -> Optional[Dict[str, Any]]:
+        """Cached object with the same box and the fewest added or removed points, to refine its mask"""
+        points, box = key
+        candidates = [(len(points ^ other_points), entry) for (other_points, other_box), entry in self.entries.items()
+                      if other_box == box and (points <= other_points or other_points <= points)]
+        return min(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+    def put(self, key: PromptKey, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Cache a decoded object"""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+
+class Session:
+    """An image pinned in memory with its model and embedding"""
+
+    def __init__(self,
+                 model_key: Hashable,
+                 model: Any,
+                 image: Any,
+                 image_embeddings: Any = None,
+                 image_sizes: Any = None,
+                 transform: Any = None,
+                 crs: Optional[str] = None,
+                 request: Optional[Dict[str, Any]] = None,
+                 cache_size: int = 128):
+        """Initialize a session
+        Args:
+            model_key: Key of the model in the model cache of the manager
+            model: The loaded model
+            image: The decoded image of shape (height, width, 3)
+            image_embeddings: Embedding of the image
+            image_sizes: Sizes of the image needed to prepare prompts, e.g. from Sam.get_image_embeddings
+            transform: Affine transform of the image, None if it is not georeferenced
+            crs: Coordinate reference system of the image
+            request: Parameters the session was opened with
+            cache_size: Maximum number of decoded objects cached by their prompts
+        """
+        self.session_id = uuid.uuid4().hex
+        self.model_key = model_key
+        self.model = model
+        self.image = image
+        self.image_embeddings = image_embeddings
+        self.image_sizes = image_sizes
+        self.transform = transform
+        self.crs = crs
+        self.request = request or {}
+        self.created = datetime.now().isoformat()
+        self.last_used = time.monotonic()
+        self.prompts = 0
+        self.cache = PromptCache(cache_size)
+        # prompts of one session are decoded one at a time
+        self.lock = threading.Lock()
+
+    def touch(self):
+        """Record that the session was used, which postpones its eviction"""
+        self.last_used = time.monotonic()
+
+    def idle(self) -> float:
+        """Seconds since the session was last used"""
+        return time.monotonic() - self.last_used
+
+    def to_dict(self) -> Dict[str, Any]:
+        """State of the session as returned by the API"""
+        return {'session_id': self.session_id, 'image_path': self.request.get('image_path'),
+                'model_path': self.request.get('model_path'), 'image_shape': list(self.image.shape[:2]),
+                'crs': self.crs, 'created': self.created, 'idle_seconds': round(self.idle(), 1), 'prompts': self.prompts,
+                'cache': {'objects': len(self.cache.entries), 'hits': self.cache.hits, 'misses': self.cache.misses}}
+
+
+class SessionManager:
+    """Keeps the open sessions, closes idle ones and shares models between sessions"""
+
+    def __init__(self, idle_timeout: float = 900, max_sessions: int = 8, directory: Optional[str] = None):
+        """Initialize the manager
+        Args:
+            idle_timeout: Sessions not used for this many seconds are closed
+            max_sessions: Maximum number of open sessions, the least recently used session is closed to open another
+            directory: Optional directory of the session markers shared by the server workers
+        """
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.directory = directory
+        self.token = f"{os.getpid()}:{uuid.uuid4().hex}"
+        self.sessions: 'OrderedDict[str, Session]' = OrderedDict()
+        self.models: Dict[Hashable, Any] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _marker(self, session_id: str) -> str:
+        """Path of the marker of a session, named by its hash as the ids of the requests come from the clients"""
+        return os.path.join(self.directory, hashlib.sha1(session_id.encode('utf-8')).hexdigest())
+
+    def holder(self, session_id: str) -> Optional[int]:
+        """Process id of the running worker holding a session that this manager does not hold, else None"""
+        if self.directory is None:
+            return None
+        with self.lock:
+            if session_id in self.sessions:
+                return None
+        try:
+            with open(self._marker(session_id)) as f:
+                holder = f.read()
+            pid = int(holder.split(':', 1)[0])
+        except (OSError, ValueError):
+            return None
+        if holder == self.token:
+            # closed by this manager meanwhile
+            return None
+        try:
+            # a worker that stopped took its sessions with it
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except OSError:
+            pass
+        return pid
+
+    def _write_marker(self, session_id: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._marker(session_id)
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.token)
+        os.replace(path + '.tmp', path)
+
+    def _remove_marker(self, session_id: str):
+        try:
+            os.remove(self._marker(session_id))
+        except OSError:
+            pass
+
+    def _start(self):
+        """Start the eviction thread on first use"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._evict_idle_forever, name="session-eviction", daemon=True)
+            self.thread.start()
+
+    def get_model(self, model_key: Hashable, load: Callable[[], Any]) -> Any:
+        """Get the model of an open session, or load it. The model is cached once a session using it is added."""
+        with self.lock:
+            model = self.models.get(model_key)
+        # loading takes long, it is done without holding the lock
+        return model if model is not None else load()
+
+    def add(self, session: Session) -> Session:
+        """Register an opened session, closing the least recently used sessions above max_sessions"""
+        with self.lock:
+            session.model = self.models.setdefault(session.model_key, session.model)
+            self.sessions[session.session_id] = session
+            if self.directory is not None:
+                self._write_marker(session.session_id)
+            while len(self.sessions) > self.max_sessions:
+                session_id, _ = next(iter(self.sessions.items()))
+                logger.info(f"Closing least recently used session {session_id}")
+                self._remove(session_id)
+            self._start()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Get a session by id and mark it as used"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.touch()
+                self.sessions.move_to_end(session_id)
+        return session
+
+    def list(self) -> List[Session]:
+        """All open sessions, least recently used first"""
+        with self.lock:
+            return list(self.sessions.values())
+
+    def find(self, model_key: Hashable, image_path: str) -> Optional[Session]:
+        """An open session on the same image with the same model, whose image and embedding can be shared"""
+        with self.lock:
+            return next((session for session in reversed(self.sessions.values())
+                         if session.model_key == model_key and session.request.get('image_path') == image_path), None)
+
+    def close(self, session_id: str) -> Optional[Session]:
+        """Close a session, freeing its image and embedding, and its model if no other session uses it"""
+        with self.lock:
+            return self._remove(session_id)
+
+    def evict_idle(self) -> List[str]:
+        """Close the sessions idle for longer than the timeout"""
+        with self.lock:
+            expired = [session_id for session_id, session in self.sessions.items() if session.idle() > self.idle_timeout]
+            for session_id in expired:
+                logger.info(f"Closing idle session {session_id}")
+                self._remove(session_id)
+        return expired
+
+    def _remove(self, session_id: str) -> Optional[Session]:
+        session = self.sessions.pop(session_id, None)
+        if session is not None and self.directory is not None:
+            self._remove_marker(session_id)
+        if session is not None and all(other.model_key != session.model_key for other in self.sessions.values()):
+            self.models.pop(session.model_key, None)
+        return session
+
+    def _evict_idle_forever(self):
+        while True:
+            time.sleep(max(1.0, min(60.0, self.idle_timeout / 4)))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"Failed to close idle sessions: {str(e)}")
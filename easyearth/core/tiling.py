@@ -0,0 +1,365 @@
+"""Sliding-window inference over large rasters with logit blending across tile seams.
+
+Tiles are read one row of tiles at a time, either from an in-memory array or from rasterio windows of an open dataset,
+so only a strip of the image is ever held in memory. Overlapping logits are blended with weights that ramp down
+towards the tile borders, and the rows of the label map are emitted as soon as no later tile can change them.
+Tiles that are entirely nodata, uniform or cloudy can be skipped before inference with a TileFilter, their pixels
+get the background label.
+"""
+import math
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+
+# A tiled image source: an array of shape (height, width, bands) or an open rasterio dataset
+ImageSource = Union[np.ndarray, DatasetReader]
+
+# Computes the logits of a batch of tiles: list of (height, width, 3) arrays -> (batch, classes, height, width)
+PredictLogits = Callable[[List[np.ndarray]], torch.Tensor]
+
+
+def tile_offsets(size: int, tile_size: int, overlap: int) -> List[int]:
+    """Start offsets of the tiles along one dimension, the last tile is aligned with the end of the image
+    Args:
+        size: Size of the image dimension
+        tile_size: Size of the tiles, clipped to the image size
+        overlap: Overlap between neighbouring tiles in pixels
+    Returns:
+        Sorted list of start offsets
+    """
+    tile_size = min(tile_size, size)
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"Overlap ({overlap}) must be smaller than the tile size ({tile_size})")
+    offsets = list(range(0, size - tile_size, stride))
+    offsets.append(size - tile_size)
+    return offsets
+
+
+def tile_windows(height: int, width: int, tile_size: int, overlap: int) -> List[List[Window]]:
+    """Windows of the tiles covering an image, grouped by rows of tiles"""
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    cols = tile_offsets(width, tile_size, overlap)
+    return [[Window(col, row, tile_width, tile_height) for col in cols] for row in tile_offsets(height, tile_size, overlap)]
+
+
+def blend_weights(height: int, width: int, overlap: int) -> torch.Tensor:
+    """Weights of a tile that ramp down linearly across the overlap towards the borders, never reaching zero"""
+    def ramp(size):
+        position = torch.arange(size, dtype=torch.float32) + 0.5
+        return torch.minimum(position, size - position).div(max(overlap, 1)).clamp(max=1.0)
+
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+
+def image_size(image: ImageSource) -> Tuple[int, int]:
+    """Size (height, width) of a tiled image source"""
+    if isinstance(image, np.ndarray):
+        return image.shape[0], image.shape[1]
+    return image.height, image.width
+
+
+def read_window(image: ImageSource, window: Window) -> np.ndarray:
+    """Read a window of a tiled image source as an RGB array of shape (height, width, 3)"""
+    if isinstance(image, np.ndarray):
+        tile = image[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+    else:
+        tile = np.transpose(image.read(window=window), (1, 2, 0))
+    if tile.ndim == 2:
+        tile = tile[:, :, np.newaxis]
+    if tile.shape[2] == 1:
+        tile = np.repeat(tile, 3, axis=2)
+    return np.ascontiguousarray(tile[:, :, :3])
+
+
+def read_valid(image: ImageSource, window: Window) -> Optional[np.ndarray]:
+    """Valid data mask of a window of shape (height, width), or None if every pixel is valid"""
+    if isinstance(image, np.ndarray):
+        return None
+    valid = image.dataset_mask(window=window) > 0
+    return None if valid.all() else valid
+
+
+def merge_windows(boxes: Sequence[Sequence[float]], height: int, width: int) -> List[Tuple[Window, List[Window]]]:
+    """Merge overlapping or touching boxes into the windows to read, so every pixel is read and predicted once
+    Args:
+        boxes: Boxes (x_min, y_min, x_max, y_max) in pixels, clipped to the image and rounded outwards
+        height: Image height
+        width: Image width
+    Returns:
+        List of (merged window, windows of the boxes it contains), empty boxes are dropped
+    """
+    groups = []
+    for x0, y0, x1, y1 in boxes:
+        x_min, y_min = max(0, math.floor(min(x0, x1))), max(0, math.floor(min(y0, y1)))
+        x_max, y_max = min(width, math.ceil(max(x0, x1))), min(height, math.ceil(max(y0, y1)))
+        if x_max > x_min and y_max > y_min:
+            groups.append(((x_min, y_min, x_max, y_max), [Window(x_min, y_min, x_max - x_min, y_max - y_min)]))
+
+    # merging two boxes can make their bounding box overlap a third one, repeat until no box touches another
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                (a, members_a), (b, members_b) = groups[i], groups[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    groups[i] = ((min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])), members_a + members_b)
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [(Window(x_min, y_min, x_max - x_min, y_max - y_min), members)
+            for (x_min, y_min, x_max, y_max), members in groups]
+
+
+# (row index, window, tile or None if skipped before reading, valid data mask or None if all valid, reason to skip)
+ScreenedTile = Tuple[int, Window, Optional[np.ndarray], Optional[np.ndarray], Optional[str]]
+
+
+class TileFilter:
+    """Decides which tiles are not worth running the model on: entirely nodata, (nearly) uniform or cloudy tiles"""
+
+    def __init__(self,
+                 skip_nodata: bool = True,
+                 min_std: float = 0.0,
+                 cloud_brightness: Optional[float] = None,
+                 max_cloud_fraction: float = 0.9,
+                 overview_factor: int = 16):
+        """Initialize the filter
+        Args:
+            skip_nodata: Skip tiles without any valid pixel according to the dataset mask
+            min_std: Skip tiles whose valid pixels have a standard deviation at most this value, 0 only skips
+                perfectly uniform tiles
+            cloud_brightness: Pixels with all bands at least this bright count as cloud, None disables the check
+            max_cloud_fraction: Skip tiles with at least this fraction of cloud pixels
+            overview_factor: Decimation of the dataset mask read once before the tiles, to skip nodata tiles
+                without reading them. Uses the overviews of the raster if it has any.
+        """
+        self.skip_nodata = skip_nodata
+        self.min_std = min_std
+        self.cloud_brightness = cloud_brightness
+        self.max_cloud_fraction = max_cloud_fraction
+        self.overview_factor = overview_factor
+
+    @classmethod
+    def from_options(cls, options: Optional[Dict] = None) -> 'TileFilter':
+        """Create a filter from the options of a request, unknown keys are ignored"""
+        options = options or {}
+        keys = ('skip_nodata', 'min_std', 'cloud_brightness', 'max_cloud_fraction', 'overview_factor')
+        return cls(**{key: options[key] for key in keys if options.get(key) is not None})
+
+    def prescreen(self, image: ImageSource, rows: List[List[Window]]) -> Dict[Tuple[int, int], str]:
+        """Tiles that are nodata according to a decimated read of the dataset mask
+        Returns:
+            Dictionary of (row_off, col_off) -> 'nodata'
+        """
+        if not self.skip_nodata or isinstance(image, np.ndarray):
+            return {}
+        factor = max(1, self.overview_factor)
+        out_shape = (max(1, image.height // factor), max(1, image.width // factor))
+        # average resampling keeps a decimated pixel valid if any of its pixels is valid
+        valid = image.dataset_mask(out_shape=out_shape, resampling=Resampling.average) > 0
+        if valid.all():
+            return {}
+        scale_y, scale_x = out_shape[0] / image.height, out_shape[1] / image.width
+
+        skipped = {}
+        for window in (window for row in rows for window in row):
+            # one decimated pixel of margin around the tile
+            row_start = max(0, int(window.row_off * scale_y) - 1)
+            row_stop = int(np.ceil((window.row_off + window.height) * scale_y)) + 1
+            col_start = max(0, int(window.col_off * scale_x) - 1)
+            col_stop = int(np.ceil((window.col_off + window.width) * scale_x)) + 1
+            if not valid[row_start:row_stop, col_start:col_stop].any():
+                skipped[(window.row_off, window.col_off)] = 'nodata'
+        return skipped
+
+    def check(self, tile: np.ndarray, valid: Optional[np.ndarray]) -> Optional[str]:
+        """Reason to skip a tile that was read, or None to run the model on it
+        Args:
+            tile: RGB tile of shape (height, width, 3)
+            valid: Valid data mask of shape (height, width), or None if every pixel is valid
+        """
+        pixels = tile.reshape(-1, tile.shape[2]) if valid is None else tile[valid]
+        if len(pixels) == 0:
+            return 'nodata' if self.skip_nodata else None
+        if pixels.std(axis=0).max() <= self.min_std:
+            return 'uniform'
+        if self.cloud_brightness is not None:
+            cloud = (pixels.min(axis=1) >= self.cloud_brightness).mean()
+            if cloud >= self.max_cloud_fraction:
+                return 'cloud'
+        return None
+
+
+def screen_tiles(image: ImageSource,
+                 rows: List[List[Window]],
+                 tile_filter: Optional[TileFilter] = None,
+                 first: int = 0) -> Iterator[ScreenedTile]:
+    """Read the tiles row by row, with their valid data mask and the reason to skip them, if any
+    Tiles found to be nodata by the prescreen of the filter are not read at all.
+    """
+    skipped = tile_filter.prescreen(image, rows[first:]) if tile_filter is not None else {}
+    for index, row in enumerate(rows[first:], start=first):
+        for window in row:
+            reason = skipped.get((window.row_off, window.col_off))
+            if reason is not None:
+                yield index, window, None, None, reason
+                continue
+            tile, valid = read_window(image, window), read_valid(image, window)
+            yield index, window, tile, valid, tile_filter.check(tile, valid) if tile_filter is not None else None
+
+
+def skipped_report(reasons: Counter, total: int) -> Dict[str, float]:
+    """Number of skipped tiles per reason and the fraction of the tiles that were skipped"""
+    skipped = sum(reasons.values())
+    return {**{reason: reasons.get(reason, 0) for reason in ('nodata', 'uniform', 'cloud')},
+            'tiles': skipped, 'total': total, 'fraction': round(skipped / total, 4) if total else 0.0}
+
+
+def _batches(items: Sequence, batch_size: int):
+    """Split a sequence into batches"""
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+class StripBlender:
+    """Blends the logits of overlapping tiles, one row of tiles at a time, and emits the final rows of the label map"""
+
+    def __init__(self, height: int, width: int, overlap: int, tile_shape: Tuple[int, int], label_dtype=np.uint8,
+                 base: int = 0, with_confidence: bool = False):
+        """Initialize the blender
+        Args:
+            height: Image height
+            width: Image width
+            overlap: Overlap between neighbouring tiles in pixels
+            tile_shape: Size (height, width) of the tiles
+            label_dtype: Data type of the label map
+            base: First row of the image covered by the tiles that will be added
+            with_confidence: Also return the softmax probability of the label of every pixel
+        """
+        self.height, self.width = height, width
+        self.weights = blend_weights(tile_shape[0], tile_shape[1], overlap)
+        self.label_dtype = label_dtype
+        self.with_confidence = with_confidence
+        # running sums of the current strip, starting at image row `base`
+        self.base, self.logits_sum, self.weights_sum, self.invalid = base, None, None, None
+
+    def add(self, windows: Sequence[Window], logits: torch.Tensor, valid: Optional[Sequence[Optional[np.ndarray]]] = None):
+        """Add the logits of a batch of tiles of shape (batch, classes, height, width)
+        Args:
+            windows: Windows of the tiles
+            logits: Logits of the tiles
+            valid: Optional valid data masks of the tiles, None for tiles where every pixel is valid. Invalid
+                pixels get the background label.
+        """
+        logits = logits.float().cpu()
+        if self.logits_sum is None or self.logits_sum.shape[0] != logits.shape[1]:
+            # the first logits, the strip may only hold zeros of skipped tiles so far
+            rows = 0 if self.weights_sum is None else self.weights_sum.shape[0]
+            self.logits_sum = torch.zeros((logits.shape[1], rows, self.width))
+            if self.weights_sum is None:
+                self.weights_sum = torch.zeros((0, self.width))
+                self.invalid = torch.zeros((0, self.width), dtype=torch.bool)
+
+        for window, tile_logits, tile_valid in zip(windows, logits, valid or [None] * len(windows)):
+            row_start, row_stop = window.row_off - self.base, window.row_off + window.height - self.base
+            # grow the strip down to the bottom of the tile
+            if row_stop > self.weights_sum.shape[0]:
+                self._grow(row_stop)
+            cols = slice(window.col_off, window.col_off + window.width)
+            self.logits_sum[:, row_start:row_stop, cols] += tile_logits * self.weights
+            self.weights_sum[row_start:row_stop, cols] += self.weights
+            if tile_valid is not None:
+                self.invalid[row_start:row_stop, cols] |= torch.from_numpy(~tile_valid)
+
+    def finish(self, row: int) -> Optional[Tuple[int, np.ndarray]]:
+        """Labels of the rows above ``row``, once no later tile can change them
+        Returns:
+            Tuple of (first row, label strip of shape (rows, width)), or None if there are no new final rows. With
+            with_confidence, the tuple also holds the confidence strip (float16) of the same shape.
+        """
+        if row <= self.base:
+            return None
+        final = row - self.base
+        if self.weights_sum is None or self.weights_sum.shape[0] < final:
+            # no tile was added for some of the rows, e.g. skipped tiles
+            self._grow(final)
+        # pixels not covered by any tile have zero logits, and get the first label
+        logits = self.logits_sum[:, :final] / self.weights_sum[:final].clamp(min=1e-6)
+        labels = logits.argmax(dim=0)
+        labels[self.invalid[:final]] = 0
+        strip = (self.base, labels.numpy().astype(self.label_dtype))
+        if self.with_confidence:
+            strip += (logits.softmax(dim=0).amax(dim=0).numpy().astype(np.float16),)
+        self.logits_sum, self.weights_sum, self.invalid = self.logits_sum[:, final:], self.weights_sum[final:], self.invalid[final:]
+        self.base = row
+        return strip
+
+    def _grow(self, rows: int):
+        """Make the strip at least ``rows`` rows high, before any logits are known there is a single class"""
+        if self.weights_sum is None:
+            self.logits_sum = torch.zeros((1, 0, self.width))
+            self.weights_sum = torch.zeros((0, self.width))
+            self.invalid = torch.zeros((0, self.width), dtype=torch.bool)
+        missing = rows - self.weights_sum.shape[0]
+        self.logits_sum = torch.cat([self.logits_sum, torch.zeros((self.logits_sum.shape[0], missing, self.width))], dim=1)
+        self.weights_sum = torch.cat([self.weights_sum, torch.zeros((missing, self.width))], dim=0)
+        self.invalid = torch.cat([self.invalid, torch.zeros((missing, self.width), dtype=torch.bool)], dim=0)
+
+
+def finished_row(rows: List[List[Window]], index: int, height: int) -> int:
+    """Row of the image above which the labels are final once the row of tiles ``index`` is done"""
+    return rows[index + 1][0].row_off if index + 1 < len(rows) else height
+
+
+def blended_label_strips(image: ImageSource,
+                         predict: PredictLogits,
+                         tile_size: int = 512,
+                         overlap: int = 64,
+                         batch_size: int = 4,
+                         label_dtype=np.uint8,
+                         tile_filter: Optional[TileFilter] = None,
+                         report: Optional[Dict] = None,
+                         with_confidence: bool = False) -> Iterator[Tuple[int, np.ndarray]]:
+    """Sliding-window segmentation of an image, yielding the label map in horizontal strips
+    Memory is bounded by one row of tiles: (classes, tile_size, width) blended logits.
+    Args:
+        image: Array of shape (height, width, bands) or an open rasterio dataset
+        predict: Function computing the logits of a batch of tiles at tile resolution
+        tile_size: Size of the tiles in pixels
+        overlap: Overlap between neighbouring tiles in pixels, blended across the seams
+        batch_size: Number of tiles per call of predict
+        label_dtype: Data type of the label map
+        tile_filter: Optional filter of the tiles to skip, nodata pixels always get the background label
+        report: Optional dictionary, filled with the skipped tiles (see skipped_report) once the iterator is exhausted
+        with_confidence: Also yield the softmax probability of the label of every pixel
+    Returns:
+        Iterator of (first row, label strip of shape (rows, width)), covering the image from top to bottom, with the
+        confidence strip as third element if with_confidence is set
+    """
+    height, width = image_size(image)
+    rows = tile_windows(height, width, tile_size, overlap)
+    blender = StripBlender(height, width, overlap, (rows[0][0].height, rows[0][0].width), label_dtype,
+                           with_confidence=with_confidence)
+    tiles = screen_tiles(image, rows, tile_filter)
+    reasons = Counter()
+    for index, row in enumerate(rows):
+        screened = [next(tiles) for _ in row]
+        reasons.update(reason for _, _, _, _, reason in screened if reason is not None)
+        computed = [item for item in screened if item[4] is None]
+        for batch in _batches(computed, batch_size):
+            blender.add([window for _, window, _, _, _ in batch], predict([tile for _, _, tile, _, _ in batch]),
+                        [valid for _, _, _, valid, _ in batch])
+        strip = blender.finish(finished_row(rows, index, height))
+        if strip is not None:
+            yield strip
+    if report is not None:
+        report.update(skipped_report(reasons, sum(len(row) for row in rows)))
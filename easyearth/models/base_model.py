@@ -1,18 +1,30 @@
 """Base class for segmentation models"""
 from collections import defaultdict
+from contextlib import contextmanager
 
 import shapely
 import torch
 from PIL import Image
 import numpy as np
 import geopandas as gpd
+import rasterio
 from rasterio import features
+from rasterio.windows import Window
 import logging
 from typing import Optional, Union, List, Dict, Any
 from pathlib import Path
 import os
+import threading
 import warnings
 import torch.backends.mps
+import base64
+from easyearth.core.cancellation import acquire
+from easyearth.core.metrics import stage
+try:
+    from .postprocess import label_bounding_boxes, rle_encode
+except ImportError:
+    # For direct script execution
+    from postprocess import label_bounding_boxes, rle_encode
 
 class BaseModel:
     def __init__(self, model_path: str):
@@ -36,6 +48,26 @@ class BaseModel:
 
         self.logger.info(f"Model cache directory: {self.cache_dir}")
 
+        # forward passes of concurrent requests take turns, see compute
+        self.compute_slots = threading.BoundedSemaphore(int(os.environ.get('MODEL_CONCURRENCY', 1)))
+
+    @contextmanager
+    def compute(self):
+        """Context of a forward pass of the model, without gradients
+        At most MODEL_CONCURRENCY (1 by default) forward passes of the model run at the same time, each with all torch
+        threads. The pre- and post-processing of requests, e.g. post_process_masks and polygonization, run outside of
+        it, so they overlap with the forward pass of another request instead of competing with it for the cores.
+        A cancelled request stops here, also while it waits for its turn, see easyearth.core.cancellation. The waiting
+        and the forward pass are timed as the stages 'wait_model' and 'compute' of the request.
+        """
+        with stage('wait_model'):
+            acquire(self.compute_slots)
+        try:
+            with stage('compute'), torch.no_grad():
+                yield
+        finally:
+            self.compute_slots.release()
+
     # TODO: figure out why GPU is not working on my computer
     def _setup_cuda(self):
         """Setup CUDA environment before initialization"""
@@ -81,20 +113,13 @@ class BaseModel:
         self.logger.info("Using CPU device")
         return torch.device("cpu")
 
-    def raster_to_vector(self, 
-                        masks: Union[List[np.ndarray], List[torch.Tensor]],
-                        img_transform: Optional[Any] = None, 
-                        filename: Optional[str] = None) -> List[Dict]:
-        """Converts a raster mask to a vector mask
+    def to_label_map(self, masks: Union[List[np.ndarray], List[torch.Tensor]]) -> np.ndarray:
+        """Converts the masks of a model to a 2D label map
         Args:
             masks: predictions from the segmentation model in hugging face format
-            img_transform: Optional transform for georeferencing
-            filename: Optional filename (including directory path) to save GeoJSON
-        Returns: 
-            List of GeoJSON features
+        Returns:
+            Label map of shape (Height, Width)
         """
-
-        # TODO: need to test if this works for prediction for an entire image (segmentation.py)
         masks = masks[0]
         self.logger.debug(f"masks: {masks}")
 
@@ -107,6 +132,23 @@ class BaseModel:
         # squeeze the masks to remove singleton dimensions
         if masks.ndim > 2:
             masks = np.squeeze(masks, axis=0)
+        return masks
+
+    def raster_to_vector(self, 
+                        masks: Union[List[np.ndarray], List[torch.Tensor]],
+                        img_transform: Optional[Any] = None, 
+                        filename: Optional[str] = None) -> List[Dict]:
+        """Converts a raster mask to a vector mask
+        Args:
+            masks: predictions from the segmentation model in hugging face format
+            img_transform: Optional transform for georeferencing
+            filename: Optional filename (including directory path) to save GeoJSON
+        Returns: 
+            List of GeoJSON features
+        """
+
+        # TODO: need to test if this works for prediction for an entire image (segmentation.py)
+        masks = self.to_label_map(masks)
 
         if img_transform is not None:
             shape_generator = features.shapes(
@@ -152,6 +194,86 @@ class BaseModel:
 
         return geojson
 
+    def raster_to_rle(self,
+                      masks: Union[List[np.ndarray], List[torch.Tensor]],
+                      img_transform: Optional[Any] = None,
+                      encoding: str = "rle") -> Dict[str, Any]:
+        """Encodes the masks without polygonization, one mask per label cropped to its bounding box
+        Args:
+            masks: predictions from the segmentation model in hugging face format
+            img_transform: Optional transform for georeferencing, returned along with the masks
+            encoding: "rle" for COCO compressed run-length encoding (column-major), or "bitmask" for base64 encoded
+                bits of the mask (row-major, numpy.packbits)
+        Returns:
+            Dictionary with the encoding, the image shape (Height, Width), the affine transform (a, b, c, d, e, f) and
+            the masks, each with uid, bbox [x_min, y_min, x_max, y_max] in pixels, size [Height, Width] and counts
+        """
+        if encoding not in ("rle", "bitmask"):
+            raise ValueError(f"Unknown encoding: {encoding}. Available: rle, bitmask")
+
+        labels = self.to_label_map(masks)
+        values, boxes = label_bounding_boxes(labels)
+
+        encoded = []
+        for value, (x_min, y_min, x_max, y_max) in zip(values.tolist(), boxes.tolist()):
+            mask = labels[y_min:y_max, x_min:x_max] == value
+            encoded.append({"uid": value, "bbox": [x_min, y_min, x_max, y_max],
+                            "size": [y_max - y_min, x_max - x_min], "counts": self.encode_mask(mask, encoding)})
+
+        return self.encoded_masks(encoding, labels.shape, img_transform, encoded)
+
+    def raster_file_to_rle(self, path: str, img_transform: Optional[Any] = None, encoding: str = "rle",
+                           strip_rows: int = 1024) -> Dict[str, Any]:
+        """Encodes the label map of a raster on disk like raster_to_rle, without reading it at once: the bounding
+        boxes are computed strip by strip, and every mask is read within its bounding box
+        Args:
+            path: Path of a single band label raster, e.g. written by Segmentation.get_masks_tiled
+            img_transform: Optional transform for georeferencing, returned along with the masks
+            encoding: "rle" or "bitmask", see raster_to_rle
+            strip_rows: Number of rows read at once for the bounding boxes
+        Returns:
+            Dictionary like raster_to_rle
+        """
+        if encoding not in ("rle", "bitmask"):
+            raise ValueError(f"Unknown encoding: {encoding}. Available: rle, bitmask")
+
+        with rasterio.open(path) as src:
+            boxes = {}
+            for row in range(0, src.height, strip_rows):
+                strip = src.read(1, window=Window(0, row, src.width, min(strip_rows, src.height - row)))
+                values, strip_boxes = label_bounding_boxes(strip)
+                for value, (x_min, y_min, x_max, y_max) in zip(values.tolist(), strip_boxes.tolist()):
+                    box = [x_min, y_min + row, x_max, y_max + row]
+                    if value in boxes:
+                        box = [min(boxes[value][0], box[0]), boxes[value][1], max(boxes[value][2], box[2]), box[3]]
+                    boxes[value] = box
+
+            encoded = []
+            for value in sorted(boxes):
+                x_min, y_min, x_max, y_max = boxes[value]
+                mask = src.read(1, window=Window(x_min, y_min, x_max - x_min, y_max - y_min)) == value
+                encoded.append({"uid": value, "bbox": [x_min, y_min, x_max, y_max],
+                                "size": [y_max - y_min, x_max - x_min], "counts": self.encode_mask(mask, encoding)})
+
+            return self.encoded_masks(encoding, (src.height, src.width), img_transform, encoded)
+
+    @staticmethod
+    def encode_mask(mask: np.ndarray, encoding: str = "rle") -> str:
+        """Encode a boolean mask as COCO compressed run-length encoding ("rle") or base64 packed bits ("bitmask")"""
+        if encoding == "rle":
+            return rle_encode(mask)
+        return base64.b64encode(np.packbits(mask, axis=None).tobytes()).decode("ascii")
+
+    @staticmethod
+    def encoded_masks(encoding: str, shape, img_transform: Optional[Any], masks: List[Dict]) -> Dict[str, Any]:
+        """Response of raster_to_rle for masks encoded with encode_mask, shape is the image shape (Height, Width)"""
+        return {
+            "encoding": encoding,
+            "shape": list(shape),
+            "transform": list(img_transform)[:6] if img_transform is not None else None,
+            "masks": masks,
+        }
+
     def get_masks(self, image: Union[str, Path, Image.Image, np.array]):
         """Get masks for input image - to be implemented by child classes
         Args:
@@ -8,7 +8,7 @@ import numpy as np
 import requests
 from PIL import Image
 from ultralytics import SAM
-from typing import Union, List
+from typing import Union, List, Optional, Tuple
 from pathlib import Path
 
 try:
@@ -55,7 +55,8 @@ class SAM2(BaseModel):
         Returns:
             list: List of masks (numpy arrays) for the segmented objects.
         """
-        results = self.model(image, bboxes=bboxes, points=points, labels=labels)
+        with self.compute():
+            results = self.model(image, bboxes=bboxes, points=points, labels=labels)
 
         masks = []
         for result in results:
@@ -65,6 +66,33 @@ class SAM2(BaseModel):
             masks.append(mask)
         return masks
 
+    def generate_masks(self, image: Union[str, Image.Image, np.ndarray]) -> List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]]:
+        """Generate the masks of every object of an image without prompts
+        Without prompts, the ultralytics predictor decodes a grid of points in batches, filters the masks by predicted
+        IoU and stability score and suppresses duplicates.
+        Args:
+            image: Path to the image file, or a PIL Image, or a RGB numpy array
+        Returns:
+            List of (score, roi, mask) as in Sam.select_best_masks, with the mask cropped to roi (x_min, y_min, x_max, y_max)
+        """
+        # ultralytics reads numpy arrays as BGR
+        with self.compute():
+            results = self.model(Image.fromarray(image) if isinstance(image, np.ndarray) else image)
+
+        generated = []
+        for result in results:
+            if result.masks is None:
+                continue
+            masks = result.masks.data.cpu().numpy() > 0
+            scores = result.boxes.conf.cpu().numpy() if result.boxes is not None else np.ones(len(masks))
+            for mask, score in zip(masks, scores.tolist()):
+                rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+                if len(rows) == 0:
+                    continue
+                roi = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+                generated.append((score, roi, mask[roi[1]:roi[3], roi[0]:roi[2]]))
+        return generated
+
 
 if __name__ == '__main__':
     # Example usage
@@ -158,8 +158,9 @@ class SamText(BaseModel):
             timestamp = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d_%H%M%S')
             output_path = os.path.join(self.tmp_dir, f"sam-text_{text}_{timestamp}.tif")
             self.logger.info(f"Processing image: {image_path} with text prompt: {text}")
-            self.model.predict(image_path, text, box_threshold=0.24, text_threshold=0.24,
-                               return_results=False, output=output_path, mask_multiplier=1)
+            with self.compute():
+                self.model.predict(image_path, text, box_threshold=0.24, text_threshold=0.24,
+                                   return_results=False, output=output_path, mask_multiplier=1)
             mask_paths.append(output_path)
         return mask_paths, input_text
 
@@ -213,6 +214,19 @@ class SamText(BaseModel):
 
         return geojson
 
+    def raster_to_rle(self, masks_path, img_transform=None, encoding="rle"):
+        """Encode a raster mask file without polygonization.
+        Args:
+            masks_path (str): Path to the raster mask file.
+            img_transform: Optional transformation for georeferencing.
+            encoding (str): "rle" or "bitmask"
+        Returns:
+            Dict[str, Any]: The encoded masks, see BaseModel.raster_to_rle
+        """
+        with rasterio.open(masks_path) as src:
+            band = src.read(1)
+        return super().raster_to_rle([band], img_transform, encoding)
+
 if __name__ == '__main__':
     sam_text = SamText(model_path="facebook/sam-vit-b")
     image_path = "/home/yan/Downloads/easyearth_data/easyearth_base/images/sam_text.tif"
@@ -0,0 +1,235 @@
+"""Memory-bounded post-processing helpers shared by the models.
+
+The hugging face processors upsample whole logit volumes to the original image size before thresholding or
+taking the argmax. The helpers below evaluate the same bilinear resize (``align_corners=False``) only on a window of
+the output, so callers can work on a region of interest or in tiles.
+"""
+import math
+from typing import Tuple
+
+import numpy as np
+import torch
+
+
+def _source_indices(start: int, stop: int, in_size: int, out_size: int, device=None):
+    """Source indices and weights used by ``F.interpolate(mode="bilinear", align_corners=False)``
+    Args:
+        start: First output index of the window
+        stop: Output index after the last one of the window
+        in_size: Size of the input dimension
+        out_size: Size of the full output dimension
+    Returns:
+        Tuple of (lower index, upper index, weight of the upper index)
+    """
+    dst = torch.arange(start, stop, dtype=torch.float32, device=device)
+    src = ((dst + 0.5) * (in_size / out_size) - 0.5).clamp(min=0)
+    lower = src.floor().long().clamp(max=in_size - 1)
+    upper = (lower + 1).clamp(max=in_size - 1)
+    weight = src - lower
+    return lower, upper, weight
+
+
+def _interpolate_dim(x: torch.Tensor, dim: int, lower, upper, weight) -> torch.Tensor:
+    """Linear interpolation of ``x`` along ``dim`` using precomputed source indices"""
+    shape = [1] * x.ndim
+    shape[dim] = -1
+    weight = weight.view(shape).to(x.dtype)
+    return x.index_select(dim, lower) * (1 - weight) + x.index_select(dim, upper) * weight
+
+
+def source_window(window: Tuple[int, int, int, int], in_size: Tuple[int, int], out_size: Tuple[int, int]):
+    """Input window needed to evaluate a bilinear resize on an output window
+    Args:
+        window: Output window (row_start, row_stop, col_start, col_stop)
+        in_size: Input size (height, width)
+        out_size: Output size (height, width)
+    Returns:
+        Input window (row_start, row_stop, col_start, col_stop)
+    """
+    row_start, row_stop, col_start, col_stop = window
+    rows = _source_indices(row_start, row_stop, in_size[0], out_size[0])
+    cols = _source_indices(col_start, col_stop, in_size[1], out_size[1])
+    return int(rows[0].min()), int(rows[1].max()) + 1, int(cols[0].min()), int(cols[1].max()) + 1
+
+
+def resize_window(x: torch.Tensor,
+                  out_size: Tuple[int, int],
+                  window: Tuple[int, int, int, int],
+                  offset: Tuple[int, int] = (0, 0),
+                  in_size: Tuple[int, int] = None) -> torch.Tensor:
+    """Evaluate ``F.interpolate(x, out_size, mode="bilinear", align_corners=False)`` on a window of the output only
+    Args:
+        x: Tensor of shape (..., height, width), or a crop of it starting at ``offset``
+        out_size: Full output size (height, width)
+        window: Output window (row_start, row_stop, col_start, col_stop)
+        offset: Position of ``x`` in the full input, if ``x`` is a crop
+        in_size: Full input size (height, width), defaults to the size of ``x``
+    Returns:
+        Tensor of shape (..., row_stop - row_start, col_stop - col_start)
+    """
+    in_size = in_size or tuple(x.shape[-2:])
+    row_start, row_stop, col_start, col_stop = window
+    lower, upper, weight = _source_indices(row_start, row_stop, in_size[0], out_size[0], x.device)
+    x = _interpolate_dim(x, x.ndim - 2, lower - offset[0], upper - offset[0], weight)
+    lower, upper, weight = _source_indices(col_start, col_stop, in_size[1], out_size[1], x.device)
+    return _interpolate_dim(x, x.ndim - 1, lower - offset[1], upper - offset[1], weight)
+
+
+def mask_roi(low_res_mask: torch.Tensor,
+             valid_size: Tuple[int, int],
+             original_size: Tuple[int, int],
+             margin: int = 16,
+             threshold: float = 0.0):
+    """Bounding box in original pixels that contains every pixel a low resolution mask can switch on
+    Args:
+        low_res_mask: Low resolution logits of shape (height, width)
+        valid_size: Size (height, width) of the part of the low resolution mask not covering padding
+        original_size: Original image size (height, width)
+        margin: Extra margin in original pixels
+        threshold: Threshold used to binarize the logits
+    Returns:
+        (x_min, y_min, x_max, y_max) in original pixels, or None if the mask is empty
+    """
+    positive = low_res_mask[:valid_size[0], :valid_size[1]] > threshold
+    rows = torch.nonzero(positive.any(dim=1)).flatten()
+    cols = torch.nonzero(positive.any(dim=0)).flatten()
+    if rows.numel() == 0:
+        return None
+
+    # bilinear interpolation only reaches one source pixel around a positive one, we keep two per resize stage
+    scale_y = original_size[0] / valid_size[0]
+    scale_x = original_size[1] / valid_size[1]
+    y_min = max(0, math.floor((int(rows[0]) - 2) * scale_y) - margin)
+    y_max = min(original_size[0], math.ceil((int(rows[-1]) + 3) * scale_y) + margin)
+    x_min = max(0, math.floor((int(cols[0]) - 2) * scale_x) - margin)
+    x_max = min(original_size[1], math.ceil((int(cols[-1]) + 3) * scale_x) + margin)
+    return x_min, y_min, x_max, y_max
+
+
+def smallest_label_dtype(max_label: int):
+    """Smallest integer dtype supported by rasterio.features.shapes that holds ``max_label``"""
+    if max_label <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if max_label <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.int32
+
+
+def tiled_label_map(logits: torch.Tensor, out_size: Tuple[int, int], tile_size: int = 1024) -> np.ndarray:
+    """Argmax of the logits upsampled to ``out_size``, computed tile by tile
+    Gives the same labels as upsampling the whole logit volume before the argmax, with memory bounded by the tile size.
+    Args:
+        logits: Class logits of shape (num_classes, height, width)
+        out_size: Output size (height, width)
+        tile_size: Size of the output tiles
+    Returns:
+        Integer label map of shape out_size
+    """
+    labels = np.empty(tuple(out_size), dtype=smallest_label_dtype(logits.shape[0] - 1))
+    for row in range(0, out_size[0], tile_size):
+        for col in range(0, out_size[1], tile_size):
+            window = (row, min(row + tile_size, out_size[0]), col, min(col + tile_size, out_size[1]))
+            tile = resize_window(logits, out_size, window)
+            labels[window[0]:window[1], window[2]:window[3]] = tile.argmax(dim=0).cpu().numpy()
+    return labels
+
+
+def low_res_label_map(logits: torch.Tensor, out_size: Tuple[int, int]) -> np.ndarray:
+    """Argmax at logit resolution, then nearest neighbour upsampling of the label map only
+    Faster than tiled_label_map, but class boundaries are only as accurate as the logit resolution.
+    Args:
+        logits: Class logits of shape (num_classes, height, width)
+        out_size: Output size (height, width)
+    Returns:
+        Integer label map of shape out_size
+    """
+    labels = logits.argmax(dim=0).cpu().numpy().astype(smallest_label_dtype(logits.shape[0] - 1))
+    in_height, in_width = labels.shape
+    rows = np.minimum(((np.arange(out_size[0]) + 0.5) * in_height / out_size[0]).astype(np.int64), in_height - 1)
+    cols = np.minimum(((np.arange(out_size[1]) + 0.5) * in_width / out_size[1]).astype(np.int64), in_width - 1)
+    return labels[rows[:, None], cols[None, :]]
+
+
+def label_agreement(labels: np.ndarray, reference: np.ndarray) -> float:
+    """Fraction of pixels where two label maps agree"""
+    return float(np.mean(np.asarray(labels) == np.asarray(reference)))
+
+
+def label_bounding_boxes(labels: np.ndarray):
+    """Bounding boxes of every non-zero label, computed in a single pass over the label map
+    Args:
+        labels: Integer label map of shape (height, width)
+    Returns:
+        Tuple of (label values, (Label, 4) array of [x_min, y_min, x_max, y_max], max exclusive)
+    """
+    rows, cols = np.nonzero(labels)
+    values, index = np.unique(labels[rows, cols], return_inverse=True)
+    boxes = np.empty((len(values), 4), dtype=np.int64)
+    boxes[:, :2] = np.iinfo(np.int64).max
+    boxes[:, 2:] = -1
+    np.minimum.at(boxes[:, 0], index, cols)
+    np.minimum.at(boxes[:, 1], index, rows)
+    np.maximum.at(boxes[:, 2], index, cols + 1)
+    np.maximum.at(boxes[:, 3], index, rows + 1)
+    return values, boxes
+
+
+def rle_encode(mask: np.ndarray) -> str:
+    """COCO run-length encoding of a binary mask, as the compressed string of pycocotools
+    Args:
+        mask: Binary mask of shape (height, width)
+    Returns:
+        The counts string, decodable with pycocotools.mask.decode({'size': [height, width], 'counts': counts})
+    """
+    pixels = np.asarray(mask, dtype=bool).ravel(order='F')
+    # runs alternate between 0 and 1, starting with 0
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [pixels.size]])
+    counts = np.diff(bounds).tolist()
+    if pixels.size and pixels[0]:
+        counts = [0] + counts
+
+    chars = []
+    for i, count in enumerate(counts):
+        value = count - counts[i - 2] if i > 2 else count
+        more = True
+        while more:
+            char = value & 0x1f
+            value >>= 5
+            more = value != -1 if char & 0x10 else value != 0
+            if more:
+                char |= 0x20
+            chars.append(chr(char + 48))
+    return ''.join(chars)
+
+
+def rle_decode(counts: str, size: Tuple[int, int]) -> np.ndarray:
+    """Decode a COCO compressed run-length encoding
+    Args:
+        counts: The counts string
+        size: Mask size (height, width)
+    Returns:
+        Boolean mask of shape size
+    """
+    runs, position = [], 0
+    while position < len(counts):
+        value, shift, more = 0, 0, True
+        while more:
+            char = ord(counts[position]) - 48
+            value |= (char & 0x1f) << shift
+            more = bool(char & 0x20)
+            position += 1
+            shift += 5
+            if not more and char & 0x10:
+                value |= -1 << shift
+        if len(runs) > 2:
+            value += runs[-2]
+        runs.append(value)
+
+    pixels = np.zeros(size[0] * size[1], dtype=bool)
+    offset = 0
+    for i, run in enumerate(runs):
+        if i % 2:
+            pixels[offset:offset + run] = True
+        offset += run
+    return pixels.reshape(size, order='F')
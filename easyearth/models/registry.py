@@ -0,0 +1,87 @@
+"""Process-wide cache of loaded models.
+
+Requests get their model from here instead of loading it every time, so the weights are read once per process. The
+models listed in PRELOAD_MODELS are loaded by the server before it forks its workers (see
+easyearth/config/gunicorn_config.py), and the workers then share the memory pages of their weights copy-on-write.
+"""
+import importlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple, Type
+
+from easyearth.core.metrics import cache_lookup
+
+logger = logging.getLogger("easyearth")
+
+# module and class of every model_type of /predict, imported on first use as some need optional packages
+MODEL_TYPES = {
+    'sam': ('easyearth.models.sam', 'Sam'),
+    'sam2': ('easyearth.models.easy_sam2', 'SAM2'),
+    'langsam': ('easyearth.models.langsam', 'SamText'),
+    'segment': ('easyearth.models.segmentation', 'Segmentation'),
+}
+
+_models: 'OrderedDict[Tuple[str, str], Any]' = OrderedDict()
+_loading: Dict[Tuple[str, str], threading.Lock] = {}
+_lock = threading.Lock()
+
+
+def get_model_class(model_type: str) -> Type:
+    """Model class of a model_type of /predict"""
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Unknown model_type: {model_type}. Available: {list(MODEL_TYPES.keys())}")
+    module, name = MODEL_TYPES[model_type]
+    return getattr(importlib.import_module(module), name)
+
+
+def get_model(model_class: Type, model_path: str) -> Any:
+    """Get the loaded model of a class and path, loading it on first use
+    Models are loaded once even if several requests ask for them at the same time, and the least recently used models
+    are released when more than MAX_LOADED_MODELS (4 by default) are loaded.
+    """
+    key = (model_class.__name__, model_path)
+    with _lock:
+        model = _models.get(key)
+        cache_lookup('models', model is not None)
+        if model is not None:
+            _models.move_to_end(key)
+            return model
+        loading = _loading.setdefault(key, threading.Lock())
+
+    # other models are served while this one loads
+    with loading:
+        with _lock:
+            model = _models.get(key)
+        if model is None:
+            logger.info(f"Loading {model_class.__name__} model {model_path}")
+            model = model_class(model_path)
+            with _lock:
+                _models[key] = model
+                _loading.pop(key, None)
+                while len(_models) > int(os.environ.get('MAX_LOADED_MODELS', 4)):
+                    released, _ = _models.popitem(last=False)
+                    logger.info(f"Releasing model {released}")
+    return model
+
+
+def loaded_models() -> List[Tuple[str, str]]:
+    """Class names and paths of the loaded models, least recently used first"""
+    with _lock:
+        return list(_models.keys())
+
+
+def preload_models(models: str) -> List[Tuple[str, str]]:
+    """Load models before they are requested
+    Args:
+        models: Comma separated model_type:model_path pairs, e.g. "sam:facebook/sam-vit-base,segment:restor/tcd-segformer-mit-b5"
+    Returns:
+        The loaded models, see loaded_models
+    """
+    for entry in filter(None, (entry.strip() for entry in models.split(','))):
+        model_type, _, model_path = entry.partition(':')
+        if not model_path:
+            raise ValueError(f"Invalid model {entry}, expected model_type:model_path")
+        get_model(get_model_class(model_type), model_path)
+    return loaded_models()
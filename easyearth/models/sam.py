@@ -4,17 +4,85 @@ reference: https://colab.research.google.com/github/huggingface/notebooks/blob/m
 
 try:
     from .base_model import BaseModel
+    from .postprocess import mask_roi, resize_window, smallest_label_dtype, source_window
+    from ..core.automatic import mask_nms, merge_nms, point_grid, stability_score
+    from ..core.metrics import stage
 except ImportError:
     # For direct script execution
     from base_model import BaseModel
+    from postprocess import mask_roi, resize_window, smallest_label_dtype, source_window
+    from easyearth.core.automatic import mask_nms, merge_nms, point_grid, stability_score
+    from easyearth.core.metrics import stage
 from pathlib import Path
 from PIL import Image
-from transformers import SamModel, SamProcessor
-from typing import Optional, List, Tuple, Union, Any
+from transformers import BatchFeature, SamModel, SamProcessor
+from typing import Optional, List, Tuple, Union, Any, Dict, Iterator
+import math
 import numpy as np
+import shapely
+import shapely.geometry
 import torch
 import requests
 import rasterio
+from rasterio import features
+from rasterio.transform import Affine
+
+
+def count_objects(input_points: Optional[List] = None, input_boxes: Optional[List] = None) -> int:
+    """Number of objects prompted by the points or boxes of one image, see chunk_prompts"""
+    if input_boxes is not None:
+        return len(input_boxes[0])
+    if input_points is not None and np.ndim(input_points) == 4:
+        return len(input_points[0])
+    return 1
+
+
+def reshape_labels(input_points: Optional[List] = None, input_labels: Optional[List] = None) -> Optional[List]:
+    """Labels in the shape of the points without their coordinates, e.g. (1, Object, Point) for (1, Object, Point, 2)
+    points, as decode_prompt_arrays gives them. The JSON prompts give the labels of all points as (1, Object).
+    Labels that do not match the number of points are returned unchanged."""
+    if input_points is None or input_labels is None:
+        return input_labels
+    shape = np.shape(input_points)[:-1]
+    if np.size(input_labels) != math.prod(shape):
+        return input_labels
+    return np.reshape(input_labels, shape).tolist()
+
+
+def chunk_prompts(input_points: Optional[List] = None,
+                  input_boxes: Optional[List] = None,
+                  input_labels: Optional[List] = None,
+                  points_per_batch: Optional[int] = None,
+                  boxes_per_batch: Optional[int] = None) -> Iterator[Tuple[int, Optional[List], Optional[List], Optional[List]]]:
+    """Split the prompts of one image into chunks of objects, so that the decoder runs on a bounded number of objects
+    Args:
+        input_points: Point prompts, (1, Object, Point, 2) or (1, Point, 2) for a single object
+        input_boxes: Box prompts, (1, Object, 4)
+        input_labels: Labels of the points, (1, Object, Point) or (1, Object), see reshape_labels
+        points_per_batch: Maximum number of point prompted objects per chunk
+        boxes_per_batch: Maximum number of box prompted objects per chunk, also used for boxes combined with points
+    Returns:
+        Iterator of (index of the first object of the chunk, points, boxes, labels)
+    """
+    num_objects = count_objects(input_points, input_boxes)
+    input_labels = reshape_labels(input_points, input_labels)
+    if input_boxes is not None:
+        chunk_size = boxes_per_batch or points_per_batch
+    elif input_points is not None and np.ndim(input_points) == 4:
+        chunk_size = points_per_batch
+    else:
+        chunk_size = None
+    chunk_size = chunk_size or max(num_objects, 1)
+
+    def chunk(prompts, start):
+        # prompts with one entry per object are sliced, e.g. not the points of a single object
+        if prompts is None or len(prompts[0]) != num_objects:
+            return prompts
+        return [prompts[0][start:start + chunk_size]]
+
+    for start in range(0, max(num_objects, 1), chunk_size):
+        yield start, chunk(input_points, start), chunk(input_boxes, start), chunk(input_labels, start)
+
 
 class Sam(BaseModel):
     def __init__(self, model_path: str = "facebook/sam-vit-huge"):
@@ -45,16 +113,63 @@ class Sam(BaseModel):
             The image embeddings
         """
         inputs = self.processor(raw_image, return_tensors="pt").to(self.device)
-        image_embeddings = self.model.get_image_embeddings(inputs["pixel_values"])
+        with self.compute():
+            image_embeddings = self.model.get_image_embeddings(inputs["pixel_values"])
         return image_embeddings
 
+    def get_image_sizes(self, image_shape: Tuple[int, ...]) -> Tuple[List[int], List[int]]:
+        """(original_size, reshaped_input_size) of an image of shape (height, width, ...) as computed by the processor,
+        so prompts can be prepared without processing the image, see get_prompt_inputs"""
+        image_processor = self.processor.image_processor
+        reshaped_input_size = image_processor._get_preprocess_shape(tuple(image_shape[:2]), image_processor.size["longest_edge"])
+        return list(image_shape[:2]), list(reshaped_input_size)
+
+    def get_prompt_inputs(self,
+                          image: Union[Image.Image, np.ndarray, None],
+                          input_points: Optional[List] = None,
+                          input_boxes: Optional[List] = None,
+                          input_labels: Optional[List] = None,
+                          image_sizes: Optional[Tuple[List[int], List[int]]] = None) -> BatchFeature:
+        """Prepare the prompts of an image for the model, without the pixel values
+        Args:
+            image: The image, only resized and normalized by the processor if image_sizes is not given
+            input_points: Optional point prompts
+            input_boxes: Optional box prompts
+            input_labels: Optional labels
+            image_sizes: Optional (original_size, reshaped_input_size) of the image from get_image_sizes
+        Returns:
+            The processor inputs on the device of the model
+        """
+        input_labels = reshape_labels(input_points, input_labels)
+        if image_sizes is None:
+            inputs = self.processor(image, input_points=input_points, input_boxes=input_boxes,
+                                    input_labels=input_labels, return_tensors="pt")
+            inputs.pop("pixel_values", None)
+        else:
+            # same normalization of the coordinates as the processor, from the sizes of the already processed image
+            original_size, reshaped_input_size = image_sizes
+            points, labels, boxes = self.processor._check_and_preprocess_points(
+                input_points=input_points, input_labels=input_labels, input_boxes=input_boxes)
+            inputs = self.processor._normalize_and_convert(
+                BatchFeature({"original_sizes": torch.tensor([original_size]),
+                              "reshaped_input_sizes": torch.tensor([reshaped_input_size])}),
+                np.array([original_size]), input_points=points, input_labels=labels, input_boxes=boxes,
+                return_tensors="pt")
+
+        if torch.backends.mps.is_available():
+            return inputs.to(torch.float32).to(self.device)
+        return inputs.to(self.device)
+
     def get_masks(self,
                  image: Union[str, Path, Image.Image, np.ndarray],
                  input_points: Optional[List] = None,
                  input_boxes: Optional[List] = None,
                  input_labels: Optional[List] = None,
                  image_embeddings: Optional[torch.Tensor] = None, 
-                 multimask_output = True) -> Tuple[torch.Tensor, torch.Tensor]:
+                 multimask_output = True,
+                 best_mask_only: bool = False,
+                 roi_margin: int = 16,
+                 image_sizes: Optional[Tuple[List[int], List[int]]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         """Get the masks for a given prompt
         Args:
             image: The image to process
@@ -63,6 +178,12 @@ class Sam(BaseModel):
             input_labels: Optional labels
             image_embeddings: Optional pre-computed embeddings
             multimask_output: Optional, if set to True, allowing one mask for one prompt point, but need to add one dimension to the point prompt.
+            best_mask_only: Optional, if set to True, only the mask with the highest iou score of each prompt is upsampled,
+                and only within its region of interest. The masks are then returned as one label map of shape (Height, Width)
+                where the pixel value is the object id, and the scores as (1, Object, 1).
+            roi_margin: Margin in pixels added around the region of interest when best_mask_only is True
+            image_sizes: Optional (original_size, reshaped_input_size) of the image, with image_embeddings the image is
+                then not processed at all
         Returns:
             Tuple of (masks, scores)
         """
@@ -74,47 +195,360 @@ class Sam(BaseModel):
         if image_embeddings is None:
             image_embeddings = self.get_image_embeddings(raw_image)
 
-        inputs = self.processor(
-            raw_image,
-            input_points=input_points,
-            input_boxes=input_boxes,
-            input_labels=input_labels,
-            return_tensors="pt"
-        )
-
-        if torch.backends.mps.is_available():
-            inputs = inputs.to(torch.float32).to(self.device)
-        else:
-            inputs = inputs.to(self.device)
-
-        inputs.pop("pixel_values", None)
+        inputs = self.get_prompt_inputs(raw_image, input_points, input_boxes, input_labels, image_sizes)
         inputs.update({"image_embeddings": image_embeddings})
 
-        with torch.no_grad():
+        with self.compute():
             outputs = self.model(**inputs, multimask_output=multimask_output) # TODO: so maybe at the moment do not allow hollow masks where it requires multimask_output=True...
 
 
+        if best_mask_only:
+            return self.post_process_best_masks(
+                outputs.pred_masks.cpu(),
+                outputs.iou_scores.cpu(),
+                inputs["original_sizes"][0].tolist(),
+                inputs["reshaped_input_sizes"][0].tolist(),
+                roi_margin=roi_margin
+            )
+
         # TODO: should this be on gpu or cpu?
-        masks = self.processor.image_processor.post_process_masks(
-            outputs.pred_masks.cpu(),
-            inputs["original_sizes"].cpu(),
-            inputs["reshaped_input_sizes"].cpu()
-        )
+        with stage('postprocess'):
+            masks = self.processor.image_processor.post_process_masks(
+                outputs.pred_masks.cpu(),
+                inputs["original_sizes"].cpu(),
+                inputs["reshaped_input_sizes"].cpu()
+            )
         scores = outputs.iou_scores.cpu()
 
         return masks, scores
 
-    def raster_to_vector(self, masks: Union[torch.Tensor, np.ndarray], scores: Union[torch.Tensor, np.ndarray], img_transform: Optional[Any] = None, filename: Optional[str] = None):
-        """Extends base raster_to_vector with SAM-specific processing
+    @stage('postprocess')
+    def select_best_masks(self,
+                          pred_masks: torch.Tensor,
+                          iou_scores: torch.Tensor,
+                          original_size: Tuple[int, int],
+                          reshaped_input_size: Tuple[int, int],
+                          roi_margin: int = 16) -> List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]]:
+        """Select the best mask of each prompt at low resolution and upsample it only within its region of interest
+        Args:
+            pred_masks: Low resolution mask logits from the model, (1, Object, Mask, 256, 256)
+            iou_scores: The iou scores of the masks, (1, Object, Mask)
+            original_size: Original image size (height, width)
+            reshaped_input_size: Size (height, width) of the resized image fed to the model, without padding
+            roi_margin: Margin in pixels added around the region of interest
+        Returns:
+            One (score, roi, mask) tuple per object, where roi is (x_min, y_min, x_max, y_max) in original pixels and mask is
+            the boolean mask cropped to the roi. roi and mask are None if the predicted mask is empty.
+        """
+        valid_size = self.low_res_valid_size(tuple(pred_masks.shape[-2:]), reshaped_input_size)
+
+        best_idx = torch.argmax(iou_scores[0], dim=-1)
+        objects = torch.arange(best_idx.shape[0])
+        best_masks = pred_masks[0, objects, best_idx].float()
+        best_scores = iou_scores[0, objects, best_idx]
+
+        return [(score, *self.upsample_mask(low_res_mask, valid_size, original_size, reshaped_input_size, roi_margin))
+                for low_res_mask, score in zip(best_masks, best_scores.tolist())]
+
+    def low_res_valid_size(self, low_res_size: Tuple[int, int], reshaped_input_size: Tuple[int, int]) -> Tuple[int, int]:
+        """Size of the part of the low resolution masks that covers the image, without the padding"""
+        pad_size = self.processor.image_processor.pad_size
+        return (math.ceil(reshaped_input_size[0] * low_res_size[0] / pad_size["height"]),
+                math.ceil(reshaped_input_size[1] * low_res_size[1] / pad_size["width"]))
+
+    def upsample_mask(self,
+                      low_res_mask: torch.Tensor,
+                      valid_size: Tuple[int, int],
+                      original_size: Tuple[int, int],
+                      reshaped_input_size: Tuple[int, int],
+                      roi_margin: int = 16) -> Tuple[Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]:
+        """Upsample a low resolution mask to the original image size within its region of interest only
+        Returns:
+            (roi, mask) with roi (x_min, y_min, x_max, y_max) in original pixels and the boolean mask cropped to the roi,
+            or (None, None) if the mask is empty
+        """
+        roi = mask_roi(low_res_mask, valid_size, original_size, margin=roi_margin)
+        if roi is None:
+            return None, None
+
+        pad_size = self.processor.image_processor.pad_size
+        pad_size = (pad_size["height"], pad_size["width"])
+        x_min, y_min, x_max, y_max = roi
+        window = (y_min, y_max, x_min, x_max)
+        # same two resize stages as SamImageProcessor.post_process_masks, evaluated on the roi only
+        padded_window = source_window(window, reshaped_input_size, original_size)
+        padded = resize_window(low_res_mask, pad_size, padded_window)
+        upsampled = resize_window(padded, original_size, window,
+                                  offset=(padded_window[0], padded_window[2]), in_size=reshaped_input_size)
+        return roi, (upsampled > 0).numpy()
+
+    def generate_masks(self,
+                       image: Union[str, Path, Image.Image, np.ndarray],
+                       image_embeddings: Optional[torch.Tensor] = None,
+                       points_per_side: int = 32,
+                       points_per_batch: int = 64,
+                       pred_iou_thresh: float = 0.88,
+                       stability_score_thresh: float = 0.95,
+                       stability_score_offset: float = 1.0,
+                       nms_thresh: float = 0.7,
+                       roi_margin: int = 16) -> List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]]:
+        """Generate the masks of every object of an image without prompts, from a grid of point prompts
+        The grid is decoded in batches against one embedding. All three masks of every point are kept if their
+        predicted IoU and stability score are high enough, duplicates are suppressed at low resolution with a mask NMS
+        within every batch and against the masks kept from the previous batches, so only the logits of the kept masks
+        are held, and only the remaining masks are upsampled within their region of interest.
+        Args:
+            image: The image to process
+            image_embeddings: Optional pre-computed embeddings of the image
+            points_per_side: Number of points along each side of the grid
+            points_per_batch: Number of points decoded at once
+            pred_iou_thresh: Minimum IoU predicted by the model
+            stability_score_thresh: Minimum IoU between the masks thresholded at +/- stability_score_offset
+            stability_score_offset: Offset of the logits for the stability score
+            nms_thresh: Masks with a higher IoU with a better mask are suppressed
+            roi_margin: Margin in pixels added around the region of interest
+        Returns:
+            List of (score, roi, mask) as in select_best_masks, best first
+        """
+        if isinstance(image, str) or isinstance(image, Path):
+            image = Image.open(image).convert("RGB")
+        if image_embeddings is None:
+            image_embeddings = self.get_image_embeddings(image)
+        width, height = image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0])
+
+        grid = point_grid(points_per_side, height, width)
+        # the grid is normalized once, then decoded batch by batch
+        inputs = self.processor(image, input_points=[grid[:, np.newaxis, :].tolist()],
+                                input_labels=[[[1]] * len(grid)], return_tensors="pt")
+        original_size = inputs["original_sizes"][0].tolist()
+        reshaped_input_size = inputs["reshaped_input_sizes"][0].tolist()
+
+        # low resolution logits of the kept masks, to upsample them, and their boolean masks for the NMS
+        logits = torch.zeros((0,), dtype=torch.float32)
+        masks = torch.zeros((0,), dtype=torch.bool)
+        scores = torch.zeros((0,), dtype=torch.float32)
+        for start in range(0, len(grid), points_per_batch):
+            with self.compute():
+                outputs = self.model(image_embeddings=image_embeddings,
+                                     input_points=inputs["input_points"][:, start:start + points_per_batch].to(self.device),
+                                     input_labels=inputs["input_labels"][:, start:start + points_per_batch].to(self.device),
+                                     multimask_output=True)
+            valid_size = self.low_res_valid_size(tuple(outputs.pred_masks.shape[-2:]), reshaped_input_size)
+            batch_logits = outputs.pred_masks[0].flatten(0, 1)[:, :valid_size[0], :valid_size[1]].float().cpu()
+            batch_scores = outputs.iou_scores[0].flatten().float().cpu()
+            keep = (batch_scores >= pred_iou_thresh) & \
+                   (stability_score(batch_logits, 0.0, stability_score_offset) >= stability_score_thresh)
+            batch_logits, batch_scores = batch_logits[keep], batch_scores[keep]
+            # duplicates are suppressed within the batch, then against the masks kept from the previous batches
+            batch_masks = batch_logits > 0
+            survivors = mask_nms(batch_masks, batch_scores, nms_thresh)
+            batch_logits, batch_masks, batch_scores = batch_logits[survivors], batch_masks[survivors], batch_scores[survivors]
+            if len(scores) == 0:
+                logits, masks, scores = batch_logits, batch_masks, batch_scores
+                continue
+            kept, new = merge_nms(masks, scores, batch_masks, batch_scores, nms_thresh)
+            logits = torch.cat([logits[kept], batch_logits[new]])
+            masks = torch.cat([masks[kept], batch_masks[new]])
+            scores = torch.cat([scores[kept], batch_scores[new]])
+
+        order = torch.argsort(scores, descending=True)
+        self.logger.debug(f"Generated {len(order)} masks from {len(grid)} points")
+        return [(float(scores[index]), *self.upsample_mask(logits[index], valid_size, original_size, reshaped_input_size, roi_margin))
+                for index in order.tolist()]
+
+    def post_process_best_masks(self,
+                                pred_masks: torch.Tensor,
+                                iou_scores: torch.Tensor,
+                                original_size: Tuple[int, int],
+                                reshaped_input_size: Tuple[int, int],
+                                roi_margin: int = 16) -> Tuple[List[np.ndarray], torch.Tensor]:
+        """Combine the best mask of each prompt into one label map without upsampling the other masks
+        Args:
+            pred_masks: Low resolution mask logits from the model, (1, Object, Mask, 256, 256)
+            iou_scores: The iou scores of the masks, (1, Object, Mask)
+            original_size: Original image size (height, width)
+            reshaped_input_size: Size (height, width) of the resized image fed to the model, without padding
+            roi_margin: Margin in pixels added around the region of interest
+        Returns:
+            Tuple of ([label map], scores), where the label map has the shape (Height, Width) and the object id (starting
+            from 1) as pixel value, and the scores have the shape (1, Object, 1)
+        """
+        best_masks = self.select_best_masks(pred_masks, iou_scores, original_size, reshaped_input_size, roi_margin)
+        label_map = np.zeros(tuple(original_size), dtype=smallest_label_dtype(len(best_masks)))
+
+        # the latter prediction overwrites the former for overlapping masks, same as in raster_to_vector
+        for obj, (_, roi, mask) in enumerate(best_masks):
+            if roi is None:
+                continue
+            x_min, y_min, x_max, y_max = roi
+            label_map[y_min:y_max, x_min:x_max][mask] = obj + 1
+
+        scores = torch.tensor([score for score, _, _ in best_masks]).view(1, -1, 1)
+        return [label_map], scores
+
+    def get_masks_chunked(self,
+                          image: Union[str, Path, Image.Image, np.ndarray],
+                          input_points: Optional[List] = None,
+                          input_boxes: Optional[List] = None,
+                          input_labels: Optional[List] = None,
+                          image_embeddings: Optional[torch.Tensor] = None,
+                          points_per_batch: Optional[int] = None,
+                          boxes_per_batch: Optional[int] = None,
+                          roi_margin: int = 16,
+                          image_sizes: Optional[Tuple[List[int], List[int]]] = None) -> Iterator[Tuple[int, List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]]]]:
+        """Decode many prompts in chunks of objects against the shared embedding, one chunk at a time
+        Only the best mask of each prompt is kept, cropped to its region of interest, so memory is bounded by the chunk
+        size instead of the number of prompts times the image size.
+        Args:
+            image: The image to process
+            input_points: Optional point prompts
+            input_boxes: Optional box prompts
+            input_labels: Optional labels
+            image_embeddings: Optional pre-computed embeddings, computed once for all chunks otherwise
+            points_per_batch: Maximum number of point prompted objects decoded at once
+            boxes_per_batch: Maximum number of box prompted objects decoded at once
+            roi_margin: Margin in pixels added around the region of interest
+            image_sizes: Optional (original_size, reshaped_input_size) of the image, see get_masks
+        Returns:
+            Iterator of (index of the first object of the chunk, [(score, roi, mask)] as in select_best_masks)
+        """
+        if isinstance(image, str) or isinstance(image, Path):
+            image = Image.open(image).convert("RGB")
+        if image_embeddings is None:
+            image_embeddings = self.get_image_embeddings(image)
+
+        for first, points, boxes, labels in chunk_prompts(input_points, input_boxes, input_labels,
+                                                          points_per_batch, boxes_per_batch):
+            inputs = self.get_prompt_inputs(image, points, boxes, labels, image_sizes)
+            inputs.update({"image_embeddings": image_embeddings})
+
+            with self.compute():
+                outputs = self.model(**inputs, multimask_output=True)
+            yield first, self.select_best_masks(outputs.pred_masks.cpu(), outputs.iou_scores.cpu(),
+                                                inputs["original_sizes"][0].tolist(),
+                                                inputs["reshaped_input_sizes"][0].tolist(), roi_margin=roi_margin)
+
+    def decode_object(self,
+                      image: Union[Image.Image, np.ndarray, None],
+                      image_embeddings: torch.Tensor,
+                      input_points: Optional[List] = None,
+                      input_boxes: Optional[List] = None,
+                      input_labels: Optional[List] = None,
+                      mask_input: Optional[torch.Tensor] = None,
+                      image_sizes: Optional[Tuple[List[int], List[int]]] = None,
+                      roi_margin: int = 16) -> Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray], torch.Tensor]:
+        """Decode the prompts of one object, optionally refining the mask of a previous decoding of the object
+        Like the interactive loop of SAM, the low resolution logits of the previous mask are given to the prompt encoder
+        and a single mask is predicted, otherwise the best of three masks is kept.
+        Args:
+            image: The image, see get_prompt_inputs
+            image_embeddings: Pre-computed embeddings of the image
+            input_points: Optional point prompts of the object, (1, Point, 2)
+            input_boxes: Optional box prompt of the object, (1, 1, 4)
+            input_labels: Optional labels of the points, (1, Point)
+            mask_input: Optional low resolution logits (256, 256) of a previous mask of the object
+            image_sizes: Optional (original_size, reshaped_input_size) of the image, see get_prompt_inputs
+            roi_margin: Margin in pixels added around the region of interest
+        Returns:
+            (score, roi, mask) as in select_best_masks, and the low resolution logits of the mask to refine it later
+        """
+        return self.decode_objects(image, image_embeddings, [(input_points, input_boxes, input_labels, mask_input)],
+                                   image_sizes=image_sizes, roi_margin=roi_margin)[0]
+
+    def decode_objects(self,
+                       image: Union[Image.Image, np.ndarray, None],
+                       image_embeddings: torch.Tensor,
+                       objects: List[Tuple[Optional[List], Optional[List], Optional[List], Optional[torch.Tensor]]],
+                       image_sizes: Optional[Tuple[List[int], List[int]]] = None,
+                       roi_margin: int = 16) -> List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray], torch.Tensor]]:
+        """Decode several objects of the same image in one forward pass of the prompt encoder and mask decoder
+        Every object is one image of the batch, all sharing the embedding, so each can refine its own previous mask.
+        The objects must have the same number of points, all or none a box and all or none a mask input, as points
+        are not padded.
+        Args:
+            image: The image, see get_prompt_inputs
+            image_embeddings: Pre-computed embeddings of the image, (1, Channel, Height, Width)
+            objects: (input_points, input_boxes, input_labels, mask_input) of every object, see decode_object
+            image_sizes: Optional (original_size, reshaped_input_size) of the image, see get_prompt_inputs
+            roi_margin: Margin in pixels added around the region of interest
+        Returns:
+            One decode_object result per object
+        """
+        prompts = [self.get_prompt_inputs(image, points, boxes, labels, image_sizes) for points, boxes, labels, _ in objects]
+        inputs = prompts[0]
+        for name in ("input_points", "input_labels", "input_boxes"):
+            if name in inputs:
+                inputs[name] = torch.cat([prompt[name] for prompt in prompts])
+        mask_inputs = [mask_input for *_, mask_input in objects]
+        if mask_inputs[0] is not None:
+            inputs["input_masks"] = torch.stack(mask_inputs)[:, None].to(device=self.device, dtype=image_embeddings.dtype)
+        inputs["image_embeddings"] = image_embeddings.expand(len(objects), -1, -1, -1)
+
+        with self.compute():
+            outputs = self.model(**inputs, multimask_output=mask_inputs[0] is None)
+        pred_masks, iou_scores = outputs.pred_masks.cpu(), outputs.iou_scores.cpu()
+        original_size, reshaped_input_size = inputs["original_sizes"][0].tolist(), inputs["reshaped_input_sizes"][0].tolist()
+        results = []
+        for index in range(len(objects)):
+            (score, roi, mask), = self.select_best_masks(pred_masks[index:index + 1], iou_scores[index:index + 1],
+                                                          original_size, reshaped_input_size, roi_margin=roi_margin)
+            results.append((score, roi, mask, pred_masks[index, 0, torch.argmax(iou_scores[index, 0])]))
+        return results
+
+    @staticmethod
+    @stage('vectorize')
+    def best_masks_to_vector(best_masks: List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]],
+                             first: int = 0,
+                             img_transform: Optional[Any] = None) -> List[Dict]:
+        """Polygonize the cropped best masks of a chunk, one GeoJSON feature per object
+        Unlike raster_to_vector, overlapping objects keep their whole mask, as they are not combined into a label map.
+        Args:
+            best_masks: [(score, roi, mask)] as returned by select_best_masks
+            first: Index of the first object of the chunk, the uid of an object is its index + 1
+            img_transform: Optional transform for georeferencing
+        Returns:
+            List of GeoJSON features, without the objects with an empty mask
+        """
+        geojson = []
+        for obj, (_, roi, mask) in enumerate(best_masks, start=first + 1):
+            if roi is None:
+                continue
+            offset = Affine.translation(roi[0], roi[1])
+            transform = img_transform * offset if img_transform is not None else offset
+            polygons = [shapely.geometry.shape(polygon)
+                        for polygon, _ in features.shapes(mask.astype(np.uint8), mask=mask, transform=transform)]
+            geometry = polygons[0] if len(polygons) == 1 else shapely.geometry.MultiPolygon(polygons)
+            geojson.append({"properties": {"uid": float(obj)}, "geometry": shapely.geometry.mapping(geometry)})
+        return geojson
+
+    def best_masks_to_rle(self,
+                          best_masks: List[Tuple[float, Optional[Tuple[int, int, int, int]], Optional[np.ndarray]]],
+                          first: int = 0,
+                          encoding: str = "rle") -> List[Dict]:
+        """Encode the cropped best masks of a chunk like raster_to_rle, one mask per object
+        Args:
+            best_masks: [(score, roi, mask)] as returned by select_best_masks
+            first: Index of the first object of the chunk, the uid of an object is its index + 1
+            encoding: "rle" or "bitmask"
+        Returns:
+            List of masks with uid, bbox, size and counts
+        """
+        return [{"uid": obj, "bbox": list(roi), "size": list(mask.shape), "counts": self.encode_mask(mask, encoding)}
+                for obj, (_, roi, mask) in enumerate(best_masks, start=first + 1) if roi is not None]
+
+    def combine_masks(self, masks: Union[List[torch.Tensor], List[np.ndarray]], scores: Union[torch.Tensor, np.ndarray]) -> List[Union[torch.Tensor, np.ndarray]]:
+        """Combine the masks of all objects into one label map, keeping the mask with the highest score of each object
         Args:
             masks: The masks to process, [(Object, Mask, Height, Width)] -> One object may have multiple masks with different scores
             scores: The scores for the masks
-            img_transform: The image transform
-            filename: The filename to save the output
         Returns:
-            geojson: The GeoJSON output of predicted masks
+            [label map] with the object id (starting from 1) as pixel value
         """
 
+        # label map from get_masks(..., best_mask_only=True), the objects are already combined
+        if isinstance(masks[0], np.ndarray) and masks[0].ndim == 2:
+            return masks
+
         num_masks = masks[0].shape[0]
         num_scores = masks[0].shape[1]
 
@@ -147,7 +581,31 @@ class Sam(BaseModel):
         if masks_combined.shape[0] > 1:
             masks_combined = torch.amax(masks_combined, dim=0, keepdim=False).numpy().astype(np.uint8)
 
-        return super().raster_to_vector([masks_combined], img_transform, filename)
+        return [masks_combined]
+
+    def raster_to_vector(self, masks: Union[torch.Tensor, np.ndarray], scores: Union[torch.Tensor, np.ndarray], img_transform: Optional[Any] = None, filename: Optional[str] = None):
+        """Extends base raster_to_vector with SAM-specific processing
+        Args:
+            masks: The masks to process, [(Object, Mask, Height, Width)] -> One object may have multiple masks with different scores
+            scores: The scores for the masks
+            img_transform: The image transform
+            filename: The filename to save the output
+        Returns:
+            geojson: The GeoJSON output of predicted masks
+        """
+        return super().raster_to_vector(self.combine_masks(masks, scores), img_transform, filename)
+
+    def raster_to_rle(self, masks: Union[torch.Tensor, np.ndarray], scores: Union[torch.Tensor, np.ndarray], img_transform: Optional[Any] = None, encoding: str = "rle"):
+        """Extends base raster_to_rle with SAM-specific processing
+        Args:
+            masks: The masks to process, [(Object, Mask, Height, Width)] -> One object may have multiple masks with different scores
+            scores: The scores for the masks
+            img_transform: The image transform
+            encoding: "rle" or "bitmask"
+        Returns:
+            The encoded masks, see BaseModel.raster_to_rle
+        """
+        return super().raster_to_rle(self.combine_masks(masks, scores), img_transform, encoding)
 
 
 if __name__ == "__main__":
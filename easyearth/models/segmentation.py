@@ -8,12 +8,28 @@ import numpy as np
 from transformers import SegformerConfig
 import torch 
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Optional, Union
+import rasterio
+from rasterio.windows import Window
+import torch.nn.functional as F
 try:
     from .base_model import BaseModel
+    from .postprocess import low_res_label_map, smallest_label_dtype, tiled_label_map
+    from ..core.tiling import TileFilter, blended_label_strips, image_size
+    from ..core.pipeline import TilePipeline
+    from ..core.coarse_to_fine import CoarseToFine
+    from ..core.metrics import stage
 except ImportError:
     # For direct script execution
     from base_model import BaseModel
+    from postprocess import low_res_label_map, smallest_label_dtype, tiled_label_map
+    from easyearth.core.tiling import TileFilter, blended_label_strips, image_size
+    from easyearth.core.pipeline import TilePipeline
+    from easyearth.core.coarse_to_fine import CoarseToFine
+    from easyearth.core.metrics import stage
+
+# ways of turning the logits into the label map at image size, see Segmentation.get_masks
+POST_PROCESSING = ("full", "tiled", "low_res")
 
 class Segmentation(BaseModel):
     def __init__(self, model_path: str = "restor/tcd-segformer-mit-b5") -> None:
@@ -31,33 +47,288 @@ class Segmentation(BaseModel):
         self.config = SegformerConfig.from_pretrained(model_path, cache_dir=self.cache_dir)
         self.logger.debug(f"Model config loaded successfully")
 
-    def get_masks(self, image: Union[str, Path, Image.Image, np.ndarray]):
+    def get_masks(self, image: Union[str, Path, Image.Image, np.ndarray], post_processing: str = "full", tile_size: int = 1024):
         """Get the masks for a given prompt
         Args:
             image: The image to process
+            post_processing: How the logits are turned into the label map at image size
+                - "full": upsample the whole logit volume to image size before the argmax (hugging face default)
+                - "tiled": same labels as "full", but the upsampling and argmax are done tile by tile with bounded memory
+                - "low_res": argmax at logit resolution, then nearest neighbour upsampling of the label map only
+            tile_size: Tile size in pixels for post_processing="tiled"
         Returns: 
             masks
         """
-
-        # TODO (function): allow to predict for a specific region of the image
-
         self.logger.debug(f"Processing image: {image}")
         if isinstance(image, str) or isinstance(image, Path):
-            raw_image = Image.open(image).convert("RGB")
-        else:
-            raw_image = image
-
-        # get the type of raw_image
-        if isinstance(raw_image, np.ndarray):
-            raw_image = Image.fromarray(raw_image)
-
-        with torch.no_grad():
-            inputs = self.processor(raw_image, return_tensors='pt')
-            preds = self.model(pixel_values=inputs.pixel_values)
-            target_size = [(raw_image.size[1], raw_image.size[0])]
-            masks = self.processor.post_process_semantic_segmentation(preds, target_sizes=target_size)
+            image = Image.open(image).convert("RGB")
+        return self.get_masks_batch([image], post_processing=post_processing, tile_size=tile_size)
+
+    def get_masks_batch(self,
+                        images: List[Union[Image.Image, np.ndarray]],
+                        post_processing: str = "full",
+                        tile_size: int = 1024,
+                        batch_size: int = 4):
+        """Get the masks of several images of any size, e.g. crops of areas of interest, in batched forward passes
+        The processor resizes every image to the input size of the model, so images of different sizes are batched.
+        Args:
+            images: The images to process
+            post_processing: How the logits are turned into the label maps, see get_masks
+            tile_size: Tile size in pixels for post_processing="tiled"
+            batch_size: Number of images per forward pass
+        Returns:
+            masks, one label map per image
+        """
+        if post_processing not in POST_PROCESSING:
+            raise ValueError(f"Unknown post_processing: {post_processing}. Available: {', '.join(POST_PROCESSING)}")
+        images = [Image.fromarray(image) if isinstance(image, np.ndarray) else image for image in images]
+
+        masks = []
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            target_sizes = [(image.size[1], image.size[0]) for image in batch]
+            inputs = self.processor(batch, return_tensors='pt')
+            with self.compute():
+                preds = self.model(pixel_values=inputs.pixel_values)
+            # the logits are turned into label maps outside of the compute slot of the model
+            with stage('postprocess'), torch.no_grad():
+                if post_processing == "full":
+                    masks.extend(self.processor.post_process_semantic_segmentation(preds, target_sizes=target_sizes))
+                elif post_processing == "tiled":
+                    masks.extend(torch.from_numpy(tiled_label_map(logits, size, tile_size=tile_size))
+                                 for logits, size in zip(preds.logits, target_sizes))
+                else:
+                    masks.extend(torch.from_numpy(low_res_label_map(logits, size))
+                                 for logits, size in zip(preds.logits, target_sizes))
         return masks
 
+    def to_label_map(self, masks: Union[List[np.ndarray], List[torch.Tensor]]) -> np.ndarray:
+        """Label map of shape (Height, Width) with the class of every pixel, not only foreground and background as in
+        BaseModel.to_label_map, so the whole image and the tiled paths give every class its own uid
+        Args:
+            masks: Label maps of the classes, as returned by get_masks
+        """
+        labels = masks[0]
+        if isinstance(labels, torch.Tensor):
+            labels = labels.cpu().numpy()
+        if labels.ndim > 2:
+            labels = np.squeeze(labels, axis=0)
+        return labels.astype(self.label_dtype, copy=False)
+
+    @property
+    def label_dtype(self):
+        """Smallest data type of the label maps of this model"""
+        return smallest_label_dtype(self.model.config.num_labels - 1)
+
+    def predict_tile_logits(self, tiles: List[np.ndarray]) -> torch.Tensor:
+        """Logits of a batch of tiles, upsampled to the tile size
+        Args:
+            tiles: List of RGB arrays of shape (height, width, 3), all of the same size
+        Returns:
+            Logits of shape (batch, classes, height, width)
+        """
+        inputs = self.processor([Image.fromarray(tile) for tile in tiles], return_tensors='pt')
+        with self.compute():
+            logits = self.model(pixel_values=inputs.pixel_values).logits
+        return F.interpolate(logits, size=tiles[0].shape[:2], mode="bilinear", align_corners=False)
+
+    def get_masks_tiled(self,
+                        image: Union[str, Path, Image.Image, np.ndarray, rasterio.io.DatasetReader],
+                        tile_size: int = 512,
+                        overlap: int = 64,
+                        batch_size: int = 4,
+                        output_path: Optional[str] = None,
+                        tile_filter: Optional[TileFilter] = None,
+                        report: Optional[Dict] = None):
+        """Get the masks with sliding-window inference at full resolution, blending the logits across tile seams
+        Unlike get_masks, the image is not resized to the input size of the processor as a whole, and memory is
+        bounded by one row of tiles. Rasters on disk are streamed window by window.
+        Args:
+            image: The image to process, a path or an open rasterio dataset is read window by window
+            tile_size: Tile size in pixels
+            overlap: Overlap between neighbouring tiles in pixels
+            batch_size: Number of tiles per forward pass
+            output_path: If given, the label map is written to this GeoTIFF strip by strip instead of being returned
+            tile_filter: Optional filter of the tiles to skip, e.g. nodata or uniform tiles. Nodata pixels of rasters
+                on disk always get the background label.
+            report: Optional dictionary, filled with the skipped tiles, see easyearth.core.tiling.skipped_report
+        Returns:
+            masks, or output_path if given
+        """
+        if isinstance(image, (str, Path)):
+            try:
+                with rasterio.open(image) as src:
+                    return self.get_masks_tiled(src, tile_size, overlap, batch_size, output_path, tile_filter, report)
+            except rasterio.errors.RasterioIOError:
+                image = Image.open(image).convert("RGB")
+        if isinstance(image, Image.Image):
+            image = np.array(image.convert("RGB"))
+
+        report = {} if report is None else report
+        strips = blended_label_strips(image, self.predict_tile_logits, tile_size=tile_size, overlap=overlap,
+                                      batch_size=batch_size, label_dtype=self.label_dtype, tile_filter=tile_filter,
+                                      report=report)
+        result = self.collect_strips(strips, image, output_path)
+        self.logger.info(f"Skipped tiles: {report}")
+        return result
+
+    def collect_strips(self, strips, image, output_path: Optional[str] = None):
+        """Assemble the label strips of a sliding-window inference into the label map of the image, or write them to
+        the GeoTIFF output_path, georeferenced like the image if it is a raster
+        Args:
+            strips: Iterator of (first row, label strip)
+            image: The image the strips belong to, an array or an open rasterio dataset
+            output_path: Optional path of the GeoTIFF
+        Returns:
+            masks, or output_path if given
+        """
+        height, width = image_size(image)
+        if output_path is None:
+            labels = np.empty((height, width), dtype=self.label_dtype)
+            for row, strip in strips:
+                labels[row:row + strip.shape[0]] = strip
+            return [torch.from_numpy(labels)]
+
+        profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1,
+                   'dtype': np.dtype(self.label_dtype).name, 'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                   'compress': 'deflate'}
+        if isinstance(image, rasterio.io.DatasetReader):
+            profile.update(transform=image.transform, crs=image.crs)
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for row, strip in strips:
+                dst.write(strip, 1, window=Window(0, row, width, strip.shape[0]))
+        return output_path
+
+    def vectorize_tiled(self,
+                        image: Union[str, Path, Image.Image, np.ndarray, rasterio.io.DatasetReader],
+                        img_transform=None,
+                        tile_size: int = 512,
+                        overlap: int = 64,
+                        batch_size: int = 4,
+                        workers: int = 2,
+                        prefetch: int = 8,
+                        tile_filter: Optional[TileFilter] = None,
+                        report: Optional[Dict] = None):
+        """Sliding-window inference and polygonization, with reading, inference and vectorization overlapped
+        Same result as raster_to_vector(get_masks_tiled(image)), one feature per class, see to_label_map and
+        easyearth.core.pipeline.TilePipeline. The
+        utilization of every stage is logged.
+        Args:
+            image: The image to process, a path or an open rasterio dataset is read window by window
+            img_transform: Optional transform for georeferencing, defaults to the transform of a raster on disk
+            tile_size: Tile size in pixels
+            overlap: Overlap between neighbouring tiles in pixels
+            batch_size: Number of tiles per forward pass
+            workers: Number of polygonization workers
+            prefetch: Number of tiles read ahead of the model
+            tile_filter: Optional filter of the tiles to skip
+            report: Optional dictionary, filled with the utilization of every stage and the skipped tiles, see
+                easyearth.core.pipeline.TilePipeline.stats
+        Returns:
+            List of GeoJSON features
+        """
+        if isinstance(image, (str, Path)):
+            try:
+                with rasterio.open(image) as src:
+                    return self.vectorize_tiled(src, img_transform if img_transform is not None else src.transform,
+                                                tile_size, overlap, batch_size, workers, prefetch, tile_filter, report)
+            except rasterio.errors.RasterioIOError:
+                image = Image.open(image).convert("RGB")
+        if isinstance(image, Image.Image):
+            image = np.array(image.convert("RGB"))
+
+        pipeline = TilePipeline(self.predict_tile_logits, tile_size=tile_size, overlap=overlap, batch_size=batch_size,
+                                prefetch=prefetch, workers=workers, label_dtype=self.label_dtype,
+                                tile_filter=tile_filter)
+        geojson = pipeline.vectorize(image, img_transform)
+        if report is not None:
+            report.update(pipeline.stats)
+        return geojson
+
+    def stream_tiled(self,
+                     image: Union[str, Path, Image.Image, np.ndarray, rasterio.io.DatasetReader],
+                     img_transform=None,
+                     tile_size: int = 512,
+                     overlap: int = 64,
+                     batch_size: int = 4,
+                     workers: int = 2,
+                     prefetch: int = 8,
+                     tile_filter: Optional[TileFilter] = None,
+                     report: Optional[Dict] = None):
+        """Like vectorize_tiled, but returns the features of every strip as soon as it is polygonized, see
+        easyearth.core.pipeline.TilePipeline.stream. The report is filled once the iterator is exhausted.
+        Returns:
+            Iterator of (number of finished rows, GeoJSON features)
+        """
+        if isinstance(image, (str, Path)):
+            try:
+                src = rasterio.open(image)
+            except rasterio.errors.RasterioIOError:
+                image = Image.open(image).convert("RGB")
+            else:
+                with src:
+                    yield from self.stream_tiled(src, img_transform if img_transform is not None else src.transform,
+                                                 tile_size, overlap, batch_size, workers, prefetch, tile_filter,
+                                                 report)
+                return
+        if isinstance(image, Image.Image):
+            image = np.array(image.convert("RGB"))
+
+        pipeline = TilePipeline(self.predict_tile_logits, tile_size=tile_size, overlap=overlap, batch_size=batch_size,
+                                prefetch=prefetch, workers=workers, label_dtype=self.label_dtype,
+                                tile_filter=tile_filter)
+        yield from pipeline.stream(image, img_transform)
+        if report is not None:
+            report.update(pipeline.stats)
+
+    def get_masks_adaptive(self,
+                           image: Union[str, Path, Image.Image, np.ndarray, rasterio.io.DatasetReader],
+                           tile_size: int = 512,
+                           overlap: int = 64,
+                           batch_size: int = 4,
+                           factor: int = 4,
+                           min_confidence: float = 0.9,
+                           tolerance: float = 0.01,
+                           verify_fraction: float = 0.05,
+                           output_path: Optional[str] = None,
+                           report: Optional[Dict] = None):
+        """Get the masks like get_masks_tiled, running the model at full resolution only where a coarse pass on the
+        image decimated by ``factor`` finds class boundaries or low confidence, see easyearth.core.coarse_to_fine.
+        The compute saved is logged.
+        Args:
+            image: The image to process, a path or an open rasterio dataset is read window by window
+            tile_size: Tile size in pixels
+            overlap: Overlap between neighbouring tiles in pixels
+            batch_size: Number of tiles per forward pass
+            factor: Decimation of the image for the coarse pass
+            min_confidence: Tiles with a lower coarse confidence anywhere are refined
+            tolerance: Maximum fraction of verified pixels where the coarse class may be wrong, otherwise every
+                tile is refined
+            verify_fraction: Fraction of the confident tiles verified at full resolution
+            output_path: If given, the label map is written to this GeoTIFF strip by strip instead of being returned
+            report: Optional dictionary, filled with the tiles refined and the compute saved, see
+                easyearth.core.coarse_to_fine.CoarseToFine.run
+        Returns:
+            masks, or output_path if given
+        """
+        if isinstance(image, (str, Path)):
+            try:
+                with rasterio.open(image) as src:
+                    return self.get_masks_adaptive(src, tile_size, overlap, batch_size, factor, min_confidence,
+                                                   tolerance, verify_fraction, output_path, report)
+            except rasterio.errors.RasterioIOError:
+                image = Image.open(image).convert("RGB")
+        if isinstance(image, Image.Image):
+            image = np.array(image.convert("RGB"))
+
+        adaptive = CoarseToFine(self.predict_tile_logits, tile_size=tile_size, overlap=overlap, batch_size=batch_size,
+                                factor=factor, min_confidence=min_confidence, tolerance=tolerance,
+                                verify_fraction=verify_fraction, label_dtype=self.label_dtype)
+        result = self.collect_strips(adaptive.run(image), image, output_path)
+        if report is not None:
+            report.update(adaptive.report)
+        return result
+
     @staticmethod
     def focus_on_region(image: Union[Image.Image, np.ndarray], region: tuple):
         """Focus on a specific region of the image
@@ -0,0 +1,120 @@
+"""Test functions in easyearth.core.admission module."""
+
+import asyncio
+import threading
+
+import httpx
+import pytest
+from a2wsgi import WSGIMiddleware
+from flask import Flask
+
+from easyearth.config.serving import wsgi_threads
+from easyearth.core.admission import MB, AdmissionControl, Overloaded, admission_limits, estimate_memory
+from easyearth.core.cancellation import CancellationRegistry, RequestCancelled
+
+
+def test_estimate_memory_grows_with_the_raster():
+    """Larger rasters and segmentation models need more memory"""
+    small, large = estimate_memory('sam', 512, 512), estimate_memory('sam', 8192, 8192)
+    assert estimate_memory('sam') < small < large
+    assert estimate_memory('segment', 8192, 8192) > large
+    assert estimate_memory('sam', 8192, 8192, bands=4, itemsize=2) > large
+
+
+def test_requests_are_queued_then_rejected():
+    """Requests beyond the running limit or the memory budget wait in order, a full queue rejects with Retry-After"""
+    admission = AdmissionControl(max_running=2, max_queued=1, memory_limit=100 * MB, queue_timeout=5)
+    first = admission.reserve(60 * MB)
+    # larger than what is left of the budget
+    second = admission.reserve(60 * MB)
+    assert first.started is not None and second.started is None
+    with pytest.raises(Overloaded) as rejected:
+        admission.reserve(MB)
+    assert rejected.value.retry_after >= 1
+
+    waiting = threading.Thread(target=admission.wait, args=(second,))
+    waiting.start()
+    admission.release(first)
+    waiting.join(5)
+    assert second.started is not None
+    admission.release(second)
+
+    # a request larger than the budget runs alone
+    with admission.admit(admission.reserve(500 * MB)):
+        assert admission.stats()['memory_mb'] == 500
+    assert admission.stats() == {'running': 0, 'queued': 0, 'max_running': 2, 'max_queued': 1, 'memory_mb': 0,
+                                 'memory_limit_mb': 100, 'admitted': 3, 'rejected': {'queue_full': 1}}
+
+
+def test_queued_request_gives_up():
+    """A queued request leaves the queue when it times out or is cancelled"""
+    admission = AdmissionControl(max_running=1, max_queued=2, queue_timeout=0.1)
+    running = admission.reserve(MB)
+    with pytest.raises(Overloaded):
+        admission.wait(admission.reserve(MB))
+
+    admission.queue_timeout = 5
+    registry = CancellationRegistry()
+    with registry.scope('queued'):
+        ticket = admission.reserve(MB)
+        registry.cancel('queued')
+        with pytest.raises(RequestCancelled):
+            admission.wait(ticket)
+    admission.release(running)
+    assert admission.stats()['queued'] == 0 and admission.stats()['rejected'] == {'timeout': 1}
+
+
+def test_limits_leave_threads_to_other_endpoints(monkeypatch):
+    """Running and queued requests together stay below the WSGI pool, also when configured higher"""
+    monkeypatch.delenv('MAX_RUNNING_PREDICTIONS', raising=False)
+    monkeypatch.delenv('MAX_QUEUED_PREDICTIONS', raising=False)
+    monkeypatch.setenv('WSGI_THREADS', '32')
+    assert admission_limits() == (4, 24)
+    monkeypatch.setenv('MAX_QUEUED_PREDICTIONS', '8')
+    assert admission_limits() == (4, 8)
+    monkeypatch.setenv('WSGI_THREADS', '10')
+    monkeypatch.setenv('MAX_QUEUED_PREDICTIONS', '16')
+    assert admission_limits() == (4, 2)
+
+
+def test_concurrent_requests_beyond_the_pool_are_rejected(monkeypatch):
+    """More concurrent requests than threads: the excess gets 429 right away and other endpoints are still served"""
+    monkeypatch.setenv('WSGI_THREADS', '12')
+    monkeypatch.setenv('MAX_RUNNING_PREDICTIONS', '2')
+    monkeypatch.delenv('MAX_QUEUED_PREDICTIONS', raising=False)
+    max_running, max_queued = admission_limits()
+    admission = AdmissionControl(max_running, max_queued, queue_timeout=10)
+    release = threading.Event()
+    app = Flask(__name__)
+
+    @app.post('/predict')
+    def predict():
+        try:
+            ticket = admission.reserve(MB)
+        except Overloaded as e:
+            return 'overloaded', 429, {'Retry-After': str(e.retry_after)}
+        with admission.admit(ticket):
+            release.wait(10)
+        return 'done'
+
+    @app.get('/requests')
+    def requests():
+        return admission.stats()
+
+    async def run():
+        transport = httpx.ASGITransport(app=WSGIMiddleware(app.wsgi_app, workers=wsgi_threads()))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            predictions = [asyncio.create_task(client.post('/predict')) for _ in range(20)]
+            rejected = []
+            while len(rejected) < 20 - max_running - max_queued:
+                done, _ = await asyncio.wait(predictions, timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                assert done, 'requests beyond the pool hang instead of being rejected'
+                rejected = [task for task in predictions if task.done()]
+            stats = (await asyncio.wait_for(client.get('/requests'), 5)).json()
+            release.set()
+            return stats, [task.result() for task in rejected], await asyncio.gather(*predictions)
+
+    stats, rejected, responses = asyncio.run(run())
+    assert (stats['running'], stats['queued']) == (2, 6)
+    assert all(response.status_code == 429 and 'Retry-After' in response.headers for response in rejected)
+    assert sorted(response.status_code for response in responses) == [200] * 8 + [429] * 12
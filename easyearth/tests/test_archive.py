@@ -0,0 +1,34 @@
+"""Test functions in easyearth.core.archive module."""
+
+import geopandas as gpd
+
+from easyearth.core.archive import PredictionArchive, archive_enabled
+
+
+def test_archive_writes_in_background(tmp_path):
+    """Submitted predictions are written once the queue drains"""
+    archive = PredictionArchive(str(tmp_path))
+    features = [{"properties": {"uid": 1},
+                 "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}}]
+    filename = archive.submit(features, "predict-test")
+    archive.close()
+    assert filename.endswith(".fgb")
+    assert len(gpd.read_file(filename)) == 1
+
+
+def test_archive_writes_empty_predictions(tmp_path):
+    """A prediction without objects is archived with its empty fallback feature"""
+    archive = PredictionArchive(str(tmp_path))
+    features = [{"properties": {"uid": -1}, "geometry": {"type": "MultiPolygon", "coordinates": []}}]
+    filename = archive.submit(features, "predict-empty")
+    archive.close()
+    assert gpd.read_file(filename)["uid"].tolist() == [-1]
+
+
+def test_archive_enabled(monkeypatch):
+    """The request flag overrides the environment variable"""
+    monkeypatch.setenv("ARCHIVE_PREDICTIONS", "true")
+    assert archive_enabled({})
+    assert not archive_enabled({"save_predictions": False})
+    monkeypatch.delenv("ARCHIVE_PREDICTIONS")
+    assert not archive_enabled({})
@@ -0,0 +1,75 @@
+"""Test functions in easyearth.core.automatic module."""
+
+import numpy as np
+import shapely.geometry
+import torch
+from rasterio import features
+from rasterio.transform import from_origin
+
+from easyearth.core.automatic import dedupe_masks, mask_nms, merge_nms, point_grid, segment_everything, stability_score
+
+
+def test_point_grid():
+    """Points are at the centers of the grid cells"""
+    grid = point_grid(2, 100, 200)
+    assert grid.tolist() == [[50, 25], [150, 25], [50, 75], [150, 75]]
+
+
+def test_stability_score():
+    """Logits far from the threshold are stable, logits close to it are not"""
+    logits = torch.full((2, 8, 8), -10.0)
+    logits[0, 2:6, 2:6] = 10.0
+    logits[1, 2:6, 2:6] = 0.5
+    assert stability_score(logits).tolist() == [1.0, 0.0]
+
+
+def test_mask_nms():
+    """The lower scoring of two overlapping masks is suppressed, disjoint masks are kept"""
+    masks = torch.zeros((3, 10, 10), dtype=torch.bool)
+    masks[0, :5, :5] = True
+    masks[1, :5, :4] = True
+    masks[2, 6:, 6:] = True
+    assert mask_nms(masks, torch.tensor([0.8, 0.9, 0.7]), 0.7).tolist() == [1, 2]
+
+
+def test_merge_nms():
+    """Duplicates across batches keep the better mask of either batch"""
+    kept = torch.zeros((2, 10, 10), dtype=torch.bool)
+    kept[0, :5, :5] = True
+    kept[1, 6:, 6:] = True
+    masks = torch.zeros((2, 10, 10), dtype=torch.bool)
+    masks[0, :5, :4] = True
+    masks[1, 6:, 6:9] = True
+    keep_kept, keep_new = merge_nms(kept, torch.tensor([0.8, 0.9]), masks, torch.tensor([0.7, 0.95]), 0.7)
+    assert keep_kept.tolist() == [True, False]
+    assert keep_new.tolist() == [False, True]
+
+
+def test_dedupe_masks():
+    """Duplicates across tiles are removed, touching neighbours are kept"""
+    rois = np.array([[0, 0, 10, 10], [1, 0, 10, 10], [10, 0, 20, 10]])
+    masks = [np.ones((10, 10), dtype=bool), np.ones((10, 9), dtype=bool), np.ones((10, 10), dtype=bool)]
+    assert dedupe_masks(rois, masks, np.array([0.5, 0.9, 0.6])).tolist() == [1, 2]
+
+
+def test_segment_everything_tiles():
+    """Objects are found once, including objects in the overlap of tiles, and not cut at inner tile edges"""
+    image = np.zeros((100, 160, 3), dtype=np.uint8)
+    image[10:30, 10:30] = 1
+    image[40:60, 70:90] = 1
+    image[70:95, 130:155] = 1
+
+    def generate(tile):
+        # one mask per square of the tile, cut squares included
+        masks = []
+        for polygon, _ in features.shapes(tile[:, :, 0], mask=tile[:, :, 0] > 0):
+            x_min, y_min, x_max, y_max = (int(v) for v in shapely.geometry.shape(polygon).bounds)
+            masks.append((0.9, (x_min, y_min, x_max, y_max), tile[y_min:y_max, x_min:x_max, 0] > 0))
+        return masks
+
+    transform = from_origin(500000, 4000000, 0.5, 0.5)
+    result = segment_everything(image, generate, tile_size=64, overlap=32, img_transform=transform)
+    bounds = sorted(shapely.geometry.shape(f["geometry"]).bounds for f in result)
+    assert bounds == [(500005.0, 3999985.0, 500015.0, 3999995.0), (500035.0, 3999970.0, 500045.0, 3999980.0),
+                      (500065.0, 3999952.5, 500077.5, 3999965.0)]
+    assert [f["properties"]["uid"] for f in result] == [1.0, 2.0, 3.0]
@@ -0,0 +1,57 @@
+"""Test functions in easyearth.core.batching module."""
+
+import threading
+
+import pytest
+
+from easyearth.core.batching import MicroBatcher
+
+
+def test_concurrent_items_are_batched():
+    """Items of several threads arriving within max_wait run as one batch, and every thread gets its own result"""
+    batches = []
+
+    def run_batch(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(run_batch, max_batch_size=4, max_wait=5)
+    results = {}
+    threads = [threading.Thread(target=lambda item=item: results.update({item: batcher.submit('key', item).result()}))
+               for item in range(3)]
+    for thread in threads:
+        thread.start()
+    # the batch is full with the fourth item, the first caller does not wait for max_wait
+    assert [future.result(timeout=5) for future in batcher.submit_many('key', [3])] == [30]
+    for thread in threads:
+        thread.join()
+
+    assert results == {0: 0, 1: 10, 2: 20}
+    assert len(batches) == 1 and sorted(batches[0]) == [0, 1, 2, 3]
+    assert batcher.stats()['histogram'] == {'4': 1}
+
+
+def test_keys_batch_sizes_and_errors():
+    """Items of other keys are not batched together, large submissions are split, errors reach every item"""
+    def run_batch(items):
+        if 'fail' in items:
+            raise ValueError('bad item')
+        return items
+
+    batcher = MicroBatcher(run_batch, max_batch_size=2, max_wait=0)
+    assert [future.result() for future in batcher.submit_many('a', [1, 2, 3])] == [1, 2, 3]
+    assert batcher.submit('b', 4).result() == 4
+    futures = batcher.submit_many('a', ['fail', 5])
+    with pytest.raises(ValueError):
+        futures[1].result()
+    assert batcher.stats() == {'batches': 4, 'items': 6, 'max_batch_size': 2, 'max_wait': 0,
+                               'histogram': {'1': 2, '2': 2}}
+
+
+def test_missing_results_fail_their_items():
+    """A batch returning fewer results than items fails all its items instead of leaving some waiting forever"""
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=4, max_wait=0)
+    futures = batcher.submit_many('a', [1, 2, 3])
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=1)
@@ -0,0 +1,75 @@
+"""Test functions in easyearth.core.cancellation module."""
+
+import threading
+
+import pytest
+
+from easyearth.core.cancellation import CancellationRegistry, RequestCancelled, acquire, check_cancelled
+from easyearth.models.base_model import BaseModel
+
+
+def test_cancel_by_id_and_latest_wins():
+    """A request is cancelled by its id, or by a newer request of its group, and unregistered when it finishes"""
+    registry = CancellationRegistry()
+    with registry.scope('a', group='session') as first:
+        check_cancelled()
+        second = registry.open('b', group='session')
+        assert first.cancelled and not second.cancelled
+        with pytest.raises(RequestCancelled, match='Request a was cancelled'):
+            check_cancelled()
+
+    assert registry.cancel('b') and second.cancelled
+    assert not registry.cancel('a')
+    registry.close(second)
+    assert registry.stats() == {'running': 0, 'cancelled': 1, 'superseded': 1}
+    assert registry.requests == {} and registry.groups == {}
+    # outside of a request nothing is cancelled
+    check_cancelled()
+
+
+def test_cancel_and_supersede_from_another_worker(tmp_path):
+    """Registries sharing a directory, like the server workers, cancel and supersede each other's requests"""
+    worker, other = CancellationRegistry(str(tmp_path)), CancellationRegistry(str(tmp_path))
+    with worker.scope('a', group='session') as first:
+        assert other.cancel('a') and first.cancelled
+        with pytest.raises(RequestCancelled, match='Request a was cancelled'):
+            check_cancelled()
+    assert not other.cancel('a')
+
+    # a new request with the id of a cancelled one runs
+    with worker.scope('a', group='session') as again:
+        check_cancelled()
+        with other.scope('b', group='session') as latest:
+            assert again.cancelled and not latest.cancelled
+            assert other.stats()['superseded'] == 1
+    # the group is done, the next request of it supersedes nothing
+    with worker.scope('c', group='session'):
+        check_cancelled()
+    assert worker.stats()['superseded'] == 0 and other.stats() == {'running': 0, 'cancelled': 1, 'superseded': 1}
+
+
+def test_waiting_request_is_aborted():
+    """A request waiting for the compute slot of a model gives up once it is cancelled, the slot stays usable"""
+    registry, model = CancellationRegistry(), BaseModel("test")
+    waiting, errors = threading.Event(), []
+
+    def wait_for_model():
+        with registry.scope('waiting'):
+            waiting.set()
+            try:
+                with model.compute():
+                    pass
+            except RequestCancelled as e:
+                errors.append(e)
+
+    acquire(model.compute_slots)
+    thread = threading.Thread(target=wait_for_model)
+    thread.start()
+    waiting.wait(5)
+    registry.cancel('waiting')
+    thread.join(5)
+    model.compute_slots.release()
+
+    assert len(errors) == 1 and not thread.is_alive()
+    with model.compute():
+        pass
@@ -0,0 +1,61 @@
+"""Test functions in easyearth.core.encoding module."""
+
+import io
+import json
+
+import geopandas as gpd
+import numpy as np
+from werkzeug.datastructures import MIMEAccept
+
+from easyearth.core.encoding import (
+    EVENT_STREAM, JSON, NDJSON, decode_prompt_arrays, decode_wkb_stream, encode_array, encode_event, encode_flatgeobuf,
+    encode_wkb_stream, negotiate
+)
+
+FEATURES = [
+    {"properties": {"uid": 1}, "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]]}},
+    {"properties": {"uid": 2}, "geometry": {"type": "MultiPolygon", "coordinates": [
+        [[[5, 5], [6, 5], [6, 6], [5, 6], [5, 5]]], [[[8, 8], [9, 8], [9, 9], [8, 9], [8, 8]]]]}},
+]
+
+
+def test_flatgeobuf_round_trip():
+    """FlatGeobuf keeps the order, properties and crs of the features"""
+    gdf = gpd.read_file(io.BytesIO(encode_flatgeobuf(FEATURES, "EPSG:32633")))
+    assert gdf["uid"].tolist() == [1, 2]
+    assert gdf.crs.to_epsg() == 32633
+    assert gdf.geometry.iloc[1].geom_type == "MultiPolygon"
+
+
+def test_wkb_stream_round_trip():
+    """The WKB stream decodes to the same geometries"""
+    features, crs = decode_wkb_stream(encode_wkb_stream(FEATURES, "EPSG:4326"))
+    assert crs == "EPSG:4326"
+    assert [f["properties"]["uid"] for f in features] == [1, 2]
+    assert features[0]["geometry"].area == 16
+
+
+def test_stream_events():
+    """Streams are only negotiated by endpoints that can stream, events are JSON lines or server-sent events"""
+    accept = MIMEAccept([(NDJSON, 1), (JSON, 0.5)])
+    assert negotiate(accept) == JSON
+    assert negotiate(accept, streaming=True) == NDJSON
+
+    event = {"type": "features", "features": FEATURES[:1]}
+    assert json.loads(encode_event(event, NDJSON)) == event
+    assert encode_event(event, NDJSON).endswith(b"}\n")
+    name, data = encode_event(event, EVENT_STREAM).decode().split("\n", 1)
+    assert name == "event: features" and data.endswith("\n\n")
+    assert json.loads(data[len("data: "):]) == event
+
+
+def test_decode_prompt_arrays():
+    """Binary prompts decode to the nested lists of reorganize_prompts"""
+    prompts = decode_prompt_arrays({
+        "points": encode_array(np.array([[10, 20], [30, 40]], dtype=np.float32)),
+        "labels": encode_array(np.array([1, 0])),
+        "boxes": encode_array(np.array([[0, 0, 5, 5]])),
+    })
+    assert prompts["points"] == [[[[10.0, 20.0]], [[30.0, 40.0]]]]
+    assert prompts["labels"] == [[[1], [0]]]
+    assert prompts["boxes"] == [[[0.0, 0.0, 5.0, 5.0]]]
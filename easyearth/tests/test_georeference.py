@@ -0,0 +1,46 @@
+"""Test functions in easyearth.core.georeference module."""
+
+import numpy as np
+import pytest
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+from easyearth.core.georeference import boxes_to_pixels, prompts_to_pixels, reproject_features, to_pixels
+
+# 10 m pixels of a 100 x 200 image in UTM zone 32N
+TRANSFORM = from_origin(500000, 5000000, 10, 10)
+SHAPE = (100, 200)
+
+
+def test_map_coordinates_to_pixels():
+    """Coordinates of the image CRS and of another CRS give the same pixels, clipped to the image"""
+    points = [[[500005, 4999995], [501000, 4999500]], [[400000, 6000000], [502000, 4999000]]]
+    pixels = to_pixels(points, TRANSFORM, SHAPE)
+    assert pixels.shape == (2, 2, 2)
+    np.testing.assert_allclose(pixels, [[[0.5, 0.5], [100, 50]], [[0, 0], [199, 99]]])
+
+    lon, lat = Transformer.from_crs('EPSG:32632', 'EPSG:4326', always_xy=True).transform(501000, 4999500)
+    np.testing.assert_allclose(to_pixels([[lon, lat]], TRANSFORM, SHAPE, 'EPSG:4326', 'EPSG:32632'), [[100, 50]], atol=1e-6)
+
+
+def test_boxes_and_prompts_to_pixels():
+    """Boxes are reordered to min/max pixels, empty prompts stay empty"""
+    np.testing.assert_allclose(boxes_to_pixels([[500100, 4999900, 500300, 4999600]], TRANSFORM, SHAPE), [[10, 10, 30, 40]])
+
+    prompts = prompts_to_pixels({'points': [[[500100, 4999900]]], 'labels': [[1]], 'boxes': [], 'text': []},
+                                TRANSFORM, SHAPE, 'EPSG:32632', 'EPSG:32632')
+    assert prompts == {'points': [[[10.0, 10.0]]], 'labels': [[1]], 'boxes': [], 'text': []}
+
+
+def test_reproject_features():
+    """Every coordinate of every feature is reprojected, properties are kept"""
+    features = [{'properties': {'uid': 1.0}, 'geometry': {'type': 'Polygon', 'coordinates': [
+        [[500000, 4999000], [501000, 4999000], [501000, 5000000], [500000, 5000000], [500000, 4999000]]]}},
+                {'properties': {'uid': -1}, 'geometry': {'type': 'MultiPolygon', 'coordinates': []}}]
+    assert reproject_features(features, 'EPSG:32632', 'EPSG:32632') is features
+
+    reprojected = reproject_features(features, 'EPSG:32632', 'EPSG:4326')
+    assert [feature['properties'] for feature in reprojected] == [{'uid': 1.0}, {'uid': -1}]
+    lon, lat = np.array(reprojected[0]['geometry']['coordinates'][0]).T
+    assert lon == pytest.approx(9.0, abs=0.02) and lat == pytest.approx(45.15, abs=0.02)
+    assert reprojected[1]['geometry']['coordinates'] == []
@@ -0,0 +1,145 @@
+"""Test functions in easyearth.core.jobs and easyearth.core.raster_jobs modules."""
+
+import threading
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import torch
+import torch.nn.functional as F
+from rasterio.transform import from_origin
+
+from easyearth.core.jobs import CANCELLED, COMPLETED, FAILED, RUNNING, JobManager
+from easyearth.core.raster_jobs import segment_raster
+
+
+def _one_hot_logits(tiles):
+    """Logits that only depend on the pixel, class = value of the first band"""
+    classes = torch.from_numpy(np.stack([tile[:, :, 0] for tile in tiles])).long()
+    return F.one_hot(classes, num_classes=2).permute(0, 3, 1, 2).float()
+
+
+def _write_raster(path):
+    """Small georeferenced raster with blobs of class 1"""
+    rng = np.random.default_rng(0)
+    blobs = F.avg_pool2d(torch.from_numpy(rng.random((1, 1, 150, 120))).float(), 9, 1, 4)[0, 0]
+    labels = (blobs > blobs.mean()).numpy().astype(np.uint8)
+    with rasterio.open(path, 'w', driver='GTiff', height=150, width=120, count=3, dtype='uint8',
+                       transform=from_origin(500000, 4000000, 0.5, 0.5), crs='EPSG:32633') as dst:
+        dst.write(np.stack([labels] * 3))
+    return labels
+
+
+def _wait(manager):
+    """Wait for the queued jobs to finish"""
+    manager.queue.join()
+
+
+def test_job_manager_runs_and_reports_failures(tmp_path):
+    """Jobs run on the worker, failures are recorded with their error"""
+    def runner(job):
+        if job.request.get('fail'):
+            raise RuntimeError("boom")
+        job.outputs = {'value': job.request['value'] * 2}
+
+    manager = JobManager(str(tmp_path), {'double': runner})
+    ok, failed = manager.submit('double', {'value': 21}), manager.submit('double', {'fail': True})
+    _wait(manager)
+    assert ok.status == COMPLETED and ok.outputs == {'value': 42}
+    assert failed.status == FAILED and failed.error == "boom"
+    # the state is on disk for the next start of the server
+    assert JobManager(str(tmp_path), {}).get(ok.job_id).status == COMPLETED
+
+
+def test_finished_jobs_expire_with_their_outputs(tmp_path):
+    """Finished jobs of a type with a time to live are removed after it, jobs of other types are kept"""
+    manager = JobManager(str(tmp_path), {'short': lambda job: None, 'kept': lambda job: None}, ttl={'short': 0})
+    short, kept = manager.submit('short', {}), manager.submit('kept', {})
+    _wait(manager)
+    assert short.status == COMPLETED and short.expires is not None and kept.expires is None
+
+    assert manager.expire() == [short.job_id]
+    assert manager.get(short.job_id) is None and not (tmp_path / short.job_id).exists()
+    assert [job.job_id for job in manager.list()] == [kept.job_id]
+
+
+def test_jobs_of_another_process(tmp_path):
+    """A manager sharing the directory, like another server worker, sees the jobs of the others and can cancel them"""
+    started = threading.Event()
+
+    def wait_for_cancel(job):
+        started.set()
+        while True:
+            job.check_cancelled()
+
+    owner, other = JobManager(str(tmp_path), {'wait': wait_for_cancel}), JobManager(str(tmp_path), {})
+    job = owner.submit('wait', {})
+    started.wait(5)
+    assert other.get(job.job_id).status == RUNNING
+    assert [listed.job_id for listed in other.list()] == [job.job_id]
+
+    other.cancel(job.job_id)
+    _wait(owner)
+    assert job.status == CANCELLED and other.get(job.job_id).status == CANCELLED
+    assert other.get('../' + job.job_id) is None
+
+
+def test_jobs_of_a_stopped_process_are_resumed(tmp_path):
+    """The jobs of a running process are left to it, another process resumes them once their lock is released"""
+    started, stop = threading.Event(), threading.Event()
+
+    def wait_for_stop(job):
+        started.set()
+        stop.wait(5)
+
+    owner, other = JobManager(str(tmp_path), {'run': wait_for_stop}), JobManager(str(tmp_path), {'run': lambda job: None})
+    job = owner.submit('run', {})
+    started.wait(5)
+    assert other.resume() == [] and other.get(job.job_id).owner == job.owner
+
+    # the lock is released when the process exits, e.g. an old worker after a reload
+    job.release()
+    assert [resumed.job_id for resumed in other.resume()] == [job.job_id]
+    _wait(other)
+    assert other.get(job.job_id).status == COMPLETED
+    assert other.resume() == []
+    stop.set()
+
+
+def test_segment_raster_resumes_after_interruption(tmp_path):
+    """A job interrupted after some rows of tiles continues there and gives the same outputs as an uninterrupted run"""
+    labels = _write_raster(str(tmp_path / "image.tif"))
+    tiling = {'tile_size': 48, 'overlap': 8, 'batch_size': 2}
+
+    def crash_after_two_rows(job):
+        """Runner that stops like a crash once two rows of tiles are written"""
+        def check_cancelled():
+            if job.progress['rows_done'] >= 2:
+                raise RuntimeError("crash")
+        job.check_cancelled = check_cancelled
+        segment_raster(job, _one_hot_logits, **tiling)
+
+    jobs_dir = str(tmp_path / "jobs")
+    manager = JobManager(jobs_dir, {'segment_raster': crash_after_two_rows})
+    job = manager.submit('segment_raster', {'image_path': str(tmp_path / "image.tif")})
+    _wait(manager)
+    assert job.status == FAILED
+    assert job.progress['rows_done'] == 2 < job.progress['rows_total']
+
+    # simulate a restart while the job was running
+    job.status = RUNNING
+    job.save()
+    manager = JobManager(jobs_dir, {'segment_raster': lambda job: segment_raster(job, _one_hot_logits, **tiling)})
+    assert [resumed.job_id for resumed in manager.resume()] == [job.job_id]
+    _wait(manager)
+
+    job = manager.get(job.job_id)
+    assert job.status == COMPLETED
+    assert job.progress['tiles_done'] == job.progress['tiles_total']
+    with rasterio.open(job.outputs['mask']) as src:
+        assert src.crs.to_string() == 'EPSG:32633'
+        assert np.array_equal(src.read(1), labels)
+
+    polygons = gpd.read_file(job.outputs['vectors'])
+    assert sorted(polygons['tile_row'].unique()) == list(range(job.progress['rows_total']))
+    assert abs(polygons.area.sum() - labels.sum() * 0.25) < 1e-6
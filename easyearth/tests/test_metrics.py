@@ -0,0 +1,43 @@
+"""Test functions in easyearth.core.metrics module."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from easyearth.core.metrics import Counter, Histogram, render_gauge, stage, timed
+from easyearth.core.pipeline import overlap
+
+
+def test_stages_are_timed_per_request():
+    """Stages add up per request, also on the post-processing pool, and end up in the Server-Timing header"""
+    with stage('ignored'):
+        pass
+    with timed('test') as timings:
+        for _ in range(2):
+            with stage('compute'):
+                pass
+        with ThreadPoolExecutor(2) as executor:
+            list(overlap(range(3), stage('vectorize')(lambda item: item), executor=executor))
+
+    assert list(timings.stages) == ['compute', 'vectorize']
+    header = timings.header().split(', ')
+    assert [entry.split(';')[0] for entry in header] == ['compute', 'vectorize', 'total']
+    assert all(entry.split(';')[1].startswith('dur=') for entry in header)
+
+
+def test_prometheus_text_format():
+    """Histograms have cumulative buckets, labels are escaped"""
+    histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage='compute')
+    counter = Counter('lookups_total', 'Lookups')
+    counter.inc(cache='a"b')
+
+    assert histogram.render() == [
+        '# HELP latency_seconds Latency', '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{stage="compute",le="0.1"} 1',
+        'latency_seconds_bucket{stage="compute",le="1"} 2',
+        'latency_seconds_bucket{stage="compute",le="+Inf"} 3',
+        'latency_seconds_sum{stage="compute"} 5.55',
+        'latency_seconds_count{stage="compute"} 3',
+    ]
+    assert counter.render()[-1] == 'lookups_total{cache="a\\"b"} 1'
+    assert render_gauge('sessions', 'Open sessions', [({}, 2)])[-1] == 'sessions 2'
@@ -0,0 +1,103 @@
+"""Test functions in easyearth.models.postprocess module."""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from easyearth.models.postprocess import (
+    label_agreement, label_bounding_boxes, low_res_label_map, mask_roi, resize_window, rle_decode, rle_encode,
+    source_window, tiled_label_map
+)
+
+
+def _sam_post_process(low_res_mask, reshaped_input_size, original_size, pad_size=(1024, 1024)):
+    """Two resize stages of SamImageProcessor.post_process_masks for a single mask"""
+    padded = F.interpolate(low_res_mask[None, None], pad_size, mode="bilinear", align_corners=False)
+    padded = padded[..., :reshaped_input_size[0], :reshaped_input_size[1]]
+    return F.interpolate(padded, original_size, mode="bilinear", align_corners=False)[0, 0]
+
+
+def test_resize_window_matches_interpolate():
+    """A window of resize_window equals the same window of F.interpolate"""
+    torch.manual_seed(0)
+    x = torch.randn(3, 17, 23)
+    expected = F.interpolate(x[None], (101, 67), mode="bilinear", align_corners=False)[0]
+    window = (13, 88, 5, 61)
+    result = resize_window(x, (101, 67), window)
+    assert torch.allclose(result, expected[:, 13:88, 5:61], atol=1e-5)
+
+
+def test_resize_window_from_crop():
+    """resize_window gives the same result from the source window only"""
+    torch.manual_seed(0)
+    x = torch.randn(40, 30)
+    window = (50, 90, 10, 70)
+    src = source_window(window, (40, 30), (120, 100))
+    crop = x[src[0]:src[1], src[2]:src[3]]
+    result = resize_window(crop, (120, 100), window, offset=(src[0], src[2]), in_size=(40, 30))
+    assert torch.allclose(result, resize_window(x, (120, 100), window), atol=1e-5)
+
+
+def test_mask_roi_contains_upsampled_mask():
+    """Every positive pixel of the full resolution mask is inside the roi"""
+    low_res_mask = torch.full((256, 256), -5.0)
+    low_res_mask[100:120, 60:64] = 5.0
+    reshaped_input_size, original_size = (768, 1024), (1500, 2000)
+    full = _sam_post_process(low_res_mask, reshaped_input_size, original_size) > 0
+
+    x_min, y_min, x_max, y_max = mask_roi(low_res_mask, (192, 256), original_size, margin=0)
+    rows, cols = np.nonzero(full.numpy())
+    assert rows.min() >= y_min and rows.max() < y_max
+    assert cols.min() >= x_min and cols.max() < x_max
+
+
+def test_mask_roi_empty():
+    """An empty mask has no roi"""
+    assert mask_roi(torch.full((256, 256), -1.0), (256, 256), (1024, 1024)) is None
+
+
+def _reference_labels(logits, out_size):
+    """Labels from post_process_semantic_segmentation: upsample all logits, then argmax"""
+    return F.interpolate(logits[None], out_size, mode="bilinear", align_corners=False)[0].argmax(dim=0).numpy()
+
+
+def test_tiled_label_map_agrees_with_full():
+    """Tiled post-processing gives the labels of the full upsampling"""
+    torch.manual_seed(0)
+    logits = torch.randn(4, 32, 48)
+    reference = _reference_labels(logits, (250, 333))
+    labels = tiled_label_map(logits, (250, 333), tile_size=64)
+    assert labels.dtype == np.uint8
+    assert label_agreement(labels, reference) == 1.0
+
+
+def test_low_res_label_map_agrees_with_full():
+    """Low resolution argmax only differs from the full upsampling along class boundaries"""
+    torch.manual_seed(0)
+    logits = F.avg_pool2d(torch.randn(1, 2, 64, 64), 21, 1, 10)[0]
+    reference = _reference_labels(logits, (512, 512))
+    assert label_agreement(low_res_label_map(logits, (512, 512)), reference) > 0.95
+
+
+def test_label_bounding_boxes():
+    """Bounding boxes of every label, max exclusive"""
+    labels = np.zeros((20, 30), dtype=np.uint8)
+    labels[2:5, 3:9] = 1
+    labels[10:19, 20:21] = 4
+    values, boxes = label_bounding_boxes(labels)
+    assert values.tolist() == [1, 4]
+    assert boxes.tolist() == [[3, 2, 9, 5], [20, 10, 21, 19]]
+
+
+def test_rle_round_trip():
+    """rle_decode inverts rle_encode, including masks starting with a positive pixel"""
+    rng = np.random.default_rng(0)
+    for mask in [rng.random((37, 23)) > 0.7, np.ones((5, 4), dtype=bool), np.zeros((3, 3), dtype=bool)]:
+        assert np.array_equal(rle_decode(rle_encode(mask), mask.shape), mask)
+
+
+def test_rle_encode_matches_coco():
+    """Counts string of a known mask, as produced by pycocotools"""
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[1:3, 1:3] = True
+    assert rle_encode(mask) == "52203"
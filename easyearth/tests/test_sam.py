@@ -1,10 +1,12 @@
 """Test functions in easyearth.sam module."""
 
 from PIL import Image
+import numpy as np
 import requests
+import shapely.geometry
 import torch
 
-from easyearth.models.sam import Sam
+from easyearth.models.sam import Sam, chunk_prompts, reshape_labels
 
 class TestSam:
     """Test the Sam class"""
@@ -58,6 +60,40 @@ class TestSam:
         assert len(scores) == 2
 
 
+def test_chunk_prompts():
+    """Prompts with one entry per object are split into chunks, the points of a single object are not"""
+    points = [[[[x, x]] for x in range(10)]]
+    labels = [[1] * 10]
+    chunks = list(chunk_prompts(input_points=points, input_labels=labels, points_per_batch=4))
+    assert [first for first, _, _, _ in chunks] == [0, 4, 8]
+    assert chunks[2][1] == [[[[8, 8]], [[9, 9]]]] and chunks[2][3] == [[[1], [1]]] and chunks[2][2] is None
+
+    boxes = [[[x, x, x + 5, x + 5] for x in range(5)]]
+    assert [len(b[0]) for _, _, b, _ in chunk_prompts(input_boxes=boxes, boxes_per_batch=2)] == [2, 2, 1]
+
+    single = [[[1, 1], [2, 2]]]
+    assert list(chunk_prompts(input_points=single, points_per_batch=1)) == [(0, single, None, None)]
+
+
+def test_chunk_prompts_reshapes_labels():
+    """Labels of several objects given as (1, Object) are chunked with their points, in the shape of the points"""
+    points = [[[[x, x], [x + 1, x]] for x in range(5)]]
+    labels = [[1, 0] * 5]
+    chunks = list(chunk_prompts(input_points=points, input_labels=labels, points_per_batch=2))
+    assert [np.shape(chunk_labels) for _, _, _, chunk_labels in chunks] == [(1, 2, 2), (1, 2, 2), (1, 1, 2)]
+    assert chunks[2][3] == [[[1, 0]]]
+    assert reshape_labels([[[[1, 1]], [[2, 2]]]], [[1, 0]]) == [[[1], [0]]]
+
+
+def test_best_masks_to_vector():
+    """Cropped masks are polygonized in their extent, objects with empty masks are left out"""
+    mask = np.zeros((4, 6), dtype=bool)
+    mask[1:3, 2:5] = True
+    features = Sam.best_masks_to_vector([(0.9, None, None), (0.8, (10, 20, 16, 24), mask)], first=5)
+    assert [f["properties"]["uid"] for f in features] == [7.0]
+    assert shapely.geometry.shape(features[0]["geometry"]).bounds == (12.0, 21.0, 15.0, 23.0)
+
+
 # Execution function
 def test_main():
     """Run the tests"""
@@ -0,0 +1,55 @@
+"""Test functions in easyearth.config.serving and easyearth.models.registry modules."""
+
+import threading
+
+from a2wsgi import WSGIMiddleware
+
+from easyearth import init_api
+from easyearth.config.serving import available_cores, worker_layout, wsgi_threads
+from easyearth.models import registry
+
+
+def test_worker_layout():
+    """Workers of 4 threads on CPU, one worker with all cores on a GPU, overrides derive the other value"""
+    assert worker_layout(16) == (4, 4)
+    assert worker_layout(6) == (1, 6)
+    assert worker_layout(2) == (1, 2)
+    assert worker_layout(16, gpu=True) == (1, 16)
+    assert worker_layout(16, workers=2) == (2, 8)
+    assert worker_layout(16, threads=8) == (2, 8)
+    assert worker_layout(2, workers=4) == (4, 1)
+    assert available_cores() >= 1
+
+
+def test_models_are_loaded_once(monkeypatch):
+    """Concurrent requests for a model load it once, the least recently used model is released"""
+    loads = []
+
+    class Model:
+        def __init__(self, model_path):
+            loads.append(model_path)
+
+    monkeypatch.setattr(registry, '_models', registry.OrderedDict())
+    monkeypatch.setenv('MAX_LOADED_MODELS', '2')
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.get_model(Model, 'a'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ['a'] and all(model is models[0] for model in models)
+
+    registry.get_model(Model, 'b')
+    registry.get_model(Model, 'a')
+    registry.get_model(Model, 'c')
+    assert registry.loaded_models() == [('Model', 'a'), ('Model', 'c')]
+
+
+def test_init_api_serves_on_wsgi_threads_without_starting_jobs(monkeypatch):
+    """The flask app runs on WSGI_THREADS threads, and creating the app resumes no jobs, the server does"""
+    monkeypatch.setenv('WSGI_THREADS', '3')
+    app = init_api()
+    middleware = app._middleware_app.asgi_app
+    assert isinstance(middleware, WSGIMiddleware) and middleware.app == app.app.wsgi_app
+    assert middleware.executor._max_workers == wsgi_threads() == 3
+    assert not any(thread.name == 'job-watcher' for thread in threading.enumerate())
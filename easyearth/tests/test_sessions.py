@@ -0,0 +1,70 @@
+"""Test functions in easyearth.core.sessions module."""
+
+import os
+
+import numpy as np
+
+from easyearth.core.sessions import PromptCache, Session, SessionManager
+
+
+def _session(model_key, model=None):
+    return Session(model_key, model if model is not None else object(), np.zeros((4, 6, 3), dtype=np.uint8))
+
+
+def test_sessions_share_models_until_the_last_is_closed():
+    """A second session of the same model gets the cached model, which is released with the last session"""
+    manager = SessionManager()
+    loads = []
+    first = manager.add(_session('sam', manager.get_model('sam', lambda: loads.append(1) or object())))
+    second = manager.add(_session('sam', manager.get_model('sam', lambda: loads.append(1) or object())))
+    assert len(loads) == 1 and first.model is second.model
+
+    manager.close(first.session_id)
+    assert 'sam' in manager.models
+    manager.close(second.session_id)
+    assert 'sam' not in manager.models
+    assert manager.get(second.session_id) is None
+
+
+def test_idle_and_least_recently_used_sessions_are_closed():
+    """Idle sessions are evicted, and the least recently used session makes room above max_sessions"""
+    manager = SessionManager(idle_timeout=60, max_sessions=2)
+    first, second = manager.add(_session('a')), manager.add(_session('b'))
+    manager.get(first.session_id)
+    third = manager.add(_session('c'))
+    assert [session.session_id for session in manager.list()] == [first.session_id, third.session_id]
+    assert 'b' not in manager.models
+
+    first.last_used -= 120
+    assert manager.evict_idle() == [first.session_id]
+    assert [session.session_id for session in manager.list()] == [third.session_id]
+
+
+def test_prompt_cache_keys_and_closest_prompts():
+    """Keys do not depend on the order of the points, the closest cached prompt set has the same box"""
+    cache = PromptCache(max_entries=3)
+    one = cache.put(cache.key([[[10, 20]]], [[1]]), {'name': 'one'})
+    cache.put(cache.key([[[10, 20], [30, 40], [50, 60]]], [[1, 1, 0]]), {'name': 'three'})
+    cache.put(cache.key([[[10, 20]]], [[1]], [[[0, 0, 50, 50]]]), {'name': 'box'})
+
+    assert cache.get(cache.key([[[30, 40], [10, 20], [50, 60]]], [[1, 1, 0]]))['name'] == 'three'
+    # one added point is closer than two removed points
+    assert cache.closest(cache.key([[[10, 20], [30, 40]]], [[1, 1]])) is one
+    assert cache.closest(cache.key([[[30, 40]]], [[1]], [[[0, 0, 50, 50]]])) is None
+    assert cache.closest(cache.key([], None, [[[0, 0, 50, 50]]]))['name'] == 'box'
+
+    cache.put(cache.key([[[70, 80]]], [[1]]), {'name': 'four'})
+    assert len(cache.entries) == 3 and cache.get(cache.key([[[10, 20]]], [[1]])) is None
+
+
+def test_a_session_of_another_worker_is_reported(tmp_path):
+    """A worker without the session finds the worker holding it through the shared markers, until it is closed"""
+    holding, other = SessionManager(directory=str(tmp_path)), SessionManager(directory=str(tmp_path))
+    session = holding.add(_session('sam'))
+
+    assert other.get(session.session_id) is None
+    assert other.holder(session.session_id) == os.getpid()
+    assert holding.holder(session.session_id) is None
+
+    holding.close(session.session_id)
+    assert other.holder(session.session_id) is None
@@ -0,0 +1,302 @@
+"""Test functions in easyearth.core.tiling module."""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import rasterio
+import shapely.geometry
+import torch
+import torch.nn.functional as F
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+from easyearth.core.coarse_to_fine import CoarseToFine
+from easyearth.core.pipeline import TilePipeline, overlap, vectorize_windows
+from easyearth.core.tiling import TileFilter, blend_weights, blended_label_strips, merge_windows, tile_windows
+from easyearth.models.base_model import BaseModel
+from easyearth.models.segmentation import Segmentation
+
+
+def _one_hot_logits(tiles):
+    """Logits that only depend on the pixel, class = value of the first band"""
+    classes = torch.from_numpy(np.stack([tile[:, :, 0] for tile in tiles])).long()
+    return F.one_hot(classes, num_classes=4).permute(0, 3, 1, 2).float()
+
+
+def _assemble(strips, height, width):
+    """Label map from the strips, checking that they cover every row once"""
+    labels = np.full((height, width), 255, dtype=np.uint8)
+    next_row = 0
+    for row, strip in strips:
+        assert row == next_row
+        labels[row:row + strip.shape[0]] = strip
+        next_row = row + strip.shape[0]
+    assert next_row == height
+    return labels
+
+
+def test_tile_windows_cover_image():
+    """Tiles have the same size, overlap and are aligned with the end of the image"""
+    windows = [window for row in tile_windows(300, 700, 256, 32) for window in row]
+    coverage = np.zeros((300, 700), dtype=int)
+    for window in windows:
+        assert (window.height, window.width) == (256, 256)
+        coverage[window.row_off:window.row_off + 256, window.col_off:window.col_off + 256] += 1
+    assert coverage.min() >= 1
+    assert windows[-1].row_off + 256 == 300 and windows[-1].col_off + 256 == 700
+
+
+def test_blend_weights_positive():
+    """Weights ramp down towards the borders without reaching zero"""
+    weights = blend_weights(64, 64, 16)
+    assert weights.min() > 0
+    assert weights[32, 32] == 1.0
+    assert weights[0, 32] < weights[8, 32] < weights[16, 32]
+
+
+def test_blended_label_strips_from_array_and_dataset():
+    """Sliding-window labels equal the labels of the whole image, read from memory or from rasterio windows"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4, size=(203, 150, 3), dtype=np.uint8)
+    strips = blended_label_strips(image, _one_hot_logits, tile_size=64, overlap=16, batch_size=3)
+    assert np.array_equal(_assemble(strips, 203, 150), image[:, :, 0])
+
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", height=203, width=150, count=3, dtype="uint8") as dst:
+            dst.write(np.transpose(image, (2, 0, 1)))
+        with memfile.open() as src:
+            strips = blended_label_strips(src, _one_hot_logits, tile_size=64, overlap=16)
+            assert np.array_equal(_assemble(strips, 203, 150), image[:, :, 0])
+
+
+def test_tile_pipeline_matches_raster_to_vector():
+    """Polygons merged across strips cover the same area as polygonizing the whole label map"""
+    rng = np.random.default_rng(0)
+    blobs = F.avg_pool2d(torch.from_numpy(rng.random((1, 1, 180, 130))).float(), 9, 1, 4)[0, 0]
+    image = np.repeat((blobs > blobs.mean()).numpy().astype(np.uint8)[:, :, None], 3, axis=2)
+    transform = from_origin(500000, 4000000, 0.5, 0.5)
+
+    pipeline = TilePipeline(_one_hot_logits, tile_size=48, overlap=8, batch_size=3, prefetch=2, workers=2)
+    features = pipeline.vectorize(image, transform)
+    expected = BaseModel("test").raster_to_vector([image[:, :, 0]], transform)
+
+    assert [f["properties"]["uid"] for f in features] == [f["properties"]["uid"] for f in expected]
+    result, reference = shapely.geometry.shape(features[0]["geometry"]), shapely.geometry.shape(expected[0]["geometry"])
+    assert result.symmetric_difference(reference).area < 1e-6
+    assert set(pipeline.stats) == {"read", "infer", "vectorize", "skipped", "wall_s"}
+    assert pipeline.stats["infer"]["items"] == sum(len(row) for row in tile_windows(180, 130, 48, 8))
+
+
+def test_tile_pipeline_stream_matches_vectorize():
+    """Streamed strips cover the same area as vectorize without counting any part twice, the progress grows"""
+    rng = np.random.default_rng(1)
+    blobs = F.avg_pool2d(torch.from_numpy(rng.random((1, 1, 180, 130))).float(), 9, 1, 4)[0, 0]
+    image = np.repeat((blobs > blobs.mean()).numpy().astype(np.uint8)[:, :, None], 3, axis=2)
+
+    pipeline = TilePipeline(_one_hot_logits, tile_size=48, overlap=8, batch_size=3, prefetch=2, workers=2)
+    parts = list(pipeline.stream(image))
+    reference = shapely.geometry.shape(pipeline.vectorize(image)[0]["geometry"])
+
+    rows = [done for done, _ in parts]
+    assert rows == sorted(rows) and rows[-1] == 180 and len(parts) > 2
+    geometries = [shapely.geometry.shape(f["geometry"]) for _, features in parts for f in features]
+    assert abs(sum(geometry.area for geometry in geometries) - reference.area) < 1e-6
+    assert shapely.union_all(geometries).symmetric_difference(reference).area < 1e-6
+
+
+def test_tile_pipeline_resumes_before_a_clamped_last_row():
+    """A resumed run gives the same strips as an uninterrupted one, also when the last row of tiles is aligned with
+    the bottom of the image and overlaps the two rows before it"""
+    rng = np.random.default_rng(2)
+    image = np.repeat(rng.integers(0, 4, (1000, 100, 1), dtype=np.uint8), 3, axis=2)
+
+    def tile_logits(tiles):
+        # logits depending on the whole tile, so that every overlapping tile changes the blended labels
+        offsets = [torch.from_numpy(np.random.default_rng(int(tile.sum())).normal(0, 2, 4)).float() for tile in tiles]
+        return _one_hot_logits(tiles) + torch.stack(offsets)[:, :, None, None]
+
+    pipeline = TilePipeline(tile_logits, tile_size=512, overlap=64, batch_size=2, prefetch=2, workers=1)
+    assert [row[0].row_off for row in tile_windows(1000, 100, 512, 64)] == [0, 448, 488]
+    complete = {row: labels for row, labels, _ in pipeline.run(image) if row >= 488}
+    resumed = {row: labels for row, labels, _ in pipeline.run(image, start_row=2)}
+
+    assert complete.keys() == resumed.keys() == {488}
+    assert np.array_equal(complete[488], resumed[488])
+
+
+def test_tile_pipeline_workers_are_capped(monkeypatch):
+    """A request asking for more polygonization threads than the server allows gets MAX_VECTORIZE_WORKERS"""
+    monkeypatch.setenv("MAX_VECTORIZE_WORKERS", "3")
+    assert TilePipeline(_one_hot_logits, workers=1000).workers == 3
+    assert TilePipeline(_one_hot_logits, workers=2).workers == 2
+
+
+def test_overlap_processes_while_the_next_item_is_computed():
+    """An item is processed while the next one is computed, the results keep the order of the items"""
+    second_computed = threading.Event()
+
+    def items():
+        yield 0
+        second_computed.set()
+        yield 1
+        yield 2
+
+    def process(item):
+        # the first item is only done once the second one was computed meanwhile
+        assert item != 0 or second_computed.wait(5)
+        return item * 10
+
+    assert list(overlap(items(), process)) == [0, 10, 20]
+
+
+def test_forward_passes_of_a_model_take_turns():
+    """At most one thread at a time is in the compute context of a model"""
+    model, running, peak = BaseModel("test"), [], []
+
+    def forward():
+        with model.compute():
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=forward) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == [1, 1, 1, 1]
+
+
+def test_merge_windows():
+    """Overlapping and touching boxes are merged, also through a chain, boxes outside the image are dropped"""
+    regions = merge_windows([(0, 0, 10, 10), (50, 50, 60, 60), (5, 5, 20.5, 20), (20.5, 0, 30, 5), (-5, 90, 5, 120),
+                             (200, 200, 300, 300)], height=100, width=100)
+    windows = sorted((w.col_off, w.row_off, w.width, w.height, len(members)) for w, members in regions)
+    assert windows == [(0, 0, 30, 20, 3), (0, 90, 5, 10, 1), (50, 50, 10, 10, 1)]
+
+
+def test_vectorize_windows_matches_raster_to_vector():
+    """Polygonizing the label maps of windows equals polygonizing a canvas of the whole image"""
+    rng = np.random.default_rng(0)
+    labels = (rng.random((120, 150)) > 0.6).astype(np.uint8)
+    transform = from_origin(500000, 4000000, 0.5, 0.5)
+    windows = [window for window, _ in merge_windows([(0, 0, 40, 50), (30, 40, 70, 80), (100, 10, 150, 60)], 120, 150)]
+
+    canvas = np.zeros_like(labels)
+    for w in windows:
+        canvas[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width] = labels[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width]
+    features = vectorize_windows(windows, [labels[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width] for w in windows], transform)
+    expected = BaseModel("test").raster_to_vector([canvas], transform)
+
+    assert [f["properties"]["uid"] for f in features] == [f["properties"]["uid"] for f in expected]
+    result, reference = shapely.geometry.shape(features[0]["geometry"]), shapely.geometry.shape(expected[0]["geometry"])
+    assert result.symmetric_difference(reference).area < 1e-6
+
+
+def test_raster_file_to_rle_matches_raster_to_rle(tmp_path):
+    """Encoding a label raster strip by strip and label by label equals encoding the label map in memory"""
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, (130, 90)).astype(np.uint8)
+    labels[:, :30] = 0
+    path = str(tmp_path / 'labels.tif')
+    with rasterio.open(path, 'w', driver='GTiff', height=130, width=90, count=1, dtype='uint8') as dst:
+        dst.write(labels, 1)
+
+    model = BaseModel("test")
+    for encoding in ('rle', 'bitmask'):
+        assert model.raster_file_to_rle(path, None, encoding, strip_rows=32) == model.raster_to_rle([labels], None, encoding)
+
+
+class _FourClasses(Segmentation):
+    """Segmentation model with 4 classes, without loading weights"""
+
+    def __init__(self):
+        BaseModel.__init__(self, "test")
+        self.model = SimpleNamespace(config=SimpleNamespace(num_labels=4))
+
+
+def test_segmentation_paths_keep_the_classes(tmp_path):
+    """The whole image and the tiled paths give every class its own uid, also with more than 2 classes"""
+    rng = np.random.default_rng(3)
+    blobs = F.avg_pool2d(torch.from_numpy(rng.random((1, 1, 130, 90))).float(), 9, 1, 4)[0, 0].numpy()
+    labels = np.digitize(blobs, np.quantile(blobs, [0.25, 0.5, 0.75])).astype(np.uint8)
+    path = str(tmp_path / 'labels.tif')
+    with rasterio.open(path, 'w', driver='GTiff', height=130, width=90, count=1, dtype='uint8') as dst:
+        dst.write(labels, 1)
+    model = _FourClasses()
+    # the label map of the whole image as returned by get_masks
+    masks = [torch.from_numpy(labels.astype(np.int64))]
+
+    encoded = model.raster_to_rle(masks, None, 'rle')
+    assert [mask['uid'] for mask in encoded['masks']] == [1, 2, 3]
+    assert model.raster_file_to_rle(path, None, 'rle', strip_rows=32) == encoded
+
+    image = np.repeat(labels[:, :, None], 3, axis=2)
+    tiled = TilePipeline(_one_hot_logits, tile_size=48, overlap=8, batch_size=3, prefetch=2, workers=2).vectorize(image)
+    whole = model.raster_to_vector(masks)
+    assert sorted(f["properties"]["uid"] for f in tiled) == sorted(f["properties"]["uid"] for f in whole) == [1, 2, 3]
+
+
+def test_tile_filter_check():
+    """Uniform and cloudy tiles are skipped, textured ones are kept"""
+    rng = np.random.default_rng(0)
+    textured = rng.integers(0, 200, size=(32, 32, 3), dtype=np.uint8)
+    cloudy = np.full((32, 32, 3), 250, dtype=np.uint8)
+    cloudy[:2] = textured[:2]
+    tile_filter = TileFilter(min_std=1.0, cloud_brightness=240, max_cloud_fraction=0.9)
+    assert tile_filter.check(textured, None) is None
+    assert tile_filter.check(np.full((32, 32, 3), 7, dtype=np.uint8), None) == "uniform"
+    assert tile_filter.check(cloudy, None) == "cloud"
+    assert tile_filter.check(textured, np.zeros((32, 32), dtype=bool)) == "nodata"
+
+
+def test_nodata_tiles_are_skipped():
+    """Tiles in the nodata collar are not run through the model and nodata pixels get the background label"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(1, 4, size=(128, 160, 3), dtype=np.uint8)
+    image[:, :70] = 0
+    calls = []
+
+    def predict(tiles):
+        calls.append(len(tiles))
+        return _one_hot_logits(tiles)
+
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", height=128, width=160, count=3, dtype="uint8", nodata=0) as dst:
+            dst.write(np.transpose(image, (2, 0, 1)))
+        with memfile.open() as src:
+            report = {}
+            strips = blended_label_strips(src, predict, tile_size=32, overlap=0, tile_filter=TileFilter(overview_factor=4), report=report)
+            labels = _assemble(strips, 128, 160)
+
+    assert np.array_equal(labels, image[:, :, 0])
+    assert report["nodata"] == 4 * 2 and report["total"] == 4 * 5
+    assert sum(calls) == 4 * 3
+
+
+def test_coarse_to_fine_matches_full_resolution():
+    """Uniform tiles keep the coarse class, and wrong coarse classes fall back to refining every tile"""
+    def confident_logits(tiles):
+        return _one_hot_logits(tiles) * 10
+
+    image = np.zeros((256, 320, 3), dtype=np.uint8)
+    image[:128, 160:] = 1
+    image[128:, :160] = 2
+    full = _assemble(blended_label_strips(image, confident_logits, tile_size=64, overlap=16), 256, 320)
+
+    adaptive = CoarseToFine(confident_logits, tile_size=64, overlap=16, factor=4, verify_fraction=0.5)
+    assert np.array_equal(_assemble(adaptive.run(image), 256, 320), full)
+    assert not adaptive.report['fallback']
+    assert 0 < adaptive.report['refined'] < adaptive.report['tiles']
+    assert adaptive.report['compute_saved'] > 0
+
+    # alternating classes 0 and 2 average to a confident, but wrong, class 1 at the coarse resolution
+    image[:, :, 0] = np.where(np.indices((256, 320)).sum(axis=0) % 2 == 0, 0, 2)
+    full = _assemble(blended_label_strips(image, confident_logits, tile_size=64, overlap=16), 256, 320)
+    adaptive = CoarseToFine(confident_logits, tile_size=64, overlap=16, factor=4)
+    assert np.array_equal(_assemble(adaptive.run(image), 256, 320), full)
+    assert adaptive.report['fallback']
+    assert adaptive.report['refined'] == adaptive.report['tiles']
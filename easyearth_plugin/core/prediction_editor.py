@@ -15,6 +15,7 @@ from qgis.core import (
     QgsRectangle,
 )
 from osgeo import gdal  # GDAL is used for in-memory file operations
+import numpy as np
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtWidgets import QMessageBox
@@ -23,6 +24,31 @@ import os
 # Set up the logger for this module
 logger = setup_logger("easyearth_plugin.prediction_editor")
 
+def pixel_to_map_geometry(geometry, extent, width, height):
+    """Convert the coordinates of a GeoJSON geometry from pixels (col, row) of a raster to its map coordinates.
+    Every ring is converted as one array, instead of point by point.
+
+    Args:
+        geometry: GeoJSON geometry dict (Polygon or MultiPolygon)
+        extent: QgsRectangle extent of the raster
+        width, height: raster size in pixels
+
+    Returns:
+        dict: the geometry in map coordinates
+    """
+    scale = np.array([extent.width() / width, -extent.height() / height])
+    origin = np.array([extent.xMinimum(), extent.yMaximum()])
+
+    def convert(coords):
+        if len(coords) and not isinstance(coords[0], (list, tuple)):
+            return (np.asarray(coords, dtype=float) * scale + origin).tolist()
+        if len(coords) and not isinstance(coords[0][0], (list, tuple)):
+            # a ring of positions
+            return (np.asarray(coords, dtype=float).reshape(-1, 2) * scale + origin).tolist()
+        return [convert(part) for part in coords]
+
+    return {**geometry, "coordinates": convert(geometry.get("coordinates", []))}
+
 def geojson_to_gpkg(geojson_obj_or_str,
                     gpkg_path,
                     layer_name="prediction_layer",
@@ -22,6 +22,7 @@ import subprocess
 import time
 import traceback
 import urllib.request
+import uuid
 import zipfile
 
 class EasyEarthPlugin:
@@ -61,6 +62,8 @@ class EasyEarthPlugin:
         self.rubber_bands = []
         self.docker_process = None
         self.server_url = f"http://0.0.0.0:3781/easyearth"  # Base URL for the server
+        self.sessions = {}  # interactive sessions on the server, (image path, model path, embedding path) -> session id
+        self.client_id = uuid.uuid4().hex  # groups the realtime requests of this plugin, a new one supersedes the previous
         self.docker_running = False
         self.server_running = False
         self.action = None
@@ -583,6 +586,7 @@ class EasyEarthPlugin:
                               f"-v \"{self.cache_dir}\":/usr/src/app/.cache/models " # mounts the cache directory in the container
                               f"-e USER_BASE_DIR=\"{self.base_dir}\" " # sets an environment variable in the container containing the user's base directory
                               f"-e RUN_MODE=docker " # sets the run mode to docker
+                              f"-e EASYEARTH_WORKERS=1 " # one server worker, which holds the interactive sessions
                               f"{self.docker_hub_image_name}")
             result = subprocess.run(docker_run_cmd, capture_output=True, text=True, shell=True, timeout=1800)
             self.iface.messageBar().pushMessage(f"Starting server...\nRunning command: {result}", level=Qgis.Info)
@@ -1212,6 +1216,7 @@ class EasyEarthPlugin:
             #     point = transform.transform(point)
 
             prompt = []
+            prompt_crs = None
             aoi_feature = None
             point_feature = None
 
@@ -1256,7 +1261,13 @@ class EasyEarthPlugin:
 
                 point_feature["properties"]["timestamp"] = time.time() # adds timestamp to prompt feature
 
-                if is_sam:
+                if is_sam and raster_crs is not None and raster_crs.isValid() and self.project_crs.authid():
+                    # sent in map coordinates, the server converts them to pixels of the image. A custom project CRS
+                    # has no authid, so its points are sent in pixels instead
+                    prompt = [{'type': 'Point', 'data': {"points": [[point.x(), point.y()]]}}]
+                    prompt_crs = self.project_crs.authid()
+                    aoi_feature = None
+                elif is_sam:
                     prompt = [{'type': 'Point', 'data': {"points": [[px, py]]}}]
                     aoi_feature = None
                 else:
@@ -1270,7 +1281,7 @@ class EasyEarthPlugin:
             self.prompt_count[self.get_image_name()] += 1  # increments prompt counter
 
             if self.realtime_checkbox.isChecked():
-                self.get_prediction(prompt, [aoi_feature])
+                self.get_prediction(prompt, [aoi_feature], prompt_crs=prompt_crs)
             
             self.predict_group.show()
 
@@ -1519,50 +1530,15 @@ class EasyEarthPlugin:
                 } for i, feat in enumerate(features)]
                 self.prediction_count[self.get_image_name()] += len(features)
 
-                # TODO: fix no coordinate system input impact to 4326
-                # Transform pixel to map coordinates for polygons if feature_crs is None
+                # Predictions on images without georeferencing are in pixels, they are placed on the raster extent
                 if crs is None:
-                    # Transform pixel coordinates to map coordinates
                     self.iface.messageBar().pushMessage("Warning",
-                                                        f"Prediction CRS is None. Transforming pixel coordinates to project coordinates.",
+                                                        f"Prediction CRS is None. Transforming pixel coordinates to the raster extent.",
                                                         level=Qgis.Warning,
                                                         duration=5)
-                    transform = QgsCoordinateTransform(raster_crs, self.project_crs, QgsProject.instance())
-                    
                     for feature in features:
-                        geom_json = feature.get('geometry')
-                        
-                        if geom_json and geom_json['type'] == 'Polygon':
-                            map_coords = []
-                            
-                            for ring in geom_json['coordinates']:
-                                map_ring = []
-                                
-                                for pixel_coord in ring:
-                                    map_x = extent.xMinimum() + (pixel_coord[0] * extent.width() / width)
-                                    map_y = extent.yMaximum() - (pixel_coord[1] * extent.height() / height)
-                                    point = QgsPointXY(map_x, map_y)
-                                    point = transform.transform(point)
-                                    map_ring.append(point)
-                                map_coords.append(map_ring)
-                            feature['geometry']['coordinates'] = [[(p.x(), p.y()) for p in ring] for ring in map_coords]
-
-                        elif geom_json and geom_json['type'] == 'MultiPolygon':
-                            map_coords = []
-                            for polygon in geom_json['coordinates']:  # list of polygons
-                                poly_coords = []
-                                for ring in polygon:  # list of rings
-                                    map_ring = []
-                                    for pixel_coord in ring:
-                                        col, row = pixel_coord  # (x, y) = (col, row)
-                                        map_x = extent.xMinimum() + (col * extent.width() / width)
-                                        map_y = extent.yMaximum() - (row * extent.height() / height)
-                                        point = QgsPointXY(map_x, map_y)
-                                        point = transform.transform(point)
-                                        map_ring.append((point.x(), point.y()))
-                                    poly_coords.append(map_ring)
-                                map_coords.append(poly_coords)
-                            feature['geometry']['coordinates'] = map_coords
+                        if feature.get('geometry'):
+                            feature['geometry'] = prediction_editor.pixel_to_map_geometry(feature['geometry'], extent, width, height)
 
             else:
                 raise ValueError("Invalid layer_type")
@@ -1724,9 +1700,9 @@ class EasyEarthPlugin:
             # if there are boxes and points in the prompts, we need to run the prediction for both
             if self.is_sam_model():
                 if len(prompts) == 0:
-                    QMessageBox.critical(None, "Error", "No prompts found. Please draw points or boxes or use a different model.")
-                    self.iface.messageBar().pushMessage("No prompts found. Please draw points or boxes.", level=Qgis.Info)
-                    return
+                    # without prompts, the server segments every object of the image
+                    self.iface.messageBar().pushMessage("No prompts found, segmenting every object of the image.", level=Qgis.Info, duration=3)
+                    self.get_prediction([], aoi_features)
                 else:
                 #     # Check if there are both points and boxes
                 #     has_points = any(p['type'] == 'Point' for p in prompts)
@@ -1757,22 +1733,23 @@ class EasyEarthPlugin:
             self.logger.error(f"Error running prediction: {str(e)}")
             QMessageBox.critical(None, "Error", f"Failed to run prediction: {str(e)}")
 
-    def get_prediction(self, prompts, aoi_features=None):
+    def get_prediction(self, prompts, aoi_features=None, prompt_crs=None):
         if len(prompts) == 0:
-            if len(aoi_features) > 0:
-                for aoi in aoi_features:
-                    self.get_prediction_per_prompt(prompts, aoi_features=aoi)
+            if aoi_features:
+                # all areas of interest in one request, the server merges overlapping areas and reads each window once
+                self.get_prediction_per_prompt(prompts, aoi_features=aoi_features)
             else:
                 self.get_prediction_per_prompt(prompts)
         else:
             for prompt in prompts:
-                self.get_prediction_per_prompt([prompt])
+                self.get_prediction_per_prompt([prompt], prompt_crs=prompt_crs)
 
-    def get_prediction_per_prompt(self, prompts, aoi_features=None):
+    def get_prediction_per_prompt(self, prompts, aoi_features=None, prompt_crs=None):
         """Get prediction from SAM server and add to predictions layer
         Args:
             prompts: list of dicts with prompt data
-            aoi_features (Optional): list of tuples with AOI features in pixel coordinates.
+            aoi_features (Optional): tuple, QgsGeometry or list of them with the AOI features in pixel coordinates.
+            prompt_crs (Optional): authid of the CRS of the prompt coordinates, None for pixel coordinates.
         """
 
         try:
@@ -1824,6 +1801,8 @@ class EasyEarthPlugin:
                 "prompts": prompts,
                 "save_embeddings": save_embeddings
             }
+            if prompt_crs:
+                payload["prompt_crs"] = prompt_crs
 
             # add the model path to the payload if not empty
             self.model_path = self.model_dropdown.currentText().strip()
@@ -1839,7 +1818,7 @@ class EasyEarthPlugin:
                     self.model_type = model_type
 
             # use langsam model if text prompt is used for SAM model
-            if "text" in prompts[0].get('type', '').lower() and self.is_sam_model():
+            if prompts and "text" in prompts[0].get('type', '').lower() and self.is_sam_model():
                 self.model_type = "langsam"
 
             self.logger.debug(f"Model type: {self.model_type}")
@@ -1849,20 +1828,23 @@ class EasyEarthPlugin:
                 payload["model_type"] = self.model_type
 
             if aoi_features:
-                payload["aoi"] = {
-                    "type": "Rectangle",  # Must include the type field
-                    "coordinates": []
-                }
-                if isinstance(aoi_features, tuple) and len(aoi_features) == 4:
-                    # change tuple to list
-                    payload["aoi"]["coordinates"] = list(aoi_features)
-                elif isinstance(aoi_features, QgsGeometry):
-                    # Convert QgsGeometry to a tuple with 4 coordinates
-                    coords = aoi_features.boundingBox().toRectF()
-                    payload["aoi"]["coordinates"] = [coords.xMinimum(), coords.yMinimum(), coords.xMaximum(), coords.yMaximum()]
-                else:
-                    QMessageBox.critical(None, "Error", "Invalid AOI feature format. Expected tuple with 4 coordinates or QgsGeometry.")
-                    return
+                aois = []
+                for aoi in (aoi_features if isinstance(aoi_features, list) else [aoi_features]):
+                    if aoi is None:
+                        # outside the raster extent, already reported by map_geom_to_pixel_coords
+                        continue
+                    if isinstance(aoi, tuple) and len(aoi) == 4:
+                        # change tuple to list
+                        coordinates = list(aoi)
+                    elif isinstance(aoi, QgsGeometry):
+                        # Convert QgsGeometry to a tuple with 4 coordinates
+                        coords = aoi.boundingBox().toRectF()
+                        coordinates = [coords.xMinimum(), coords.yMinimum(), coords.xMaximum(), coords.yMaximum()]
+                    else:
+                        QMessageBox.critical(None, "Error", "Invalid AOI feature format. Expected tuple with 4 coordinates or QgsGeometry.")
+                        return
+                    aois.append({"type": "Rectangle", "coordinates": coordinates})  # Must include the type field
+                payload["aois"] = aois
 
             # Show payload in message bar
             if prompts is None or len(prompts) == 0:
@@ -1896,64 +1878,143 @@ class EasyEarthPlugin:
 
             # Send request to SAM server
             try:
-                response = requests.post(f"{self.server_url}/predict", json=payload, timeout=6000000)
+                if self.model_type == "sam" and prompts and not aoi_features:
+                    # the server keeps the image and its embedding, so every click only decodes the new prompts
+                    response = self.post_session_prompts(payload)
+                else:
+                    # long predictions run as a job on the server, polled without blocking QGIS
+                    if self.realtime_checkbox.isChecked():
+                        # only the prediction of the latest drawing matters, the server cancels the older ones
+                        payload.update({"session_id": self.client_id, "latest_wins": True})
+                    response = requests.post(f"{self.server_url}/jobs", json={**payload, "job_type": "predict"}, timeout=60)
+                    if response.status_code == 202:
+                        job_id = response.json()["job_id"]
+                        self.logger.debug(f"Queued prediction job {job_id}")
+                        self.poll_prediction_job(job_id, self.model_path, self.model_type)
+                        return
+
+                self.add_prediction_response(response, self.model_path, self.model_type)
 
-                self.logger.debug(f"Server response status: {response.status_code}")
-                self.logger.debug(f"Server response text: {response.text}")
+            except requests.exceptions.RequestException as e:
+                raise ValueError(f"Request failed: {str(e)}")
 
-                if response.status_code == 200:
-                    try:
-                        # After the first response from the server, if it was to save the embedding, we need to load it directly instead and avoid saving it again
-                        if self.save_embedding_radio.isChecked():
-                            self.load_embedding_radio.setChecked(True)
-                            self.save_embedding_radio.setChecked(False)
-                            self.load_embedding_radio.setEnabled(True)
-                            self.update_embeddings()
+        except Exception as e:
+            self.logger.error(f"Error getting prediction: {str(e)}")
+            self.logger.exception("Full traceback:")
+            # QMessageBox.critical(None, "Error", f"Failed to get prediction: {str(e)}")
+            tb = traceback.format_exc()
+            self.iface.messageBar().pushMessage(f'{tb}', level=Qgis.Info)
+        finally:
+            QApplication.restoreOverrideCursor()
 
-                        response_json = response.json()
+    def add_prediction_response(self, response, model_path, model_type):
+        """Add the features of a prediction response of the server to the predictions layer
+        Args:
+            response: Response of /predict, of a session or of the result of a predict job
+            model_path: Path of the model of the prediction
+            model_type: Type of the model of the prediction
+        """
+        self.logger.debug(f"Server response status: {response.status_code}")
+        self.logger.debug(f"Server response text: {response.text}")
 
-                        if not response_json:
-                            raise ValueError("Empty response from server")
+        if response.status_code == 200:
+            try:
+                # After the first response from the server, if it was to save the embedding, we need to load it directly instead and avoid saving it again
+                if self.save_embedding_radio.isChecked():
+                    self.load_embedding_radio.setChecked(True)
+                    self.save_embedding_radio.setChecked(False)
+                    self.load_embedding_radio.setEnabled(True)
+                    self.update_embeddings()
 
-                        if 'features' not in response_json:
-                            raise ValueError("Response missing 'features' field")
+                response_json = response.json()
 
-                        features = response_json['features']
-                        feature_crs = response_json.get('crs', None)
-                        text_prompt = response_json.get('text', None)
+                if not response_json:
+                    raise ValueError("Empty response from server")
 
-                        if not features:
-                            self.iface.messageBar().pushMessage("Warning", "No predictions returned from server", level=Qgis.Warning, duration=3)
-                            return
+                if 'features' not in response_json:
+                    raise ValueError("Response missing 'features' field")
 
-                        self.add_features_to_layer(features, "predictions", crs=feature_crs,
-                                                   model_path=self.model_path, model_type=self.model_type) # adds the predictions as a layer
+                features = response_json['features']
+                feature_crs = response_json.get('crs', None)
+                text_prompt = response_json.get('text', None)
 
-                    except json.JSONDecodeError as e:
-                        raise ValueError(f"Invalid JSON response: {str(e)}")
-                else:
-                    error_msg = f"Server returned status code {response.status_code}"
+                if not features:
+                    self.iface.messageBar().pushMessage("Warning", "No predictions returned from server", level=Qgis.Warning, duration=3)
+                    return
 
-                    try:
-                        error_json = response.json()
+                self.add_features_to_layer(features, "predictions", crs=feature_crs,
+                                           model_path=model_path, model_type=model_type) # adds the predictions as a layer
 
-                        if 'message' in error_json:
-                            error_msg = error_json['message']
-                    except:
-                        error_msg = response.text
-                    raise ValueError(f"Server error: {error_msg}")
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON response: {str(e)}")
+        else:
+            error_msg = f"Server returned status code {response.status_code}"
 
-            except requests.exceptions.RequestException as e:
-                raise ValueError(f"Request failed: {str(e)}")
+            try:
+                error_json = response.json()
+
+                if 'message' in error_json:
+                    error_msg = error_json['message']
+            except:
+                error_msg = response.text
+            raise ValueError(f"Server error: {error_msg}")
+
+    def poll_prediction_job(self, job_id, model_path, model_type, interval=500):
+        """Check a predict job on the server every interval milliseconds without blocking QGIS, and add its
+        result to the predictions layer once it completed
+        Args:
+            job_id: Id of the job returned by /jobs
+            model_path: Path of the model of the prediction
+            model_type: Type of the model of the prediction
+            interval: Milliseconds between two checks
+        """
+        try:
+            job = requests.get(f"{self.server_url}/jobs/{job_id}", timeout=60).json()
+            if job.get("status") in ("queued", "running"):
+                QTimer.singleShot(interval, lambda: self.poll_prediction_job(job_id, model_path, model_type, interval))
+                return
+
+            if job.get("status") == "cancelled":
+                # superseded by a newer realtime prediction
+                self.logger.debug(f"Prediction job {job_id} was cancelled")
+                return
+
+            if job.get("status") != "completed":
+                raise ValueError(f"Prediction job {job_id} {job.get('status')}: {job.get('error') or job.get('message')}")
+
+            response = requests.get(f"{self.server_url}/jobs/{job_id}/result", timeout=600)
+            self.add_prediction_response(response, model_path, model_type)
 
         except Exception as e:
             self.logger.error(f"Error getting prediction: {str(e)}")
             self.logger.exception("Full traceback:")
-            # QMessageBox.critical(None, "Error", f"Failed to get prediction: {str(e)}")
-            tb = traceback.format_exc()
-            self.iface.messageBar().pushMessage(f'{tb}', level=Qgis.Info)
-        finally:
-            QApplication.restoreOverrideCursor()
+            self.iface.messageBar().pushMessage("Error", f"Failed to get prediction: {str(e)}", level=Qgis.Critical, duration=5)
+
+    def post_session_prompts(self, payload):
+        """Send the prompts of a SAM request to an interactive session on its image, opening the session if needed
+        Args:
+            payload: The /predict request body
+        Returns:
+            The response of the server, like the one of /predict
+        """
+        key = (payload["image_path"], payload.get("model_path"), payload.get("embedding_path"))
+        for _ in range(2):
+            session_id = self.sessions.get(key)
+            if session_id is None:
+                session_request = {name: payload[name] for name in ("image_path", "model_type", "model_path", "embedding_path", "save_embeddings")
+                                   if payload.get(name) is not None}
+                response = requests.post(f"{self.server_url}/sessions", json=session_request, timeout=6000000)
+                if response.status_code != 201:
+                    return response
+                session_id = self.sessions[key] = response.json()["session_id"]
+                self.logger.debug(f"Opened session {session_id} for {payload['image_path']}")
+
+            response = requests.post(f"{self.server_url}/sessions/{session_id}/prompts", json={name: payload[name] for name in ("prompts", "prompt_crs") if name in payload}, timeout=6000000)
+            if response.status_code != 404:
+                return response
+            # the session was closed by the server after being idle, open a new one
+            self.sessions.pop(key, None)
+        return response
 
     def on_embedding_option_changed(self, button):
         """Handle embedding option changes"""
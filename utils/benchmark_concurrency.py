@@ -0,0 +1,74 @@
+"""Measure the throughput of concurrent /predict requests, with the forward passes of a model taking turns or not.
+
+Every request decodes many point prompts in chunks, so the model compute of one request can overlap with the
+post-processing (upsampling and polygonization) of the others.
+
+Usage: python -m utils.benchmark_concurrency --image /path/to/image.tif [--clients 4] [--requests 16]
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from easyearth import init_api
+from easyearth.models.registry import get_model
+from easyearth.models.sam import Sam
+
+
+def payload(image_path: str, model_path: str, height: int, width: int, prompts: int, seed: int = 0):
+    """SAM request with random point prompts, decoded in chunks"""
+    rng = np.random.default_rng(seed)
+    points = np.stack([rng.uniform(0, width - 1, prompts), rng.uniform(0, height - 1, prompts)], axis=1)
+    return {'model_type': 'sam', 'model_path': model_path, 'image_path': image_path, 'points_per_batch': 16,
+            'prompts': [{'type': 'Point', 'data': {'points': [point.tolist()]}} for point in points]}
+
+
+def throughput(client, body, clients: int, requests: int) -> float:
+    """Requests per second of `requests` requests sent by `clients` threads"""
+    remaining = list(range(requests))
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                remaining.pop()
+            response = client.post('/easyearth/predict', json=body)
+            assert response.status_code == 200, response.text
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return requests / (time.perf_counter() - start)
+
+
+def main(image_path: str, model_path: str = 'facebook/sam-vit-base', clients: int = 4, requests: int = 16,
+         prompts: int = 64):
+    import rasterio
+    with rasterio.open(image_path) as src:
+        body = payload(image_path, model_path, src.height, src.width, prompts)
+    client = init_api().test_client()
+    sam = get_model(Sam, model_path)
+    client.post('/easyearth/predict', json=body)  # warm up
+
+    print(f"{requests} requests of {prompts} prompts, {clients} clients")
+    print(f"{'1 client':>24}: {throughput(client, body, 1, requests):6.2f} requests/s")
+    for name, slots in (('concurrent forward', clients), ('forward passes in turn', 1)):
+        sam.compute_slots = threading.BoundedSemaphore(slots)
+        print(f"{name:>24}: {throughput(client, body, clients, requests):6.2f} requests/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--image', required=True, help='Path of the image')
+    parser.add_argument('--model-path', default='facebook/sam-vit-base', help='SAM model')
+    parser.add_argument('--clients', type=int, default=4, help='Number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=16, help='Number of requests per measurement')
+    parser.add_argument('--prompts', type=int, default=64, help='Number of point prompts per request')
+    args = parser.parse_args()
+    main(args.image, args.model_path, args.clients, args.requests, args.prompts)
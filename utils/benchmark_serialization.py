@@ -0,0 +1,67 @@
+"""Measure serialization time and payload size of /predict responses on Segformer-like outputs.
+
+Usage: python -m utils.benchmark_serialization [--size 4096] [--repeat 3]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import shapely
+import torch
+import torch.nn.functional as F
+from rasterio.transform import from_origin
+from shapely.geometry import shape
+
+from easyearth.core.compression import available_encodings, compress
+from easyearth.core.serialization import orjson
+from easyearth.models.base_model import BaseModel
+
+
+def synthetic_tree_cover(size: int, blob_size: int = 15, seed: int = 0) -> np.ndarray:
+    """Binary label map with irregular blobs, similar to the tree cover predicted by restor/tcd-segformer"""
+    generator = torch.Generator().manual_seed(seed)
+    noise = torch.rand((1, 1, size, size), generator=generator)
+    smooth = F.avg_pool2d(noise, blob_size, stride=1, padding=blob_size // 2)
+    return (smooth[0, 0] > smooth.mean()).numpy().astype(np.uint8)
+
+
+def timed(func, repeat):
+    """Best wall time of func over repeat runs, and its result"""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(size: int = 4096, repeat: int = 3):
+    labels = synthetic_tree_cover(size)
+    transform = from_origin(500000, 4000000, 0.1, 0.1)
+    features = BaseModel('benchmark').raster_to_vector([labels], transform)
+    payload = {'status': 'success', 'features': features, 'crs': 'EPSG:32633'}
+    # features are polygons or multipolygons, depending on the post-processing
+    num_coords = int(shapely.get_num_coordinates([shape(f['geometry']) for f in features]).sum())
+    print(f"{size}x{size} label map, {len(features)} features, {num_coords} coordinates")
+
+    encoders = {'json': lambda: json.dumps(payload).encode('utf-8')}
+    if orjson is not None:
+        encoders['orjson'] = lambda: orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    for name, encode in encoders.items():
+        seconds, body = timed(encode, repeat)
+        print(f"{name:>8}: {seconds * 1000:8.1f} ms, {len(body) / 1e6:8.2f} MB")
+
+    for encoding in available_encodings():
+        seconds, compressed = timed(lambda: compress(body, encoding), repeat)
+        print(f"{encoding:>8}: {seconds * 1000:8.1f} ms, {len(compressed) / 1e6:8.2f} MB "
+              f"({len(body) / len(compressed):.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=4096, help='Width and height of the label map in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best time is reported')
+    args = parser.parse_args()
+    main(args.size, args.repeat)